@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+
+# where key/value annotations live. every image is addressed by its file
+# name; either one jsons/<name>.json per image (the original layout) or a
+# single sqlite database for the whole dataset.
+#
+#   python3 annostore.py import /path/to/images     jsons/ -> annotations.db
+#   python3 annostore.py export /path/to/images     annotations.db -> jsons/
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import tempfile
+import argparse
+import threading
+
+
+# per-image bookkeeping that is not a key/value pair (orientation, ...) lives
+# under this key of the annotation dict. never shown, never exported
+META_KEY = '__meta__'
+
+
+def split_meta(data):
+    # -> (pairs, meta)
+    if not data:
+        return {}, {}
+    pairs = dict(data)
+    meta = pairs.pop(META_KEY, None) or {}
+    return pairs, meta
+
+
+def join_meta(pairs, meta):
+    data = dict(pairs)
+    if meta:
+        data[META_KEY] = meta
+    return data
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _write_temp(path, data):
+    # -> temp file next to path holding data, fsynced
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        _unlink(tmp)
+        raise
+    return tmp
+
+
+def atomic_write_json(path, data):
+    # temp file in the same dir + fsync + rename, a crash leaves either the old
+    # or the new file, never a truncated one
+    tmp = _write_temp(path, data)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        _unlink(tmp)
+        raise
+
+
+class JsonDirStore:
+
+    def __init__(self, json_dir):
+        self.json_dir = json_dir
+        if not os.path.exists(json_dir):
+            print('create json dir', json_dir)
+            os.makedirs(json_dir)
+
+    def path(self, name):
+        return os.path.join(self.json_dir, name + '.json')
+
+    def get(self, name):
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print('bad json', self.path(name), e)
+            return None
+
+    def put(self, name, data):
+        # names of images in sub dirs of a recursive dataset carry the sub dir
+        path = self.path(name)
+        if os.sep in name:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write_json(path, data)
+
+    def put_many(self, items):
+        # all or nothing like SqliteStore: every file is written aside first,
+        # then renamed in. on a failure the files already replaced get their
+        # old content back (kept as hard links until the end)
+        staged = []     # (path, temp file)
+        replaced = []   # (path, link to the old file or None)
+        try:
+            for name, data in items:
+                path = self.path(name)
+                if os.sep in name:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                staged.append((path, _write_temp(path, data)))
+            for path, tmp in staged:
+                old = None
+                if os.path.exists(path):
+                    old = tmp + '.old'
+                    os.link(path, old)
+                os.replace(tmp, path)
+                replaced.append((path, old))
+        except BaseException:
+            for path, old in reversed(replaced):
+                try:
+                    if old is None:
+                        os.unlink(path)
+                    else:
+                        os.replace(old, path)
+                except OSError as e:
+                    print('could not restore', path, e)
+            for _, tmp in staged[len(replaced):]:
+                _unlink(tmp)
+                _unlink(tmp + '.old')
+            raise
+        for _, old in replaced:
+            if old is not None:
+                _unlink(old)
+
+    def delete(self, name):
+        try:
+            os.unlink(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def names(self):
+        rev = []
+        for root, dirs, files in os.walk(self.json_dir):
+            rel = os.path.relpath(root, self.json_dir)
+            for f in files:
+                if f.endswith('.json') and not f.startswith('.'):
+                    rev.append(f[:-5] if rel == '.' else os.path.join(rel, f[:-5]))
+        return sorted(rev)
+
+    def items(self):
+        for name in self.names():
+            data = self.get(name)
+            if data is not None:
+                yield name, data
+
+    def stamps(self):
+        # name -> change marker (mtime + size of the file), without reading any
+        out = {}
+        dirs = ['']
+        while dirs:
+            rel = dirs.pop()
+            with os.scandir(os.path.join(self.json_dir, rel)) as it:
+                for e in it:
+                    if e.name.startswith('.'):
+                        continue
+                    if e.is_dir():
+                        dirs.append(os.path.join(rel, e.name))
+                    elif e.name.endswith('.json'):
+                        st = e.stat()
+                        out[os.path.join(rel, e.name[:-5])] = '{}:{}'.format(st.st_mtime_ns, st.st_size)
+        return out
+
+    def close(self):
+        pass
+
+
+class SqliteStore:
+    # one row per image, WAL so the GUI, the prefetch workers and the writer
+    # thread can all use it at once (one connection per thread)
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS annotations ('
+                         'name TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, name):
+        row = self._conn().execute('SELECT data FROM annotations WHERE name = ?', (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, name, data):
+        self.put_many([(name, data)])
+
+    def put_many(self, items):
+        # one transaction, all or nothing
+        now = time.time()
+        with self._conn() as conn:
+            conn.executemany('INSERT OR REPLACE INTO annotations (name, data, updated) VALUES (?, ?, ?)',
+                             ((name, json.dumps(data, ensure_ascii=False), now) for name, data in items))
+
+    def delete(self, name):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM annotations WHERE name = ?', (name,))
+
+    def names(self):
+        return [r[0] for r in self._conn().execute('SELECT name FROM annotations ORDER BY name')]
+
+    def items(self):
+        for name, data in self._conn().execute('SELECT name, data FROM annotations ORDER BY name'):
+            yield name, json.loads(data)
+
+    def stamps(self):
+        # name -> change marker (time of the last write)
+        return {name: repr(updated) for name, updated in self._conn().execute('SELECT name, updated FROM annotations')}
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+DB_NAME = 'annotations.db'
+
+
+def open_store(image_path, backend=None):
+    # backend None picks sqlite when the dataset already has a database
+    db_path = os.path.join(image_path, DB_NAME)
+    if backend is None:
+        backend = 'sqlite' if os.path.exists(db_path) else 'json'
+    if backend == 'sqlite':
+        return SqliteStore(db_path)
+    return JsonDirStore(os.path.join(image_path, 'jsons'))
+
+
+def copy_store(src, dst, batch=1000):
+    n = 0
+    chunk = []
+    for item in src.items():
+        chunk.append(item)
+        if len(chunk) >= batch:
+            dst.put_many(chunk)
+            n += len(chunk)
+            chunk = []
+    if chunk:
+        dst.put_many(chunk)
+        n += len(chunk)
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='move annotations between jsons/ and ' + DB_NAME)
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('path', help='image dir')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+
+    json_store = JsonDirStore(os.path.join(args.path, 'jsons'))
+    db_store = SqliteStore(os.path.join(args.path, DB_NAME))
+    t0 = time.perf_counter()
+    if args.action == 'import':
+        n = copy_store(json_store, db_store)
+    else:
+        n = copy_store(db_store, json_store)
+    print('{} {} annotations in {:.1f}s'.format(args.action, n, time.perf_counter() - t0))
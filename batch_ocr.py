@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+
+# headless pre-annotation: full page OCR for every image of a dataset dir,
+# written as ocr/<image>.ocr.json sidecars the GUI picks up in pageOCR mode
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import importlib.util
+import multiprocessing as mp
+
+import ocrindex
+from annostore import open_store, split_meta
+from imagelist import list_images
+from ocrengine import ENGINES, create_engine, engine_class
+
+
+_engine = None
+_engine_error = None
+
+
+def file_hash(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def is_up_to_date(image_file, ocr_dir=None, check_hash=False, rotation=0):
+    data = ocrindex.read_sidecar(image_file, ocr_dir)
+    if data is None:
+        return False
+    # read at another orientation than the one the image is labeled at
+    if data.get('rotation', 0) != rotation:
+        return False
+    if data.get('mtime') == os.path.getmtime(image_file):
+        return True
+    # touched but unchanged (copied, re-synced...): refresh the stamp, skip the OCR
+    if check_hash and data.get('sha1') and data['sha1'] == file_hash(image_file):
+        ocrindex.save_sidecar(image_file, ocrindex.PageIndex.from_dict(data), ocr_dir, sha1=data['sha1'],
+                              rotation=rotation)
+        return True
+    return False
+
+
+def check_engine(engine):
+    # -> None, or why the engine can not be used. only the registry and the
+    # engine's package are looked at, no model is loaded for it
+    try:
+        cls = engine_class(engine)
+    except ValueError as e:
+        return str(e)
+    if cls.module is not None and importlib.util.find_spec(cls.module) is None:
+        return 'python package {} is not installed'.format(cls.module)
+    return None
+
+
+def rotations(store):
+    # store name -> rotation of the images labeled turned
+    rev = {}
+    for name, data in store.items():
+        rotation = split_meta(data)[1].get('rotation', 0)
+        if rotation:
+            rev[name] = rotation
+    return rev
+
+
+def _init_worker(engine, options):
+    # an initializer that raises makes Pool respawn the worker forever, the
+    # error is handed back with the first job instead
+    global _engine, _engine_error
+    try:
+        _engine = create_engine(engine, **options)
+    except Exception as e:
+        _engine_error = '{}: {}'.format(type(e).__name__, e)
+
+
+class EngineError(RuntimeError):
+    pass
+
+
+def _ocr_one(job):
+    image_file, ocr_dir, with_hash, rotation = job
+    if _engine is None:
+        return image_file, 0, EngineError(_engine_error)
+    import cv2
+    import numpy as np
+
+    t0 = time.perf_counter()
+    img = cv2.imread(image_file)
+    if img is None:
+        return image_file, 0, 'unreadable'
+    h, w = img.shape[:2]
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if rotation:
+        # upright like the GUI shows it (clockwise), boxes are mapped back below
+        img = np.ascontiguousarray(np.rot90(img, -(rotation // 90) % 4))
+    try:
+        result = _engine.recognize(img)
+    except Exception as e:
+        return image_file, 0, str(e)
+
+    index = ocrindex.PageIndex.from_result(result, rotation, (w, h))
+    ocrindex.save_sidecar(image_file, index, ocr_dir, sha1=file_hash(image_file) if with_hash else None,
+                          rotation=rotation)
+    return image_file, time.perf_counter() - t0, None
+
+
+def run(path, workers=1, rec_batch=16, use_gpu=False, threads=None, check_hash=False, force=False, engine='paddle',
+        recursive=False):
+    json_dir = os.path.join(path, 'jsons')
+    os.makedirs(json_dir, exist_ok=True)
+
+    # sidecars go to the ocr/ dir next to each image, where the GUI looks
+    images = list_images(path, recursive)
+    store = open_store(path)
+    turned = rotations(store)
+    store.close()
+    rotation = {f: turned.get(os.path.relpath(f, path), 0) for f in images}
+    todo = [f for f in images if force or not is_up_to_date(f, None, check_hash, rotation[f])]
+    print('{} images, {} up to date, {} to do'.format(len(images), len(images) - len(todo), len(todo)))
+    if not todo:
+        return
+
+    # engines spin up their own threads per process, keep the total near the core count
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+    options = {'threads': threads}
+    if engine == 'paddle':
+        options.update(rec_batch=rec_batch, use_gpu=use_gpu)
+
+    # an unknown engine or a missing package fails here once, not in every
+    # worker. anything else the first job reports
+    err = check_engine(engine)
+    if err:
+        raise EngineError('ocr engine {} not usable: {}'.format(engine, err))
+
+    ctx = mp.get_context('spawn')
+    jobs = [(f, None, check_hash, rotation[f]) for f in todo]
+    n_done = n_failed = 0
+    t0 = last_report = time.perf_counter()
+
+    with ctx.Pool(workers, initializer=_init_worker, initargs=(engine, options)) as pool:
+        for image_file, secs, err in pool.imap_unordered(_ocr_one, jobs, chunksize=4):
+            if isinstance(err, EngineError):
+                pool.terminate()
+                raise EngineError('ocr engine {} failed in a worker: {}'.format(engine, err))
+            if err:
+                n_failed += 1
+                print('failed', image_file, err)
+            else:
+                n_done += 1
+
+            now = time.perf_counter()
+            if now - last_report > 5 or n_done + n_failed == len(jobs):
+                last_report = now
+                print('{}/{} done, {} failed, {:.2f} images/sec'.format(
+                    n_done, len(jobs), n_failed, (n_done + n_failed) / (now - t0)))
+
+    elapsed = time.perf_counter() - t0
+    print('finished {} images in {:.1f}s, {:.2f} images/sec'.format(n_done, elapsed, n_done / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OCR every image of a dataset dir into ocr/ sidecars')
+    parser.add_argument('path', help='image dir, same layout as LoadDir (images + jsons/)')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='paddle', help='OCR backend')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='worker processes')
+    parser.add_argument('--rec-batch', type=int, default=16, help='text lines per recognizer batch')
+    parser.add_argument('--threads', type=int, default=None, help='cpu threads per worker')
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--hash', action='store_true',
+                        help='also compare content hashes, so touched but unchanged images are skipped')
+    parser.add_argument('--force', action='store_true', help='redo images that are up to date')
+    parser.add_argument('--recursive', action='store_true', help='also the images of sub dirs')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+
+    try:
+        run(args.path, workers=args.workers, rec_batch=args.rec_batch, use_gpu=args.gpu,
+            threads=args.threads, check_hash=args.hash, force=args.force, engine=args.engine,
+            recursive=args.recursive)
+    except EngineError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# multi box OCR: N crops one recognize() call each vs one recognize_batch()
+#
+#   python3 bench/bench_batch_ocr.py /path/to/form.jpg --boxes 20 --repeat 5 --engine onnx
+#
+# --preprocess sends the crops through preprocess.CropPipeline first, one
+# line crops then skip detection, and prints where the time went per stage
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocrengine import ENGINES, create_engine
+from preprocess import CropPipeline
+from bench_render import percentile
+
+
+def strips(img, n):
+    # n full width bands over the page, about what a form's fields look like
+    h, w = img.shape[:2]
+    band = h // n
+    return [img[i * band:i * band + min(band, 64), w // 10:w * 9 // 10] for i in range(n)]
+
+
+def run(path, n_boxes, repeat, engine, preprocess=False):
+    import cv2
+
+    img = cv2.imread(path)
+    if img is None:
+        print('unreadable', path)
+        sys.exit(1)
+    crops = strips(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), n_boxes)
+
+    ocr = create_engine(engine)
+    ocr.warmup()
+
+    lines = None
+    if preprocess:
+        pipeline = CropPipeline(rec_height=ocr.rec_height)
+        stages = {}
+        t0 = time.perf_counter()
+        prepared = [pipeline.run(c) for c in crops]
+        prep_ms = (time.perf_counter() - t0) * 1000
+        for _, _, info in prepared:
+            for stage, ms in info['ms'].items():
+                stages[stage] = stages.get(stage, 0.0) + ms / n_boxes
+        crops = [p for p, _, _ in prepared]
+        lines = [s for _, s, _ in prepared]
+        print('preprocess {:.1f}ms, {} of {} single line, per box: {}'.format(
+            prep_ms, sum(lines), n_boxes, ' '.join('{}:{:.2f}ms'.format(k, v) for k, v in stages.items())))
+
+    single, batch = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        if lines is None:
+            one = [ocr.recognize(c) for c in crops]
+        else:
+            one = [ocr.recognize_line(c) if s else ocr.recognize(c) for c, s in zip(crops, lines)]
+        single.append((time.perf_counter() - t0) * 1000)
+
+        t0 = time.perf_counter()
+        many = ocr.recognize_batch(crops, lines)
+        batch.append((time.perf_counter() - t0) * 1000)
+
+    same = sum(1 for a, b in zip(one, many) if a.text() == b.text())
+    print('{} boxes, {} runs, {} of {} texts identical'.format(n_boxes, repeat, same, n_boxes))
+    for name, times in (('single', single), ('batch', batch)):
+        print('{:6s} p50 {:8.1f}ms  p95 {:8.1f}ms  per box {:7.1f}ms'.format(
+            name, percentile(times, 50), percentile(times, 95), percentile(times, 50) / n_boxes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('image')
+    parser.add_argument('--boxes', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='paddle')
+    parser.add_argument('--preprocess', action='store_true')
+    args = parser.parse_args()
+
+    run(args.image, args.boxes, args.repeat, args.engine, args.preprocess)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# OCR backends against each other on the same crops: load time, latency per
+# crop and per batched box, peak memory, and how often they read the same text
+#
+#   python3 bench/bench_engines.py --image /path/to/form.jpg --boxes 20
+#   python3 bench/bench_engines.py --engines onnx tesseract --threads 4
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from ocrengine import available, create_engine
+from bench_memory import rss_mb
+from bench_render import percentile
+from bench_batch_ocr import strips
+
+
+WORDS = ('INVOICE', 'Total 1,284.50', '2023-04-17', 'ACME GmbH', 'No. 000423', 'Patient ID 7731')
+
+
+def synthetic_crops(n):
+    import cv2
+    crops = []
+    for i in range(n):
+        text = WORDS[i % len(WORDS)]
+        img = np.full((48, 24 * len(text) + 20, 3), 255, dtype=np.uint8)
+        cv2.putText(img, text, (10, 34), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2, cv2.LINE_AA)
+        crops.append(img)
+    return crops
+
+
+def load_crops(image, n):
+    if not image:
+        return synthetic_crops(n)
+    import cv2
+    img = cv2.imread(image)
+    if img is None:
+        print('unreadable', image)
+        sys.exit(1)
+    return strips(cv2.cvtColor(img, cv2.COLOR_BGR2RGB), n)
+
+
+def run(engine, crops, repeat, threads):
+    t0 = time.perf_counter()
+    ocr = create_engine(engine, threads=threads)
+    load_ms = (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    ocr.warmup()
+    warmup_ms = (time.perf_counter() - t0) * 1000
+
+    single, batch = [], []
+    texts = []
+    for _ in range(repeat):
+        texts = []
+        for c in crops:
+            t0 = time.perf_counter()
+            texts.append(ocr.recognize(c).text(' '))
+            single.append((time.perf_counter() - t0) * 1000)
+        t0 = time.perf_counter()
+        ocr.recognize_batch(crops)
+        batch.append((time.perf_counter() - t0) * 1000 / len(crops))
+
+    return {'engine': engine, 'load_ms': load_ms, 'warmup_ms': warmup_ms,
+            'p50_ms': percentile(single, 50), 'p95_ms': percentile(single, 95),
+            'batch_ms_per_box': percentile(batch, 50), 'peak_mb': rss_mb()[1], 'texts': texts}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', help='crops are taken from this page, synthetic text lines otherwise')
+    parser.add_argument('--boxes', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=None, help='cpu threads per engine')
+    parser.add_argument('--engines', nargs='*', default=None, help='default: all installed ones')
+    parser.add_argument('--one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    crops = load_crops(args.image, args.boxes)
+
+    if args.one:
+        print(json.dumps(run(args.one, crops, args.repeat, args.threads)))
+        sys.exit(0)
+
+    engines = args.engines or available()
+    rows = []
+    for engine in engines:
+        # one process per engine, so load time and peak memory are its own
+        cmd = [sys.executable, __file__, '--one', engine, '--boxes', str(args.boxes), '--repeat', str(args.repeat)]
+        if args.image:
+            cmd += ['--image', args.image]
+        if args.threads:
+            cmd += ['--threads', str(args.threads)]
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        if out.returncode != 0:
+            print(engine, 'failed')
+            continue
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    ref = rows[0]['texts'] if rows else []
+    print('{:10s} {:>9s} {:>9s} {:>8s} {:>8s} {:>10s} {:>9s} {:>6s}'.format(
+        'engine', 'load', 'warmup', 'p50', 'p95', 'batch/box', 'peak', 'same'))
+    for r in rows:
+        same = sum(1 for a, b in zip(ref, r['texts']) if a == b)
+        print('{engine:10s} {load_ms:7.0f}ms {warmup_ms:7.0f}ms {p50_ms:6.1f}ms {p95_ms:6.1f}ms '
+              '{batch_ms_per_box:8.1f}ms {peak_mb:7.0f}MB'.format(**r) + ' {:3d}/{}'.format(same, len(ref)))
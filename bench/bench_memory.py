@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# peak RSS while paging through a directory of large images with ImageViewer
+#
+#   python3 bench/bench_memory.py --count 20 --size 6000x8000
+#   python3 bench/bench_memory.py --dir /path/to/scans --legacy
+
+import os
+import sys
+import glob
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QImage, QPainter, QColor, QFont
+from PyQt5.QtCore import Qt
+
+from imageviewer import ImageViewer
+from prefetch import read_image
+
+
+def rss_mb():
+    # current and peak resident set size
+    cur = peak = 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    cur = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return cur, peak
+
+
+def make_images(path, count, w, h):
+    for i in range(count):
+        img = QImage(w, h, QImage.Format.Format_RGB32)
+        img.fill(QColor(250, 250, 245))
+        p = QPainter(img)
+        p.setFont(QFont('Sans', max(12, h // 150)))
+        p.setPen(Qt.GlobalColor.black)
+        step = max(20, h // 60)
+        for y in range(step, h, step):
+            p.drawText(step, y, 'synthetic form line {} / page {}   value: {}'.format(y // step, i, y * 31 % 9973))
+        p.end()
+        img.save(os.path.join(path, 'page_{:05d}.jpg'.format(i)), 'JPG', 90)
+
+
+def legacy_array(viewer):
+    # what set_photo used to do eagerly for every image
+    _qimg = viewer._photo.pixmap().toImage()
+    _ptr = _qimg.bits()
+    _ptr.setsize(_qimg.byteCount())
+    return np.array(_ptr, dtype=np.uint8).reshape(_qimg.height(), _qimg.width(), 4)
+
+
+def run(files, legacy=False, crop_every=1):
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    viewer = ImageViewer()
+    viewer.resize(800, 730)
+
+    _, base_peak = rss_mb()
+    t0 = time.perf_counter()
+    for i, f in enumerate(files):
+        viewer.set_photo(read_image(f))
+        if legacy:
+            viewer.cv2_img = legacy_array(viewer)
+        if crop_every and i % crop_every == 0:
+            arr, _ = viewer.image_array()
+            h, w = arr.shape[:2]
+            crop = viewer.crop_rgb(w // 4, h // 4, w // 3, h // 20)
+            assert crop.shape[2] == 3
+        app.processEvents()
+        cur, peak = rss_mb()
+        print('{:4d} {:40s} rss {:8.1f}MB peak {:8.1f}MB'.format(i, os.path.basename(f), cur, peak))
+
+    elapsed = time.perf_counter() - t0
+    cur, peak = rss_mb()
+    print('{} images in {:.2f}s, baseline peak {:.1f}MB, peak {:.1f}MB ({:+.1f}MB){}'.format(
+        len(files), elapsed, base_peak, peak, peak - base_peak, ' [legacy copy]' if legacy else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', help='page through existing images instead of synthetic ones')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--size', default='5000x7000', help='WxH of synthetic images')
+    parser.add_argument('--crop-every', type=int, default=1, help='crop every Nth image, 0 for never')
+    parser.add_argument('--legacy', action='store_true', help='also do the old eager full-image copy')
+    parser.add_argument('--make', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    if args.make:
+        w, h = (int(v) for v in args.size.split('x'))
+        make_images(args.make, args.count, w, h)
+    elif args.dir:
+        run(sorted(glob.glob(os.path.join(args.dir, '*.jpg')) + glob.glob(os.path.join(args.dir, '*.png'))),
+            args.legacy, args.crop_every)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            # generate in a child so it does not count against our own peak
+            subprocess.check_call([sys.executable, __file__, '--make', tmp,
+                                   '--count', str(args.count), '--size', args.size])
+            run(sorted(glob.glob(os.path.join(tmp, '*.jpg'))), args.legacy, args.crop_every)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+# frame times for pan and zoom in ImageViewer, tiled pyramid vs one big pixmap
+#
+#   python3 bench/bench_render.py --size 12000x16000
+#   python3 bench/bench_render.py --image /path/to/huge_scan.jpg --mode tiled
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt5.QtWidgets import QApplication
+
+from imageviewer import ImageViewer
+from prefetch import read_image
+from bench_memory import rss_mb
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def frame(app, viewer):
+    t0 = time.perf_counter()
+    viewer.viewport().repaint()
+    app.processEvents()
+    return (time.perf_counter() - t0) * 1000
+
+
+def run(path, mode, steps, settle):
+    app = QApplication.instance()
+    viewer = ImageViewer()
+    viewer.resize(800, 730)
+    viewer.show()
+
+    t0 = time.perf_counter()
+    if mode == 'tiled':
+        viewer.set_tiled_photo(path)
+    else:
+        viewer.set_photo(read_image(path))
+    load_ms = (time.perf_counter() - t0) * 1000
+    frame(app, viewer)
+
+    def settle_tiles():
+        if settle and viewer._tiled is not None:
+            viewer._tiled.wait_for_tiles()
+            app.processEvents()
+
+    zoom = []
+    for i in range(steps):
+        f = 1.1 if i < steps // 2 else 1 / 1.1
+        viewer.scale(f, f)
+        zoom.append(frame(app, viewer))
+        settle_tiles()
+
+    viewer.scale(4, 4)
+    settle_tiles()
+    pan = []
+    hbar, vbar = viewer.horizontalScrollBar(), viewer.verticalScrollBar()
+    for i in range(steps):
+        hbar.setValue(hbar.value() + (40 if (i // 20) % 2 == 0 else -40))
+        vbar.setValue(vbar.value() + 25)
+        pan.append(frame(app, viewer))
+        settle_tiles()
+
+    _, peak = rss_mb()
+    print('{:6s} load {:8.1f}ms  peak rss {:8.1f}MB'.format(mode, load_ms, peak))
+    for name, times in (('zoom', zoom), ('pan', pan)):
+        print('{:6s} {:4s} mean {:7.2f}ms  p50 {:7.2f}ms  p95 {:7.2f}ms  max {:7.2f}ms'.format(
+            mode, name, sum(times) / len(times), percentile(times, 50), percentile(times, 95), max(times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image', help='existing image instead of a synthetic one')
+    parser.add_argument('--size', default='12000x16000', help='WxH of the synthetic image')
+    parser.add_argument('--mode', choices=('tiled', 'pixmap', 'both'), default='both')
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--settle', action='store_true',
+                        help='wait for tile decodes after every frame (steady state instead of first touch)')
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    modes = ('tiled', 'pixmap') if args.mode == 'both' else (args.mode,)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.image
+        if not path:
+            subprocess.check_call([sys.executable, os.path.join(os.path.dirname(__file__), 'bench_memory.py'),
+                                   '--make', tmp, '--count', '1', '--size', args.size])
+            path = os.path.join(tmp, 'page_00000.jpg')
+
+        for mode in modes:
+            # separate processes so peak rss of one mode does not hide the other
+            if len(modes) > 1:
+                cmd = [sys.executable, __file__, '--image', path, '--mode', mode, '--steps', str(args.steps)]
+                subprocess.check_call(cmd + (['--settle'] if args.settle else []))
+            else:
+                run(path, mode, args.steps, args.settle)
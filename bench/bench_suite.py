@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+
+# the hot paths of the GUI on synthetic pages, offscreen, each case in its own
+# process so peak memory is its own. results go to a json file, to compare
+# runs across commits
+#
+#   python3 bench/bench_suite.py --count 20 --size 2480x3508 --out results.json
+#   python3 bench/bench_suite.py --cases set_photo crop --compare before.json
+#
+# without --out the results go to ~/.cache/label_it/bench/, not the cwd
+#
+# cases
+#   set_photo     decode + ImageViewer.set_photo of every page
+#   crop          right button press / release on the viewer, up to imageCropped
+#   set_pairs     KeyValueWidget.set_pairs of --keys pairs
+#   edit          a value typed over in the table, up to item_modified
+#   load_json     LabelIt.load_json of annotated pages
+#   save          LabelIt.slot_kv_item_modified until the json is written
+#   ocr_stub      crop -> OcrService (preprocessing + stub engine) -> resultReady
+#
+# every case gets an empty cache dir of its own (LABEL_IT_CACHE), so runs
+# start cold and the caches in ~/.cache/label_it are never touched
+
+import os
+import sys
+import json
+import time
+import glob
+import platform
+import argparse
+import tempfile
+import subprocess
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtGui import QMouseEvent
+from PyQt5.QtCore import Qt, QEvent, QPointF, QT_VERSION_STR
+
+from cachedir import CACHE_DIR
+from bench_memory import rss_mb
+from bench_render import percentile
+
+
+CASES = ('set_photo', 'crop', 'set_pairs', 'edit', 'load_json', 'save', 'ocr_stub')
+
+
+def pairs_of(i, n_keys):
+    return {'key_{:03d}'.format(k): 'value {} of page {}'.format(k, i) for k in range(n_keys)}
+
+
+def wait_for(app, done, timeout=30):
+    t0 = time.perf_counter()
+    while not done():
+        if time.perf_counter() - t0 > timeout:
+            raise RuntimeError('timed out')
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def timed(fn, times):
+    t0 = time.perf_counter()
+    out = fn()
+    times.append((time.perf_counter() - t0) * 1000)
+    return out
+
+
+def bench_viewer(app, files, case, repeat):
+    from imageviewer import ImageViewer
+    from prefetch import read_image
+
+    viewer = ImageViewer()
+    viewer.resize(800, 730)
+    viewer.show()
+    times = []
+
+    if case == 'set_photo':
+        for _ in range(repeat):
+            for f in files:
+                timed(lambda: (viewer.set_photo(read_image(f)), app.processEvents()), times)
+        return times
+
+    crops = []
+    viewer.imageCropped.connect(lambda img, rect: crops.append(img.shape))
+    vp = viewer.viewport()
+
+    def mouse(kind, x, y):
+        return QMouseEvent(kind, QPointF(x, y), Qt.MouseButton.RightButton, Qt.MouseButton.RightButton,
+                           Qt.KeyboardModifier.NoModifier)
+
+    for f in files:
+        viewer.set_photo(read_image(f))
+        app.processEvents()
+        w, h = vp.width(), vp.height()
+        for i in range(repeat):
+            # a field sized box, moving down the page
+            y = h * (0.1 + 0.8 * i / max(repeat, 1))
+            viewer.mousePressEvent(mouse(QEvent.MouseButtonPress, w * 0.2, y))
+            timed(lambda: viewer.mouseReleaseEvent(mouse(QEvent.MouseButtonRelease, w * 0.7, y + 30)), times)
+    assert len(crops) == len(times), 'no imageCropped'
+    return times
+
+
+def bench_kv(app, case, repeat, n_keys):
+    from kvwidget import KeyValueWidget
+
+    widget = KeyValueWidget()
+    widget.resize(400, 600)
+    widget.show()
+    times = []
+    saved = []
+    widget.item_modified.connect(saved.append)
+    model = widget.model
+    for i in range(repeat):
+        pairs = pairs_of(i, n_keys)
+        if case == 'set_pairs':
+            timed(lambda: (widget.set_pairs(pairs), app.processEvents()), times)
+        else:
+            # setData like the editor commits it: pairChanged, item_modified
+            # with the pairs to save, the next row selected
+            widget.set_pairs(pairs)
+            index = model.index(i % n_keys, model.VALUE)
+            timed(lambda: (model.setData(index, 'edited {}'.format(i)), app.processEvents()), times)
+    if case == 'edit':
+        assert len(saved) == len(times), 'no item_modified'
+    return times
+
+
+def bench_labelit(app, files, case, repeat, n_keys):
+    from annostore import open_store
+    import main
+
+    path = os.path.dirname(files[0])
+    store = open_store(path)
+    for i, f in enumerate(files):
+        store.put(os.path.basename(f), pairs_of(i, n_keys))
+
+    # label.ui is loaded relative to the working dir
+    os.chdir(ROOT)
+    ui = main.LabelIt(ocr_engine='stub', ocr_cache_mb=0, prefetch=0)
+    ui.choose_dir(path)
+    wait_for(app, lambda: ui.scanner is not None and ui.scanner.isFinished() and ui.images_list)
+    ui.ui.autoSaveChk.setChecked(True)
+
+    times = []
+    for r in range(repeat):
+        for i in range(len(ui.images_list)):
+            if case == 'load_json':
+                ui.image_index = i
+                timed(ui.load_json, times)
+            else:
+                ui.show_image(i)
+                pairs = dict(ui.kvwidget.gen_all_pairs(), key_000='edited {}'.format(r))
+                timed(lambda: (ui.slot_kv_item_modified(pairs), ui.saver.flush(wait=True)), times)
+    ui.close()
+    return times
+
+
+def bench_ocr(app, files, repeat):
+    from ocrworker import OcrService
+    from ocrengine import create_engine
+    from preprocess import CropPipeline
+    from prefetch import read_image
+    from imageviewer import ImageViewer
+
+    service = OcrService(lambda: create_engine('stub'), pipeline=CropPipeline())
+    service.warmup()
+    wait_for(app, lambda: service.state == OcrService.READY)
+
+    viewer = ImageViewer()
+    results = []
+    service.resultReady.connect(lambda req_id, ctx, result: results.append(result))
+    times = []
+    for f in files:
+        viewer.set_photo(read_image(f))
+        size = viewer.image_size()
+        for i in range(repeat):
+            y = int(size.height() * (0.1 + 0.8 * i / max(repeat, 1)))
+            crop = viewer.crop_rgb(size.width() // 5, y, size.width() // 2, 40)
+            n = len(results)
+            timed(lambda: (service.submit(crop, tag=i, prepare=True), wait_for(app, lambda: len(results) > n)), times)
+    stages = service.stats()['stage_ms']
+    service.shutdown()
+    return times, stages
+
+
+def run_case(case, files, repeat, n_keys):
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    _, base_peak = rss_mb()
+    extra = {}
+    if case in ('set_photo', 'crop'):
+        times = bench_viewer(app, files, case, repeat)
+    elif case in ('set_pairs', 'edit'):
+        times = bench_kv(app, case, repeat * len(files), n_keys)
+    elif case in ('load_json', 'save'):
+        times = bench_labelit(app, files, case, repeat, n_keys)
+    else:
+        times, extra['stage_ms'] = bench_ocr(app, files, repeat)
+    _, peak = rss_mb()
+    return dict({
+        'n': len(times),
+        'mean_ms': sum(times) / len(times),
+        'p50_ms': percentile(times, 50),
+        'p95_ms': percentile(times, 95),
+        'p99_ms': percentile(times, 99),
+        'max_ms': max(times),
+        'per_s': len(times) * 1000 / sum(times) if sum(times) else 0.0,
+        'peak_rss_mb': peak,
+        'peak_rss_delta_mb': peak - base_peak,
+    }, **extra)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as f:
+        old = json.load(f)['cases']
+    print('p50 against', path)
+    for case, r in results.items():
+        if case in old:
+            before = old[case]['p50_ms']
+            print('  {:14s} {:9.2f}ms -> {:9.2f}ms  {:+6.0%}'.format(
+                case, before, r['p50_ms'], (r['p50_ms'] - before) / before if before else 0.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--count', type=int, default=10, help='synthetic pages')
+    parser.add_argument('--size', default='2480x3508', help='WxH of the synthetic pages (A4 at 300dpi)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keys', type=int, default=40, help='key/value pairs per page')
+    parser.add_argument('--out', default=None, help='results file, by default a new one in ' +
+                        os.path.join(CACHE_DIR, 'bench'))
+    parser.add_argument('--compare', help='results file of an earlier run')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # child: one case, its numbers as json on the last line of stdout
+        files = sorted(glob.glob(os.path.join(args.dir, '*.jpg')))
+        print(json.dumps(run_case(args.case, files, args.repeat, args.keys)))
+        sys.exit(0)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.check_call([sys.executable, os.path.join(os.path.dirname(__file__), 'bench_memory.py'),
+                               '--make', tmp, '--count', str(args.count), '--size', args.size])
+        for case in args.cases:
+            # a fresh copy of the pages, load_json / save write annotations next to them
+            case_dir = os.path.join(tmp, case)
+            os.mkdir(case_dir)
+            cache_dir = os.path.join(tmp, case + '.cache')
+            os.mkdir(cache_dir)
+            for f in glob.glob(os.path.join(tmp, '*.jpg')):
+                os.link(f, os.path.join(case_dir, os.path.basename(f)))
+            out = subprocess.run([sys.executable, __file__, '--case', case, '--dir', case_dir,
+                                  '--repeat', str(args.repeat), '--keys', str(args.keys)],
+                                 stdout=subprocess.PIPE, check=True,
+                                 env=dict(os.environ, LABEL_IT_CACHE=cache_dir)).stdout.decode()
+            r = results[case] = json.loads(out.strip().splitlines()[-1])
+            print('{:14s} n {:5d}  p50 {:8.2f}ms  p95 {:8.2f}ms  {:8.1f}/s  peak rss {:7.1f}MB'.format(
+                case, r['n'], r['p50_ms'], r['p95_ms'], r['per_s'], r['peak_rss_mb']))
+
+    if args.out is None:
+        os.makedirs(os.path.join(CACHE_DIR, 'bench'), exist_ok=True)
+        args.out = os.path.join(CACHE_DIR, 'bench', time.strftime('results-%Y%m%d-%H%M%S.json'))
+    with open(args.out, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'qt': QT_VERSION_STR,
+            'platform': platform.platform(),
+            'params': {'count': args.count, 'size': args.size, 'repeat': args.repeat, 'keys': args.keys},
+            'cases': results,
+        }, f, indent=1)
+    print('results in', args.out)
+
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,7 @@
+import os
+
+# where label_it keeps its caches (listings, thumbnails, OCR results, hashes,
+# traces...). no Qt here, headless tools and pool workers import it too.
+# LABEL_IT_CACHE moves it, e.g. benchmarks that must start cold and leave the
+# user's caches alone
+CACHE_DIR = os.environ.get('LABEL_IT_CACHE') or os.path.expanduser('~/.cache/label_it')
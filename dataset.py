@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import hashlib
+
+from PyQt5.QtCore import QThread, QObject, QFileSystemWatcher, pyqtSignal
+
+from cachedir import CACHE_DIR
+from imagelist import natural_key, scan_dir, walk_images
+
+
+def cache_file(path):
+    # listings are cached outside the dataset (CACHE_DIR), writing into it would
+    # change the very dir mtimes the cache is validated with
+    return os.path.join(CACHE_DIR, hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + '.json')
+
+
+def load_cache(path, recursive):
+    # cached (files, dirs), or None when the images of a scanned dir changed
+    # since. a dir whose mtime moved is listed again and compared by its
+    # entries: annotations.db-wal / -shm, schema.json, jsons/ ... come and go
+    # in the image dir and touch its mtime without changing any image
+    try:
+        with open(cache_file(path)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('recursive') != recursive:
+        return None
+    files, dirs = data['files'], data.get('dirs', {})
+    images_of, subdirs_of = {}, {}
+    for f in files:
+        images_of.setdefault(os.path.dirname(f), set()).add(f)
+    for d in dirs:
+        subdirs_of.setdefault(os.path.dirname(d), set()).add(d)
+    moved = False
+    for d, mtime in dirs.items():
+        try:
+            now = os.stat(d).st_mtime
+        except OSError:
+            return None
+        if now == mtime:
+            continue
+        images, subdirs = scan_dir(d)
+        if set(images) != images_of.get(d, set()):
+            return None
+        if recursive and set(subdirs) != subdirs_of.get(d, set()):
+            return None
+        dirs[d] = now
+        moved = True
+    if moved:
+        save_cache(path, recursive, files, dirs)
+    return files, sorted(dirs)
+
+
+def save_cache(path, recursive, files, dirs):
+    data = {'path': os.path.abspath(path), 'recursive': recursive, 'dirs': dirs, 'files': files}
+    dst = cache_file(path)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(dst + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(dst + '.tmp', dst)
+    except OSError as e:
+        print('index cache not written', e)
+
+
+class DatasetScanner(QThread):
+    # lists a dataset dir off the GUI thread. batches come out as they are
+    # found so the first image can be shown right away, `done` carries the
+    # full naturally sorted list
+    batchFound = pyqtSignal(list)
+    done = pyqtSignal(list, list)      # files, scanned dirs
+
+    BATCH = 256
+
+    def __init__(self, path, recursive=False, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.recursive = recursive
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        t0 = time.perf_counter()
+        cached = load_cache(self.path, self.recursive)
+        if cached is not None:
+            print('dataset index from cache, {} images'.format(len(cached[0])))
+            self.done.emit(*cached)
+            return
+
+        files = []
+        dirs = {}
+        batch = []
+        for d, images in walk_images(self.path, self.recursive):
+            if self._stop:
+                return
+            try:
+                dirs[d] = os.stat(d).st_mtime
+            except OSError:
+                pass
+            images.sort(key=natural_key)
+            for f in images:
+                batch.append(f)
+                if len(batch) >= self.BATCH:
+                    self.batchFound.emit(batch)
+                    files.extend(batch)
+                    batch = []
+        if batch:
+            self.batchFound.emit(batch)
+            files.extend(batch)
+
+        files.sort(key=natural_key)
+        save_cache(self.path, self.recursive, files, dirs)
+        print('scanned {} images in {:.2f}s'.format(len(files), time.perf_counter() - t0))
+        self.done.emit(files, sorted(dirs))
+
+
+class DatasetWatcher(QObject):
+    # incremental updates once the initial scan is done
+    added = pyqtSignal(list)
+    removed = pyqtSignal(list)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self._slot_dir_changed)
+        self._known = {}    # dir -> set of images
+        self.recursive = False
+
+    def watch(self, files, dirs, recursive=False):
+        if self._watcher.directories():
+            self._watcher.removePaths(self._watcher.directories())
+        self.recursive = recursive
+        self._known = {d: set() for d in dirs}
+        for f in files:
+            self._known.setdefault(os.path.dirname(f), set()).add(f)
+        if self._known:
+            self._watcher.addPaths(list(self._known))
+
+    def _slot_dir_changed(self, d):
+        # one scandir of the changed dir only, cheap even for big datasets
+        if d not in self._known:
+            return
+        added, removed = [], []
+        if not os.path.isdir(d):
+            # gone with everything under it, its parent sees it too
+            removed.extend(self._forget(d))
+        else:
+            images, subdirs = scan_dir(d)
+            now = set(images)
+            before = self._known[d]
+            self._known[d] = now
+            added.extend(now - before)
+            removed.extend(before - now)
+            if self.recursive:
+                # sub dirs made after the scan get watched (with whatever
+                # is in them already), removed ones are dropped
+                subdirs = set(subdirs)
+                for sub in subdirs:
+                    if sub not in self._known:
+                        for sd, images in walk_images(sub, True):
+                            self._known[sd] = set(images)
+                            self._watcher.addPath(sd)
+                            added.extend(images)
+                for sub in [k for k in self._known if os.path.dirname(k) == d and k not in subdirs]:
+                    removed.extend(self._forget(sub))
+        if added:
+            self.added.emit(sorted(added, key=natural_key))
+        if removed:
+            self.removed.emit(sorted(removed, key=natural_key))
+
+    def _forget(self, d):
+        # -> images of d and its sub dirs, no longer watched
+        gone = []
+        watched = set(self._watcher.directories())
+        for k in [k for k in self._known if k == d or k.startswith(d + os.sep)]:
+            gone.extend(self._known.pop(k))
+            if k in watched:
+                self._watcher.removePath(k)
+        return gone
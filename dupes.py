@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+# near duplicate images (re-scans, the same form twice...) by perceptual hash,
+# and copying an annotation to the unlabeled duplicates of a labeled image.
+#
+#   dHash     64 bits, brighter / darker between neighbours of a 9x8 grey
+#             thumbnail. JPEGs are decoded at 1/8 resolution for it
+#   cache     ~/.cache/label_it/phash.db, keyed by path + mtime + size
+#   pairs     within `radius` bits by multi-index hashing, vectorized, instead
+#             of comparing every pair. groups are their connected components
+#
+#   python3 dupes.py /path/to/images --radius 6
+#   python3 dupes.py /path/to/images --copy
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import multiprocessing as mp
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from annostore import open_store, split_meta, join_meta
+from cachedir import CACHE_DIR
+from imagelist import list_images
+from thumbcache import jpeg_size, reduction
+
+
+HASH_DB = 'phash.db'
+RADIUS = 6
+
+
+def dhash(path):
+    # -> 64 bit int, None when the image can not be read
+    import cv2
+    import numpy as np
+    flags = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+             4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+    dims = jpeg_size(path)
+    img = cv2.imread(path, flags[reduction(*dims, 64)] if dims else cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def _hash_one(job):
+    path, mtime, size = job
+    try:
+        return path, mtime, size, dhash(path)
+    except Exception as e:
+        print('hash failed', path, e)
+        return path, mtime, size, None
+
+
+class HashCache:
+    # path -> dhash, valid while mtime and size are unchanged
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            db_path = os.path.join(CACHE_DIR, HASH_DB)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS phash (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash TEXT)')
+
+    def under(self, root):
+        # every row below `root`, one range scan of the primary key
+        root = os.path.join(os.path.abspath(root), '')
+        rows = self.conn.execute('SELECT path, mtime, size, hash FROM phash WHERE path >= ? AND path < ?',
+                                 (root, root + '\uffff'))
+        return {path: (mtime, size, int(h, 16) if h else None) for path, mtime, size, h in rows}
+
+    def put_many(self, rows):
+        self.conn.executemany('INSERT OR REPLACE INTO phash VALUES (?, ?, ?, ?)',
+                              [(p, m, s, '{:016x}'.format(h) if h is not None else None) for p, m, s, h in rows])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_images(root, files, workers=None, stop=None, progress=None, db_path=None):
+    # -> {path: dhash} of every readable image, from the cache where it is up to date
+    cache = HashCache(db_path)
+    known = cache.under(root)
+    hashes = {}
+    todo = []
+    for f in files:
+        path = os.path.abspath(f)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        hit = known.get(path)
+        if hit is not None and hit[:2] == (st.st_mtime_ns, st.st_size):
+            if hit[2] is not None:
+                hashes[f] = hit[2]
+        else:
+            todo.append((path, st.st_mtime_ns, st.st_size))
+    print('{} hashes cached, {} to compute'.format(len(files) - len(todo), len(todo)))
+
+    if todo:
+        back = {os.path.abspath(f): f for f in files}
+        rows = []
+        workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        with mp.get_context('spawn').Pool(workers) as pool:
+            for i, row in enumerate(pool.imap_unordered(_hash_one, todo, chunksize=16)):
+                rows.append(row)
+                if row[3] is not None:
+                    hashes[back[row[0]]] = row[3]
+                if len(rows) >= 500:
+                    cache.put_many(rows)
+                    rows = []
+                    if progress is not None:
+                        progress(i + 1, len(todo))
+                if stop is not None and stop():
+                    pool.terminate()
+                    break
+        if rows:
+            cache.put_many(rows)
+    cache.close()
+    return hashes
+
+
+def popcount(x):
+    # set bits of every uint64
+    import numpy as np
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return table[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def near_pairs(hashes, radius=RADIUS, chunks=4):
+    # multi-index hashing: the 64 bits are cut into `chunks` parts. two hashes
+    # within `radius` bits have at least one part within radius // chunks bits
+    # of each other (pigeonhole), so per part only the exact matches of its few
+    # bit flipped variants are candidates. the matching is a sorted search
+    # over all hashes at once, no pair of unrelated hashes is ever compared.
+    # hashes: uint64 array of distinct hashes -> (i, j) index arrays, i < j
+    import numpy as np
+    n = len(hashes)
+    width = 64 // chunks
+    mask = np.uint64((1 << width) - 1)
+    flips = {0}
+    for _ in range(radius // chunks):
+        flips |= {f | (1 << b) for f in flips for b in range(width)}
+
+    found = []
+    for c in range(chunks):
+        parts = (hashes >> np.uint64(c * width)) & mask
+        order = np.argsort(parts, kind='stable')
+        ordered = parts[order]
+        for f in flips:
+            keys = parts ^ np.uint64(f)
+            lo = np.searchsorted(ordered, keys, 'left')
+            count = np.searchsorted(ordered, keys, 'right') - lo
+            total = int(count.sum())
+            if not total:
+                continue
+            i = np.repeat(np.arange(n), count)
+            j = order[np.repeat(lo, count) + np.arange(total) - np.repeat(np.cumsum(count) - count, count)]
+            keep = i < j
+            i, j = i[keep], j[keep]
+            keep = popcount(hashes[i] ^ hashes[j]) <= radius
+            found.append(i[keep].astype(np.int64) * n + j[keep])
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    pairs = np.unique(np.concatenate(found))
+    return pairs // n, pairs % n
+
+
+def cluster(hashes, radius=RADIUS):
+    # {item: hash} -> groups of 2+ items within `radius` of each other,
+    # transitively (union-find), largest first
+    import numpy as np
+    by_hash = {}
+    for item, h in hashes.items():
+        by_hash.setdefault(h, []).append(item)
+    distinct = list(by_hash)
+
+    parent = list(range(len(distinct)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(*near_pairs(np.array(distinct, dtype=np.uint64), radius)):
+        a, b = find(int(a)), find(int(b))
+        if a != b:
+            parent[a] = b
+
+    groups = {}
+    for k, h in enumerate(distinct):
+        groups.setdefault(find(k), []).extend(by_hash[h])
+    return sorted((sorted(g) for g in groups.values() if len(g) > 1), key=len, reverse=True)
+
+
+def plan_copies(store, clusters):
+    # -> [(source, target)]: in every group the image with the most filled
+    # values is the source for the members without any
+    plan = []
+    for group in clusters:
+        filled = {}
+        for name in group:
+            pairs, _ = split_meta(store.get(name))
+            filled[name] = sum(1 for v in pairs.values() if str(v).strip())
+        source = max(group, key=lambda n: filled[n])
+        if filled[source]:
+            plan.extend((source, name) for name in group if not filled[name])
+    return plan
+
+
+def copy_annotations(store, plan, batch=500, stop=None, written=None):
+    # the pairs of the source, marked as copied. the target keeps its own meta
+    # (rotation, ...) and is left alone when it got filled values since the
+    # plan was made. -> {name: data} written (into `written` when given, so
+    # a caller still has the batches done before an error)
+    written = {} if written is None else written
+    chunk = []
+    for source, target in plan:
+        if stop is not None and stop():
+            break
+        target_pairs, meta = split_meta(store.get(target))
+        if any(str(v).strip() for v in target_pairs.values()):
+            continue
+        pairs, _ = split_meta(store.get(source))
+        chunk.append((target, join_meta(pairs, dict(meta, copied_from=source))))
+        if len(chunk) >= batch:
+            store.put_many(chunk)
+            written.update(chunk)
+            chunk = []
+    if chunk:
+        store.put_many(chunk)
+        written.update(chunk)
+    return written
+
+
+class DuplicateTask(QThread):
+    # hash, cluster and plan off the GUI thread
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(list, list)   # clusters of names, [(source, target)]
+
+    def __init__(self, root, files, store, radius=RADIUS, parent=None):
+        super().__init__(parent)
+        self.root = root
+        self.files = files
+        self.store = store
+        self.radius = radius
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        t0 = time.perf_counter()
+        clusters, plan = [], []
+        try:
+            hashes = hash_images(self.root, self.files, stop=lambda: self._stop, progress=self.progress.emit)
+            if self._stop:
+                return
+            names = {os.path.relpath(f, self.root): h for f, h in hashes.items()}
+            clusters = cluster(names, self.radius)
+            plan = plan_copies(self.store, clusters)
+            print('{} groups of near duplicates in {} images, {:.1f}s'.format(
+                len(clusters), len(hashes), time.perf_counter() - t0))
+        except Exception as e:
+            print('duplicate search failed:', e)
+        finally:
+            # the store connection of this thread
+            self.store.close()
+        # always answered, the dupes button waits for it
+        self.done.emit(clusters, plan)
+
+
+class CopyAnnotationsTask(QThread):
+    done = pyqtSignal(dict)     # name -> data written
+
+    def __init__(self, store, plan, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.plan = plan
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        written = {}
+        try:
+            copy_annotations(self.store, self.plan, stop=lambda: self._stop, written=written)
+        except Exception as e:
+            # the batches written before the error stay and are reported
+            print('copy failed:', e)
+        finally:
+            self.store.close()
+        self.done.emit(written)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='near duplicate images of a dataset dir')
+    parser.add_argument('path', help='image dir')
+    parser.add_argument('--radius', type=int, default=RADIUS, help='max differing hash bits of duplicates')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--recursive', action='store_true')
+    parser.add_argument('--copy', action='store_true',
+                        help='copy the annotation of a labeled image to its unlabeled duplicates')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+
+    t0 = time.perf_counter()
+    files = list_images(args.path, args.recursive)
+    hashes = hash_images(args.path, files, args.workers)
+    clusters = cluster({os.path.relpath(f, args.path): h for f, h in hashes.items()}, args.radius)
+    print('{} images hashed in {:.1f}s, {} groups of near duplicates'.format(
+        len(hashes), time.perf_counter() - t0, len(clusters)))
+    for group in clusters:
+        print('  ' + '  '.join(group))
+
+    store = open_store(args.path)
+    plan = plan_copies(store, clusters)
+    if args.copy:
+        print('annotations copied to {} images'.format(len(copy_annotations(store, plan))))
+    elif plan:
+        print('{} unlabeled images have a labeled duplicate, --copy copies the annotations'.format(len(plan)))
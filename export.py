@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+
+# stream a labeled dataset dir out as training data
+#
+#   out/<split>/<image>              copied, optionally downscaled
+#   out/<split>/metadata.jsonl       donut: {"file_name", "ground_truth": "{\"gt_parse\": {...}}"}
+#   out/<split>/layoutlm.jsonl       words + 0..1000 boxes + tags, from the ocr/ sidecars
+#
+#   python3 export.py /path/to/images /path/to/out --split 0.8 0.1 0.1 -j 8 --max-side 2560
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import multiprocessing as mp
+
+import ocrindex
+from annostore import open_store, split_meta
+from imagelist import list_images
+
+
+SPLITS = ('train', 'validation', 'test')
+STATE_DB = '.export_state.db'
+
+
+def split_of(name, ratios, seed):
+    # deterministic, and stable when images are added or removed
+    h = int(hashlib.sha1((seed + name).encode()).hexdigest()[:8], 16) / 0xffffffff
+    acc = 0.0
+    for split, r in zip(SPLITS, ratios):
+        acc += r
+        if h < acc:
+            return split
+    return SPLITS[-1]
+
+
+def is_labeled(pairs):
+    return any(str(v).strip() for v in pairs.values())
+
+
+def tag_lines(lines, pairs):
+    # label an ocr line with the key whose value contains it, 'O' otherwise
+    tags = []
+    for text in lines:
+        t = text.strip()
+        tag = 'O'
+        if t:
+            for k, v in pairs.items():
+                if t in str(v):
+                    tag = k
+                    break
+        tags.append(tag)
+    return tags
+
+
+def _export_one(job):
+    # worker: copy/resize one image, build its records
+    name, img_file, data, rotation, out_dir, split, max_side, quality = job
+    import cv2
+
+    img = cv2.imread(img_file)
+    if img is None:
+        return name, None, 'unreadable'
+    h, w = img.shape[:2]
+    # exported upright, the orientation recorded in the GUI is applied here
+    dw, dh = (h, w) if rotation in (90, 270) else (w, h)
+
+    dst = os.path.join(out_dir, split, name)
+    if os.sep in name:
+        # an image of a sub dir keeps it under the split
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+    scale = 1.0
+    if max_side and max(dh, dw) > max_side:
+        scale = max_side / max(dh, dw)
+    if scale != 1.0 or rotation:
+        if rotation:
+            img = cv2.rotate(img, {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180,
+                                   270: cv2.ROTATE_90_COUNTERCLOCKWISE}[rotation])
+        if scale != 1.0:
+            img = cv2.resize(img, (round(dw * scale), round(dh * scale)), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(dst, img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        # untouched, copy the bytes instead of re-encoding
+        with open(img_file, 'rb') as src, open(dst, 'wb') as f:
+            f.write(src.read())
+
+    donut = {'file_name': name, 'ground_truth': json.dumps({'gt_parse': data}, ensure_ascii=False)}
+
+    layout = None
+    index = ocrindex.load_sidecar(img_file)
+    if index is not None and len(index):
+        words, boxes = [], []
+        for text, poly in zip(index.texts, index.polys):
+            pts = [ocrindex.to_display(x, y, rotation, w, h) for x, y in poly]
+            x0, y0 = min(p[0] for p in pts), min(p[1] for p in pts)
+            x1, y1 = max(p[0] for p in pts), max(p[1] for p in pts)
+            words.append(text)
+            boxes.append([max(0, min(1000, int(1000 * v / d))) for v, d in ((x0, dw), (y0, dh), (x1, dw), (y1, dh))])
+        layout = {'id': name, 'file_name': name, 'width': round(dw * scale), 'height': round(dh * scale),
+                  'words': words, 'bboxes': boxes, 'ner_tags': tag_lines(words, data)}
+
+    return name, (json.dumps(donut, ensure_ascii=False),
+                  json.dumps(layout, ensure_ascii=False) if layout else ''), None
+
+
+class OutputError(RuntimeError):
+    pass
+
+
+def clear_output(out_dir):
+    # a full run starts from nothing. our own earlier export (it has the state
+    # db) is removed, anything else in the dir is not ours to delete
+    if not os.path.isdir(out_dir) or not os.listdir(out_dir):
+        return
+    if not os.path.exists(os.path.join(out_dir, STATE_DB)):
+        raise OutputError('{} is not empty and holds no earlier export, refusing to write into it'.format(out_dir))
+    for split in SPLITS:
+        shutil.rmtree(os.path.join(out_dir, split), ignore_errors=True)
+    os.unlink(os.path.join(out_dir, STATE_DB))
+
+
+class ExportState:
+    # what was exported last time, so an incremental run only redoes changed images
+
+    def __init__(self, out_dir):
+        self.conn = sqlite3.connect(os.path.join(out_dir, STATE_DB))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS exported ('
+                          'name TEXT PRIMARY KEY, sig TEXT, split TEXT, donut TEXT, layout TEXT)')
+
+    def get(self, name):
+        return self.conn.execute('SELECT sig, split, donut, layout FROM exported WHERE name = ?', (name,)).fetchone()
+
+    def put(self, name, sig, split, donut, layout):
+        self.conn.execute('INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?, ?)', (name, sig, split, donut, layout))
+
+    def names(self):
+        return [r[0] for r in self.conn.execute('SELECT name FROM exported')]
+
+    def delete(self, name):
+        self.conn.execute('DELETE FROM exported WHERE name = ?', (name,))
+
+    def records(self, split):
+        return self.conn.execute('SELECT donut, layout FROM exported WHERE split = ? ORDER BY name', (split,))
+
+    def commit(self):
+        self.conn.commit()
+
+
+def signature(img_file, data, options):
+    h = hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode())
+    h.update(repr((os.path.getmtime(img_file), options)).encode())
+    sidecar = ocrindex.sidecar_path(img_file)
+    if os.path.exists(sidecar):
+        h.update(repr(os.path.getmtime(sidecar)).encode())
+    return h.hexdigest()
+
+
+def run(path, out_dir, ratios=(0.8, 0.1, 0.1), seed='label_it', workers=4, max_side=0, quality=95,
+        incremental=False, chunk=512, recursive=False):
+    if not incremental:
+        clear_output(out_dir)
+    for split in SPLITS:
+        os.makedirs(os.path.join(out_dir, split), exist_ok=True)
+
+    state = ExportState(out_dir)
+    store = open_store(path)
+    options = (tuple(ratios), seed, max_side, quality)
+
+    def jobs():
+        # lazily, one image at a time, so memory does not grow with the dataset
+        for img_file in list_images(path, recursive):
+            # the store key, with the sub dir in a recursive dataset
+            name = os.path.relpath(img_file, path)
+            data, meta = split_meta(store.get(name))
+            if not is_labeled(data):
+                continue
+            rotation = meta.get('rotation', 0)
+            split = split_of(name, ratios, seed)
+            sig = signature(img_file, data, options + (rotation,))
+            old = state.get(name)
+            if old is not None and old[0] == sig:
+                yield name, None
+                continue
+            if old is not None and old[1] != split:
+                _remove(out_dir, old[1], name)
+            yield name, ((name, img_file, data, rotation, out_dir, split, max_side, quality), sig, split)
+
+    seen = set()
+    n_done = n_skipped = n_failed = 0
+    t0 = time.perf_counter()
+
+    with mp.get_context('spawn').Pool(workers) as pool:
+        batch = []
+
+        def drain(batch):
+            nonlocal n_done, n_failed
+            meta = {b[0][0]: b for b in batch}
+            for name, records, err in pool.imap_unordered(_export_one, [b[0] for b in batch]):
+                if err:
+                    n_failed += 1
+                    print('failed', name, err)
+                    continue
+                _, sig, split = meta[name]
+                state.put(name, sig, split, records[0], records[1])
+                n_done += 1
+            state.commit()
+            print('{} exported, {} unchanged, {} failed, {:.1f} images/sec'.format(
+                n_done, n_skipped, n_failed, n_done / (time.perf_counter() - t0)))
+
+        for name, job in jobs():
+            seen.add(name)
+            if job is None:
+                n_skipped += 1
+                continue
+            batch.append(job)
+            if len(batch) >= chunk:
+                drain(batch)
+                batch = []
+        if batch:
+            drain(batch)
+
+    # images that lost their labels or disappeared since the last export
+    for name in state.names():
+        if name not in seen:
+            row = state.get(name)
+            _remove(out_dir, row[1], name)
+            state.delete(name)
+    state.commit()
+
+    # jsonl files are rewritten from the state, streamed row by row
+    for split in SPLITS:
+        with open(os.path.join(out_dir, split, 'metadata.jsonl'), 'w') as fd, \
+                open(os.path.join(out_dir, split, 'layoutlm.jsonl'), 'w') as fl:
+            for donut, layout in state.records(split):
+                fd.write(donut + '\n')
+                if layout:
+                    fl.write(layout + '\n')
+
+    print('done: {} exported, {} unchanged, {} failed in {:.1f}s'.format(
+        n_done, n_skipped, n_failed, time.perf_counter() - t0))
+
+
+def _remove(out_dir, split, name):
+    try:
+        os.unlink(os.path.join(out_dir, split, name))
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a labeled dir as Donut / LayoutLMv3 training data')
+    parser.add_argument('path', help='image dir')
+    parser.add_argument('out', help='output dir')
+    parser.add_argument('--split', type=float, nargs=3, default=(0.8, 0.1, 0.1), metavar=('TRAIN', 'VAL', 'TEST'))
+    parser.add_argument('--seed', default='label_it', help='changes which images land in which split')
+    parser.add_argument('-j', '--workers', type=int, default=4)
+    parser.add_argument('--max-side', type=int, default=0, help='downscale images so the long side fits, 0 keeps them')
+    parser.add_argument('--quality', type=int, default=95, help='jpeg quality for downscaled images')
+    parser.add_argument('--incremental', action='store_true', help='only redo images whose annotation changed')
+    parser.add_argument('--recursive', action='store_true', help='also the images in sub dirs, labeled with --recursive')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+    total = sum(args.split)
+    try:
+        run(args.path, args.out, [r / total for r in args.split], args.seed, args.workers,
+            args.max_side, args.quality, args.incremental, recursive=args.recursive)
+    except OutputError as e:
+        print(e)
+        sys.exit(1)
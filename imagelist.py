@@ -0,0 +1,68 @@
+import os
+import re
+import bisect
+
+# listing image dirs, no Qt here: the command line tools (batch_ocr, export,
+# ...) use it without loading the GUI
+
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+# our own sidecar dirs, never part of the dataset
+SKIP_DIRS = ('jsons', 'ocr', 'thumbs')
+
+_digits = re.compile(r'(\d+)')
+
+
+def natural_key(path):
+    # page2.jpg before page10.jpg
+    return [int(t) if t.isdigit() else t.lower() for t in _digits.split(path)]
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_EXTS) and not name.startswith('.')
+
+
+def scan_dir(path):
+    # (image paths, sub dirs) of one directory
+    images, subdirs = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in SKIP_DIRS:
+                        subdirs.append(entry.path)
+                elif is_image(entry.name):
+                    images.append(entry.path)
+    except OSError as e:
+        print('scan failed', path, e)
+    return images, subdirs
+
+
+def walk_images(path, recursive=False):
+    # yields (dir, [images in it]) directory by directory
+    todo = [path]
+    while todo:
+        d = todo.pop()
+        images, subdirs = scan_dir(d)
+        yield d, images
+        if recursive:
+            todo.extend(sorted(subdirs, key=natural_key, reverse=True))
+
+
+def list_images(path, recursive=False):
+    rev = []
+    for _, images in walk_images(path, recursive):
+        rev.extend(images)
+    rev.sort(key=natural_key)
+    return rev
+
+
+def insort_natural(files, keys, f):
+    # files kept naturally sorted, keys is the parallel list of natural_key()s
+    k = natural_key(f)
+    i = bisect.bisect_left(keys, k)
+    files.insert(i, f)
+    keys.insert(i, k)
+    return i
@@ -1,23 +1,97 @@
 from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import QGraphicsScene, QGraphicsPixmapItem, QGraphicsView, QFrame, QToolButton, QVBoxLayout, QHBoxLayout, QLineEdit, QWidget, QApplication, QFileDialog
-from PyQt5.QtGui import QColor, QBrush, QPixmap
+from PyQt5.QtGui import QColor, QBrush, QPixmap, QImageReader
 from PyQt5.QtCore import pyqtSignal, Qt, QPoint, QRectF
 
-import cv2
+import sys
 import numpy as np
 
+import instrument
+from tiledimage import TiledImageItem, can_tile
+
+
+QImage = QtGui.QImage
+
+# 32 bit formats we can view as-is, channel order of the bytes in memory
+_BYTE_ORDER = {
+    QImage.Format.Format_RGBA8888: 'RGBA',
+    QImage.Format.Format_RGBX8888: 'RGBA',
+    QImage.Format.Format_RGBA8888_Premultiplied: 'RGBA',
+    QImage.Format.Format_RGB32: 'BGRA' if sys.byteorder == 'little' else 'ARGB',
+    QImage.Format.Format_ARGB32: 'BGRA' if sys.byteorder == 'little' else 'ARGB',
+    QImage.Format.Format_ARGB32_Premultiplied: 'BGRA' if sys.byteorder == 'little' else 'ARGB',
+    QImage.Format.Format_RGB888: 'RGB',
+    QImage.Format.Format_Grayscale8: 'GRAY',
+}
+
+
+def qimage_view(qimg):
+    # zero-copy numpy view on the QImage pixels, honouring bytesPerLine padding.
+    # returns (array, channel order), the QImage must outlive the array.
+    order = _BYTE_ORDER.get(qimg.format())
+    if order is None:
+        # indexed, 16 bit... nothing sensible to view, normalise once
+        qimg = qimg.convertToFormat(QImage.Format.Format_RGBA8888)
+        order = 'RGBA'
+
+    h, w, bpl = qimg.height(), qimg.width(), qimg.bytesPerLine()
+    ptr = qimg.constBits()
+    ptr.setsize(bpl * h)
+
+    if order == 'GRAY':
+        arr = np.ndarray((h, w), dtype=np.uint8, buffer=ptr, strides=(bpl, 1))
+    else:
+        c = len(order)
+        arr = np.ndarray((h, w, c), dtype=np.uint8, buffer=ptr, strides=(bpl, c, 1))
+    arr.flags.writeable = False
+    return arr, order, qimg
+
+
+def rotate_array(arr, rotation):
+    # clockwise, multiples of 90 only
+    k = (rotation // 90) % 4
+    return np.ascontiguousarray(np.rot90(arr, -k)) if k else arr
+
+
+def to_rgb(arr, order):
+    # the minimal conversion OCR needs, only ever applied to a crop. always a
+    # fresh array, the result may outlive the QImage the view points into
+    if order == 'RGB':
+        return arr.copy()
+    if order == 'GRAY':
+        return np.repeat(arr[:, :, None], 3, axis=2)
+    if order == 'RGBA':
+        return np.ascontiguousarray(arr[:, :, :3])
+    if order == 'BGRA':
+        return np.ascontiguousarray(arr[:, :, 2::-1])
+    # ARGB
+    return np.ascontiguousarray(arr[:, :, 1:])
+
+
 class ImageViewer(QGraphicsView):
     imageClicked = pyqtSignal(QPoint)
-    imageCropped = pyqtSignal(np.ndarray)
+    # RGB crop pixels (upright as shown), crop rect in unrotated image coordinates
+    imageCropped = pyqtSignal(np.ndarray, QRectF)
+    # multi box mode: a box was drawn, rect in unrotated image coordinates.
+    # nothing is cropped until the boxes are taken with crop_boxes()
+    boxDrawn = pyqtSignal(QRectF)
+
+    # above this many pixels images are shown through a tiled mip pyramid
+    TILE_PIXELS = 40 * 1000 * 1000
 
     def __init__(self, parent=None):
         super().__init__(parent)
 
         self._draw_box = None
         self._draw_box_label = None
+        self._multi = False
+        self._boxes = {}    # key -> (rect item, label item, rect in image coordinates)
 
         self._zoom = 0
         self._empty = True
+        self._view = None
+        self._tiled = None
+        self._rotation = 0
         self._scene = QGraphicsScene(self)
         self._photo = QGraphicsPixmapItem()
         self.scale_level = 1.0
@@ -37,8 +111,48 @@ class ImageViewer(QGraphicsView):
     def has_photo(self):
         return not self._empty
 
+    def _image_item(self):
+        return self._tiled if self._tiled is not None else self._photo
+
+    def image_rect(self):
+        # in scene coordinates, i.e. after rotation
+        item = self._image_item()
+        return item.mapRectToScene(item.boundingRect())
+
+    def image_size(self):
+        # unrotated
+        r = self._image_item().boundingRect()
+        return QtCore.QSize(int(r.width()), int(r.height()))
+
+    def rotation(self):
+        return self._rotation
+
+    def set_rotation(self, rotation):
+        # orientation is only a view transform, the pixels are never touched
+        rotation %= 360
+        item = self._image_item()
+        r = item.boundingRect()
+        w, h = r.width(), r.height()
+
+        t = QtGui.QTransform()
+        if rotation == 90:
+            t.translate(h, 0)
+        elif rotation == 180:
+            t.translate(w, h)
+        elif rotation == 270:
+            t.translate(0, w)
+        t.rotate(rotation)
+        item.setTransform(t)
+        self._rotation = rotation
+
+        self.fit_in_view()
+
+    def scene_to_image(self, rect):
+        # scene rect -> rect in unrotated image pixels
+        return self._image_item().mapRectFromScene(rect)
+
     def fit_in_view(self, scale=True):
-        rect = QRectF(self._photo.pixmap().rect())
+        rect = self.image_rect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.has_photo():
@@ -51,21 +165,49 @@ class ImageViewer(QGraphicsView):
                 self.scale(factor, factor)
             self._zoom = 0
 
+    def _drop_tiled(self):
+        if self._tiled is not None:
+            self._tiled.close()
+            self._scene.removeItem(self._tiled)
+            self._tiled = None
+
+    def set_tiled_photo(self, path):
+        # huge scans: nothing is decoded at full resolution until a crop asks for it
+        if not can_tile(QImageReader(path)):
+            self.set_photo(QImageReader(path).read())
+            return
+        self._zoom = 0
+        self._view = None
+        self._drop_tiled()
+        self._photo.setPixmap(QPixmap())
+        self._photo.setTransform(QtGui.QTransform())
+        self._rotation = 0
+
+        self._tiled = TiledImageItem(path)
+        self._tiled.setZValue(-1)
+        self._scene.addItem(self._tiled)
+        self._empty = self._tiled.image_size().isEmpty()
+        self.setDragMode(QGraphicsView.DragMode.NoDrag if self._empty else QGraphicsView.DragMode.ScrollHandDrag)
+
+        self.fit_in_view()
+
     def set_photo(self, pixmap=None):
+        # accepts a QPixmap or a QImage, pixels are only looked at once a crop is asked for
+        with instrument.span('set_photo'):
+            self._set_photo(pixmap)
+
+    def _set_photo(self, pixmap):
         self._zoom = 0
+        self._view = None
+        self._drop_tiled()
+        self._photo.setTransform(QtGui.QTransform())
+        self._rotation = 0
+        if isinstance(pixmap, QImage):
+            pixmap = QPixmap.fromImage(pixmap) if not pixmap.isNull() else None
         if pixmap and not pixmap.isNull():
             self._empty = False
             self.setDragMode(QGraphicsView.DragMode.ScrollHandDrag)
             self._photo.setPixmap(pixmap)
-
-            _qimg = self._photo.pixmap().toImage()
-            _shape = _qimg.height(), _qimg.width()
-            _shape += (4,)
-            _ptr = _qimg.bits()
-            _ptr.setsize(_qimg.byteCount())
-            # print(_ptr.getsize())
-
-            self.cv2_img = np.array(_ptr, dtype=np.uint8).reshape(_shape)
         else:
             self._empty = True
             self.setDragMode(QGraphicsView.DragMode.NoDrag)
@@ -73,9 +215,49 @@ class ImageViewer(QGraphicsView):
 
         self.fit_in_view()
 
+    def image_array(self):
+        # (view, channel order) on the shown pixels. with the raster backend
+        # toImage() shares the pixmap buffer, so nothing is copied here
+        if self._empty:
+            return None, None
+        if self._view is None:
+            with instrument.span('image_array'):
+                if self._tiled is not None:
+                    self._view = qimage_view(self._tiled.source.read_full())
+                else:
+                    self._view = qimage_view(self._photo.pixmap().toImage())
+        return self._view[0], self._view[1]
+
+    def crop_rgb(self, x, y, w, h):
+        # x, y, w, h in unrotated image pixels, the crop comes back upright as shown
+        with instrument.span('crop'):
+            return self._crop_rgb(x, y, w, h)
+
+    def _crop_rgb(self, x, y, w, h):
+        if self._tiled is not None and self._view is None:
+            # straight from the file at full resolution, never the pyramid
+            region = self._tiled.source.read_region(QtCore.QRect(int(x), int(y), int(w), int(h)))
+            arr, order, _ = qimage_view(region)
+            return rotate_array(to_rgb(arr, order), self._rotation)
+
+        arr, order = self.image_array()
+        if arr is None:
+            return None
+        return rotate_array(to_rgb(arr[int(y):int(y + h), int(x):int(x + w)], order), self._rotation)
+
+    def rgb_image(self, rotated=True):
+        arr, order = self.image_array()
+        if arr is None:
+            return None
+        rgb = to_rgb(arr, order)
+        return rotate_array(rgb, self._rotation) if rotated else rgb
+
     def set_drawbox_color(self, color, width=2, style=Qt.PenStyle.SolidLine):
+        # the box may be gone already when an async OCR result arrives
+        if self._draw_box is None:
+            return
         self._draw_box.setPen(
-            QtGui.QPen(color, width, Qt.PenStyle.SolidLine))
+            QtGui.QPen(color, width, style))
 
     def clear_draw_box(self):
         if self._draw_box is not None:
@@ -85,6 +267,55 @@ class ImageViewer(QGraphicsView):
             self._scene.removeItem(self._draw_box_label)
             self._draw_box_label = None
 
+    def set_multi_box(self, on):
+        self._multi = on
+        self.clear_draw_box()
+        if not on:
+            self.clear_boxes()
+
+    def is_multi_box(self):
+        return self._multi
+
+    def keep_box(self, key):
+        # the box just drawn stays on the image, bound to `key`
+        if self._draw_box is None:
+            return
+        self.remove_box(key)
+        rect = self._draw_box.rect()
+        label = self._scene.addText(key, font=QtGui.QFont('Noto', 12))
+        label.setDefaultTextColor(Qt.GlobalColor.magenta)
+        label.setPos(rect.x(), rect.y() - label.boundingRect().height())
+        self._draw_box.setPen(QtGui.QPen(Qt.GlobalColor.magenta, 2, Qt.PenStyle.DashLine))
+        self._boxes[key] = (self._draw_box, label, self.scene_to_image(rect))
+        self._draw_box = None
+
+    def remove_box(self, key):
+        box = self._boxes.pop(key, None)
+        if box is not None:
+            self._scene.removeItem(box[0])
+            self._scene.removeItem(box[1])
+
+    def clear_boxes(self):
+        for key in list(self._boxes):
+            self.remove_box(key)
+
+    def boxes(self):
+        # [(key, rect in image coordinates)] in the order they were drawn
+        return [(key, box[2]) for key, box in self._boxes.items()]
+
+    def crop_boxes(self):
+        # [(key, RGB crop upright as shown, rect)]
+        return [(key, self.crop_rgb(r.x(), r.y(), r.width(), r.height()), r) for key, r in self.boxes()]
+
+    def set_box_result(self, key, color, width=2, text=None):
+        box = self._boxes.get(key)
+        if box is None:
+            return
+        box[0].setPen(QtGui.QPen(color, width))
+        box[1].setDefaultTextColor(color)
+        if text is not None:
+            box[1].setPlainText('{}: {}'.format(key, text))
+
     def add_text_in_draw_box(self, text):
         if self._draw_box is not None:
             if self._draw_box_label is None:
@@ -161,7 +392,7 @@ class ImageViewer(QGraphicsView):
     def mousePressEvent(self, event):
         super().mousePressEvent(event)
 
-        if self._photo.isUnderMouse():
+        if self._photo.isUnderMouse() or (self._tiled is not None and self._tiled.isUnderMouse()):
             self.imageClicked.emit(self.mapToScene(event.pos()).toPoint())
 
         ebtn = event.button()
@@ -208,35 +439,43 @@ class ImageViewer(QGraphicsView):
 
             self._draw_box.setRect(self._start_point.x(), self._start_point.y(), pos.x() - self._start_point.x(), pos.y() - self._start_point.y())
             # print(self._draw_box.rect())
+            _img_w, _img_h = self.image_rect().width(), self.image_rect().height()
             _rect = self._draw_box.rect()
             if _rect.x() < 0:
                 # print('x < 0')
                 self._draw_box.setRect(0, _rect.y(), _rect.width() + _rect.x(), _rect.height())
                 _rect = self._draw_box.rect()
-            elif _rect.x() > self._photo.pixmap().width():
+            elif _rect.x() > _img_w:
                 # print('x > w')
                 return
             if _rect.y() < 0:
                 # print('y < 0')
                 self._draw_box.setRect(_rect.x(), 0, _rect.width(), _rect.height() + _rect.y())
                 _rect = self._draw_box.rect()
-            elif _rect.y() > self._photo.pixmap().height():
+            elif _rect.y() > _img_h:
                 self._draw_box.setRect(_rect.x(), _rect.y(), _rect.width(), _rect.height() + _rect.y())
                 _rect = self._draw_box.rect()
-            if _rect.x() + _rect.width() > self._photo.pixmap().width():
+            if _rect.x() + _rect.width() > _img_w:
                 # print('x + w > w')
-                self._draw_box.setRect(_rect.x(), _rect.y(), self._photo.pixmap().width() - _rect.x(), _rect.height())
+                self._draw_box.setRect(_rect.x(), _rect.y(), _img_w - _rect.x(), _rect.height())
                 _rect = self._draw_box.rect()
-            if _rect.y() + _rect.height() > self._photo.pixmap().height():
+            if _rect.y() + _rect.height() > _img_h:
                 # print('y + h > h')
-                self._draw_box.setRect(_rect.x(), _rect.y(), _rect.width(), self._photo.pixmap().height() - _rect.y())
+                self._draw_box.setRect(_rect.x(), _rect.y(), _rect.width(), _img_h - _rect.y())
                 _rect = self._draw_box.rect()
 
             self._start_point = None
             _rect = self._draw_box.rect()
 
-            cropped = self.cv2_img[int(_rect.y()):int(_rect.y() + _rect.height()), int(_rect.x()):int(_rect.x() + _rect.width())]
-            self.imageCropped.emit(cropped)
+            _img_rect = self.scene_to_image(_rect)
+            if self._multi:
+                self.boxDrawn.emit(_img_rect)
+                return
+            cropped = self.crop_rgb(_img_rect.x(), _img_rect.y(), _img_rect.width(), _img_rect.height())
+            # no pixels yet, or a box without width / height: nothing to OCR
+            if cropped is None or not cropped.size:
+                return
+            self.imageCropped.emit(cropped, _img_rect)
 
 
 
@@ -283,8 +522,8 @@ if __name__ == '__main__':
         #         self.draw_toggle.setText('Stop')
         #         self.viewer.enter_draw_box()
 
-        def slot_show_cropped(self, cropped):
-            cv2.imshow('cropped here', cropped)
+        def slot_show_cropped(self, cropped, rect):
+            cv2.imshow('cropped here', cv2.cvtColor(cropped, cv2.COLOR_RGB2BGR))
             cv2.waitKey(1)
 
         def keyPressEvent(self, e):
@@ -294,7 +533,7 @@ if __name__ == '__main__':
                 self.viewer.clear_draw_box()
 
     import sys
-    from paddleocr import PaddleOCR
+    import cv2
 
     app = QApplication(sys.argv)
     window = Window()
@@ -0,0 +1,202 @@
+# named timing spans around the stages of a session (decode, set_photo, the
+# numpy view of the pixels, OCR, json load / save ...). off unless enable()d:
+# span() is then one global check returning a shared no-op, so the calls can
+# stay in the hot paths for good.
+#
+# when on, every span is kept as a Chrome trace event (chrome://tracing or
+# https://ui.perfetto.dev) and its duration goes into a per-stage window for
+# live p50 / p95. a session is written out with export(); traces of many
+# sessions are folded into one table with
+#
+#   python3 instrument.py summary ~/.cache/label_it/traces/*.json
+
+import os
+import sys
+import json
+import time
+import socket
+import getpass
+import argparse
+import threading
+from collections import deque
+
+from cachedir import CACHE_DIR
+
+
+TRACE_DIR = os.path.join(CACHE_DIR, 'traces')
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullSpan()
+
+
+class _Span:
+
+    __slots__ = ('rec', 'name', 'args', 't0')
+
+    def __init__(self, rec, name, args):
+        self.rec = rec
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.rec.add(self.name, self.t0, time.perf_counter() - self.t0, self.args)
+        return False
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Recorder:
+
+    def __init__(self, window=200, max_events=200000):
+        self.t_start = time.perf_counter()
+        self.wall_start = time.time()
+        self.window = window
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=max_events)    # (name, tid, start s, duration s, args)
+        self._recent = {}                           # name -> deque of the last ms
+        self._count = {}                            # name -> spans so far
+
+    def add(self, name, t0, dur, args=None):
+        tid = threading.get_ident()
+        with self._lock:
+            self._events.append((name, tid, t0, dur, args))
+            recent = self._recent.get(name)
+            if recent is None:
+                recent = self._recent[name] = deque(maxlen=self.window)
+            recent.append(dur * 1000)
+            self._count[name] = self._count.get(name, 0) + 1
+
+    def stats(self):
+        # name -> (spans, p50 ms, p95 ms) of the recent window
+        with self._lock:
+            recent = {name: list(ms) for name, ms in self._recent.items()}
+            count = dict(self._count)
+        return {name: (count[name], percentile(ms, 50), percentile(ms, 95)) for name, ms in recent.items()}
+
+    def trace(self):
+        with self._lock:
+            events = list(self._events)
+        threads = {}
+        out = []
+        for name, tid, t0, dur, args in events:
+            ev = {'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'pid': os.getpid(),
+                  'tid': threads.setdefault(tid, len(threads)),
+                  'ts': round((t0 - self.t_start) * 1e6, 1), 'dur': round(dur * 1e6, 1)}
+            if args:
+                ev['args'] = args
+            out.append(ev)
+        # thread names for the trace viewer
+        for tid, n in threads.items():
+            out.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': n,
+                        'args': {'name': 'gui' if tid == threading.main_thread().ident else 'worker {}'.format(n)}})
+        return {
+            'traceEvents': out,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'host': socket.gethostname(),
+                'user': getpass.getuser(),
+                'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.wall_start)),
+                'seconds': round(time.perf_counter() - self.t_start, 1),
+                'stats': {name: {'n': n, 'p50_ms': p50, 'p95_ms': p95} for name, (n, p50, p95) in self.stats().items()},
+            },
+        }
+
+
+_recorder = None
+
+
+def enable(window=200, max_events=200000):
+    global _recorder
+    if _recorder is None:
+        _recorder = Recorder(window, max_events)
+    return _recorder
+
+
+def enabled():
+    return _recorder is not None
+
+
+def span(name, **args):
+    #   with instrument.span('ocr.crop', w=..., h=...):
+    if _recorder is None:
+        return _NULL
+    return _Span(_recorder, name, args)
+
+
+def record(name, ms, **args):
+    # a duration measured elsewhere, ending now
+    if _recorder is not None:
+        dur = ms / 1000
+        _recorder.add(name, time.perf_counter() - dur, dur, args)
+
+
+def stats():
+    return _recorder.stats() if _recorder is not None else {}
+
+
+def export(path=None):
+    # -> path of the written trace, None when not enabled
+    if _recorder is None:
+        return None
+    if path is None:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, 'session-{}-{}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(_recorder.wall_start)), os.getpid()))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(_recorder.trace(), f)
+    os.replace(tmp, path)
+    return path
+
+
+def summary(paths):
+    # every span of every trace, per stage over all sessions
+    durations = {}
+    for path in paths:
+        try:
+            with open(path) as f:
+                events = json.load(f)['traceEvents']
+        except (OSError, ValueError, KeyError) as e:
+            print('skipped', path, e)
+            continue
+        for ev in events:
+            if ev.get('ph') == 'X':
+                durations.setdefault(ev['name'], []).append(ev['dur'] / 1000)
+    print('{} sessions'.format(len(paths)))
+    print('{:24s} {:>8s} {:>9s} {:>9s} {:>9s}'.format('stage', 'spans', 'p50 ms', 'p95 ms', 'max ms'))
+    for name in sorted(durations):
+        ms = durations[name]
+        print('{:24s} {:8d} {:9.2f} {:9.2f} {:9.2f}'.format(
+            name, len(ms), percentile(ms, 50), percentile(ms, 95), max(ms)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    p = sub.add_parser('summary', help='p50 / p95 per stage over session traces')
+    p.add_argument('traces', nargs='+')
+    args = parser.parse_args()
+
+    missing = [t for t in args.traces if not os.path.isfile(t)]
+    if missing:
+        print('not a file', ', '.join(missing))
+        sys.exit(1)
+    summary(args.traces)
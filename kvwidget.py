@@ -1,7 +1,173 @@
 from cProfile import label
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QListWidget, QPlainTextEdit
-from PyQt5.QtCore import pyqtSignal, Qt
+import json
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QTableView, QHeaderView, QAbstractItemView, QPlainTextEdit
+from PyQt5.QtCore import pyqtSignal, Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QBrush, QColor
+
+from progress import LOW_CONF, HIGH_CONF, LOW, MID, conf_level
+
+
+class KeyValueModel(QAbstractTableModel):
+    # the pairs of one image: an ordered dict plus the key of every row, so
+    # row <-> key both ways are O(1). a new image is one modelReset, an edit
+    # one dataChanged for its cell and one pairChanged with just that pair.
+    # the store writes whole annotations, so adding / removing a pair is
+    # saved by the widget like any other change of the image
+    pairChanged = pyqtSignal(int, str, str)     # row, key, value
+
+    KEY, VALUE = 0, 1
+
+    INVALID = QBrush(QColor(255, 200, 200))
+    # values by OCR confidence level, high ones are left alone
+    CONFIDENCE = {LOW: QBrush(QColor(255, 215, 170)), MID: QBrush(QColor(255, 245, 185))}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._pairs = {}
+        self._keys = []
+        self._rows = {}     # key -> row
+        self.schema = None
+        self.confidence = {}    # key -> OCR confidence of its value
+        self.thresholds = (LOW_CONF, HIGH_CONF)
+
+    # -- Qt model interface
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return ('Key', 'Value')[section]
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == self.VALUE:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        key = self._keys[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return key if index.column() == self.KEY else self.text(index.row())
+        if index.column() != self.VALUE:
+            return None
+        # checked on paint, only the rows on screen ever are. a schema error
+        # wins over the confidence
+        error = self.schema.validate(key, self.text(index.row())) if self.schema is not None else None
+        conf = self.confidence.get(key)
+        if role == Qt.BackgroundRole:
+            return self.INVALID if error else self.CONFIDENCE.get(conf_level(conf, *self.thresholds))
+        if role == Qt.ToolTipRole:
+            if error:
+                return error
+            return 'ocr confidence {:.2f}'.format(conf) if conf is not None else None
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid() or index.column() != self.VALUE:
+            return False
+        # committing an untouched editor is no edit, the value keeps its type
+        if str(value) != self.text(index.row()):
+            self.set_value(index.row(), str(value))
+        return True
+
+    # -- pairs
+
+    def pairs(self):
+        # the model's own dict, copy it before handing it out
+        return self._pairs
+
+    def keys(self):
+        return list(self._keys)
+
+    def key(self, row):
+        return self._keys[row] if 0 <= row < len(self._keys) else None
+
+    def value(self, row):
+        return self._pairs[self._keys[row]] if 0 <= row < len(self._keys) else None
+
+    def text(self, row):
+        # the value as shown and edited. the pairs keep what was loaded (numbers,
+        # bools, null), only an edit turns a value into a string
+        value = self.value(row)
+        if value is None or isinstance(value, str):
+            return value or ''
+        return json.dumps(value, ensure_ascii=False)
+
+    def row_of(self, key):
+        return self._rows.get(key, -1)
+
+    def set_pairs(self, pairs):
+        self.beginResetModel()
+        self._pairs = {str(k): v for k, v in pairs.items()}
+        self._keys = list(self._pairs)
+        self._rows = {k: i for i, k in enumerate(self._keys)}
+        self.endResetModel()
+
+    def set_value(self, row, value):
+        key = self._keys[row]
+        if self._pairs[key] == value:
+            return
+        self._pairs[key] = value
+        index = self.index(row, self.VALUE)
+        self.dataChanged.emit(index, index)
+        self.pairChanged.emit(row, key, value)
+
+    def add_pair(self, key, value):
+        # -> row of the pair, an existing key just gets the new value
+        row = self._rows.get(key)
+        if row is not None:
+            self.set_value(row, value)
+            return row
+        row = len(self._keys)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._keys.append(key)
+        self._pairs[key] = value
+        self._rows[key] = row
+        self.endInsertRows()
+        return row
+
+    def remove_row(self, row):
+        if not 0 <= row < len(self._keys):
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        key = self._keys.pop(row)
+        del self._pairs[key]
+        del self._rows[key]
+        for k in self._keys[row:]:
+            self._rows[k] -= 1
+        self.endRemoveRows()
+
+    def clear_values(self):
+        # keep the keys, blank the values. not an edit, so no pairChanged
+        if not self._keys:
+            return
+        for k in self._keys:
+            self._pairs[k] = ' '
+        self.dataChanged.emit(self.index(0, self.VALUE), self.index(len(self._keys) - 1, self.VALUE))
+
+    def set_schema(self, schema):
+        self.schema = schema
+        self._repaint_values()
+
+    def set_confidence(self, confidence, thresholds=None):
+        # {key: confidence} of the values that came from OCR
+        self.confidence = dict(confidence)
+        if thresholds is not None:
+            self.thresholds = thresholds
+        self._repaint_values()
+
+    def _repaint_values(self):
+        if self._keys:
+            self.dataChanged.emit(self.index(0, self.VALUE), self.index(len(self._keys) - 1, self.VALUE))
+
 
 class KeyValueWidget(QWidget):
     item_modified = pyqtSignal(dict)
@@ -16,9 +182,17 @@ class KeyValueWidget(QWidget):
         self.value_input.setFixedHeight(50)
         self.add_button = QPushButton("Add")
         self.delete_button = QPushButton("Delete")
-        self.key_list = QListWidget()
-        self.value_list = QListWidget()
-        self.value_list.setEditTriggers(QListWidget.EditTrigger.SelectedClicked | QListWidget.EditTrigger.DoubleClicked | QListWidget.EditTrigger.AnyKeyPressed)
+
+        self.model = KeyValueModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.SelectedClicked | QAbstractItemView.DoubleClicked | QAbstractItemView.AnyKeyPressed)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        # fixed row heights, the view never measures hundreds of rows
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().hide()
 
         self.init_ui()
 
@@ -33,63 +207,43 @@ class KeyValueWidget(QWidget):
         key_value_layout.addWidget(self.value_label)
         key_value_layout.addWidget(self.value_input)
 
-        result_layout = QHBoxLayout()
-        result_layout.addWidget(self.key_list)
-        result_layout.addWidget(self.value_list)
-
         layout.addLayout(key_value_layout)
         layout.addWidget(self.add_button)
         layout.addWidget(self.delete_button)
-        layout.addLayout(result_layout)
+        layout.addWidget(self.table)
 
         self.setLayout(layout)
 
         self.add_button.clicked.connect(self.slot_add_pair)
         self.delete_button.clicked.connect(self.slot_delete_pair)
 
-        self.key_list.itemClicked.connect(self.slot_key_list_item_clicked)
-        self.value_list.itemClicked.connect(self.slot_value_list_item_clicked)
-
-        self.value_list.itemChanged.connect(self.slot_value_list_item_changed)
-
-    def value_list_commitData(self, editor):
-        print('commitData')
+        self.table.clicked.connect(self.slot_table_clicked)
+        self.model.pairChanged.connect(self.slot_pair_changed)
 
-    def slot_key_list_item_clicked(self, item):
-        print('key click')
-        index = self.key_list.row(item)
-        self.curr_selected_index = index
-        self.value_list.setCurrentRow(index)
-        # print(item.text(), index)
-
-        self.key_input.setText(item.text())
-        self.value_input.setPlainText(self.value_list.item(index).text())
-
-        self.value_input.clear()
-
-    def slot_value_list_item_clicked(self, item):
-        print('value click')
-        index = self.value_list.row(item)
-        self.curr_selected_index = index
-
-        # self.value_list.editItem(item)
-        self.key_input.clear()
+    def slot_table_clicked(self, index):
+        self.curr_selected_index = index.row()
+        if index.column() == KeyValueModel.KEY:
+            print('key click')
+            self.key_input.setText(self.model.key(index.row()))
+        else:
+            print('value click')
+            self.key_input.clear()
         self.value_input.clear()
 
-        self.key_list.setCurrentRow(index)
-
-    def slot_value_list_item_changed(self, item):        
-        # print('changed', item.text())
+    def slot_pair_changed(self, row, key, value):
+        # print('changed', key, value)
 
         self.item_modified.emit(self.gen_all_pairs())
-        
-        next_index = self.curr_selected_index + 1
-        if next_index >= self.key_list.count():
+
+        next_index = row + 1
+        if next_index >= self.model.rowCount():
             next_index = 0
-        
-        self.value_list.setCurrentRow(next_index)
-        self.key_list.setCurrentRow(next_index)
-        self.curr_selected_index = next_index
+        self.select_row(next_index)
+
+    def select_row(self, row):
+        self.curr_selected_index = row
+        if 0 <= row < self.model.rowCount():
+            self.table.setCurrentIndex(self.model.index(row, KeyValueModel.VALUE))
 
     def slot_add_pair(self):
         key = self.key_input.text()
@@ -98,57 +252,65 @@ class KeyValueWidget(QWidget):
         if not key or not value:
             return
 
-        k = self.key_list.findItems(key, Qt.MatchExactly)
-        if k:
-            index = self.key_list.row(k[0])
-            self.value_list.item(index).setText(value)
+        if self.model.row_of(key) >= 0:
+            # pairChanged saves it
+            self.model.add_pair(key, value)
             print('modified')
         else:
-            self.key_list.addItem(key)
-            self.value_list.addItem(value)
-            self.value_list.item(self.value_list.count() - 1).setFlags(Qt.ItemIsEditable | Qt.ItemIsEnabled | Qt.ItemIsSelectable)
+            self.model.add_pair(key, value)
+            self.item_modified.emit(self.gen_all_pairs())
         self.key_input.clear()
         self.value_input.clear()
 
-        self.item_modified.emit(self.gen_all_pairs())
-
     def slot_delete_pair(self):
         if self.curr_selected_index < 0:
             return
 
-        self.key_list.takeItem(self.curr_selected_index)
-        self.value_list.takeItem(self.curr_selected_index)
+        self.model.remove_row(self.curr_selected_index)
         self.curr_selected_index = -1
 
-        self.key_list.clearSelection()
-        self.value_list.clearSelection()
+        self.table.clearSelection()
         self.key_input.clear()
         self.value_input.clear()
 
         self.item_modified.emit(self.gen_all_pairs())
 
+    def set_schema(self, schema):
+        self.model.set_schema(schema)
+
+    def set_confidence(self, confidence, thresholds=None):
+        self.model.set_confidence(confidence, thresholds)
+
     def set_pairs(self, pairs:dict):
-        self.key_list.clear()
-        self.value_list.clear()
-        for k, v in pairs.items():
-            # print(k, v)
-            self.key_list.addItem(k)
-            self.value_list.addItem(v)
-            self.value_list.item(self.value_list.count() - 1).setFlags(Qt.ItemIsEditable | Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            
-        self.slot_key_list_item_clicked(self.key_list.item(0))
-        self.slot_value_list_item_clicked(self.value_list.item(0))
+        self.model.set_pairs(pairs)
+        if self.model.rowCount():
+            self.select_row(0)
 
-    def gen_all_pairs(self) -> dict:
-        rev = dict()
-        for i in range(self.key_list.count()):
-            rev[self.key_list.item(i).text()] = self.value_list.item(i).text()
+    def clear_values(self):
+        # keep the keys, blank the values, without it counting as an edit
+        self.model.clear_values()
+        self.select_row(0)
 
-        return rev
+    def count(self):
+        return self.model.rowCount()
+
+    def current_row(self):
+        index = self.table.currentIndex()
+        return index.row() if index.isValid() else self.curr_selected_index
+
+    def set_value(self, row, value):
+        # like typing it in: saved, and the next row gets the focus
+        if not 0 <= row < self.model.rowCount():
+            row = self.current_row()
+        if 0 <= row < self.model.rowCount():
+            self.model.set_value(row, value)
+
+    def gen_all_pairs(self) -> dict:
+        return dict(self.model.pairs())
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     widget = KeyValueWidget()
     widget.show()
-    sys.exit(app.exec_())
\ No newline at end of file
+    sys.exit(app.exec_())
@@ -1,20 +1,39 @@
 #!/usr/bin/python3
 
+import time
+_T_START = time.perf_counter()
+
 import os
 import sys
-import glob
-import json
+import bisect
+import argparse
+from collections import OrderedDict
 
 from PyQt5 import QtGui, uic
-from PyQt5.QtWidgets import QWidget, QApplication, QWidget, QFileDialog, QVBoxLayout
-from PyQt5.QtGui import QColor, QPixmap
+from PyQt5.QtWidgets import QWidget, QApplication, QWidget, QFileDialog, QVBoxLayout, QHBoxLayout, QLabel, QCheckBox, \
+    QProgressBar, QComboBox, QPushButton, QMessageBox
+from PyQt5.QtGui import QColor
 from PyQt5.QtCore import QTimer, Qt
 
 from imageviewer import ImageViewer
 from kvwidget import KeyValueWidget
-
-from paddleocr import PaddleOCR
-import cv2
+from ocrworker import OcrService
+from prefetch import ImagePrefetcher
+from persistence import JsonSaver
+from annostore import open_store, split_meta, join_meta
+from dataset import DatasetScanner, DatasetWatcher
+from imagelist import natural_key, insort_natural
+from ocrcache import OcrCache
+from ocrengine import ENGINES, engine_class, create_engine
+from preprocess import CropPipeline
+from progress import ProgressIndex, UNLABELED, PARTIAL, REVIEW, LOW_CONF, HIGH_CONF, LOW, HIGH, conf_level
+from schema import Schema, load_schema, ApplySchemaTask
+from thumbgrid import ThumbnailNavigator
+from dupes import DuplicateTask, CopyAnnotationsTask
+from search import SearchIndex, SearchBuildTask, ReplaceTask, replace_hits
+from searchpanel import SearchPanel
+import ocrindex
+import instrument
 
 
 #-----------------------------
@@ -31,16 +50,79 @@ class LabelIt( QWidget ):
 
     DEFAULT_DIR = '/home/marco/downloads/datasets/hostpital_cases/img_symlinks_1k/'
 
-    def __init__( self ):
+    PAGE_INDEX_CACHE = 32
+
+    def __init__( self, startup_timing=False, page_ocr=False, prefetch=3, cache_mb=512, store=None,
+                  recursive=False, ocr_cache_mb=256, ocr_engine='paddle', ocr_threads=None,
+                  preprocess=True, deskew=False, binarize=False, rec_height=None,
+                  conf_low=LOW_CONF, conf_high=HIGH_CONF, trace_file=None ):
         super().__init__()
 
-        self.ocr = PaddleOCR(use_angle_cls=True, show_log=False)
-        # self.ocr.use_gpu = False
+        self.startup_timing = startup_timing
+        self.trace_file = trace_file
+        self._first_paint = False
+
+        # crops are resized / cleaned up for the recognizer on the OCR worker, pages are not
+        self.pipeline = CropPipeline(rec_height=rec_height or engine_class(ocr_engine).rec_height,
+                                     deskew=deskew, binarize=binarize) if preprocess else None
+
+        # the engine is only created on the OCR worker thread, paddle alone takes seconds to import
+        self.ocr_service = OcrService(lambda: create_engine(ocr_engine, threads=ocr_threads), pipeline=self.pipeline)
+        self.ocr_service.resultReady.connect(self.slot_ocr_result)
+        self.ocr_service.statsChanged.connect(self.slot_ocr_stats)
+        self.ocr_service.stateChanged.connect(self.slot_ocr_state)
+
+        # crops seen before (same image content, about the same box) skip the model
+        ocr_config = engine_class(ocr_engine).config_key()
+        if self.pipeline is not None:
+            ocr_config += ' ' + self.pipeline.config_key()
+        self.ocr_cache = OcrCache(ocr_config, max_mb=ocr_cache_mb) if ocr_cache_mb > 0 else None
+
+        self.prefetcher = ImagePrefetcher(ahead=prefetch, behind=max(1, prefetch // 2), budget_mb=cache_mb,
+                                          max_pixels=ImageViewer.TILE_PIXELS)
+
+        # edits are coalesced and written off the GUI thread
+        self.saver = JsonSaver(delay=500)
+        self.store_backend = store
+        self.store = None
+
+        # the image list is built off the GUI thread and kept up to date by the watcher
+        self.recursive = recursive
+        self.scanner = None
+        self.watcher = DatasetWatcher(self)
+        self.watcher.added.connect(self.slot_images_added)
+        self.watcher.removed.connect(self.slot_images_removed)
+
+        # labeling state of every image, kept in memory and updated on save
+        self.progress = ProgressIndex(self)
+        self.progress.changed.connect(self.slot_progress_changed)
+
+        # thumbnail grid, made on first use (it spawns a process pool)
+        self.grid = None
+
+        # full text index of every value, updated on save, and its window
+        self.search_index = None
+        self.search_task = None
+        self.replace_task = None
+        self.search_panel = None
+
+        # keys every image starts with, from schema.json or else from the annotations
+        self.schema = Schema(inferred=True)
+        self.apply_task = None
+        self.dupe_task = None
+        self.copy_task = None
 
         # init vars
         self.image_path = ''
         self.images_list = []
+        self.images_keys = []               # natural sort keys, parallel to images_list
         self.image_index = 0
+        self.page_indexes = OrderedDict()   # img_file -> ocrindex.PageIndex
+        self.meta = {}                      # annostore meta of the current image
+        # the values of meta['confidence'] as OCR left them, editing one drops its confidence
+        self.ocr_values = {}
+        self.conf_thresholds = (conf_low, conf_high)
+        self.review_at = None               # (confidence, name, key) the review queue is at
         ###########
 
         # init ui #
@@ -51,6 +133,7 @@ class LabelIt( QWidget ):
         viewer_layout.addWidget(self.image_viewer)
         self.ui.pictureFrame.setLayout(viewer_layout)
         self.image_viewer.imageCropped.connect(self.slot_image_cropped)
+        self.image_viewer.boxDrawn.connect(self.slot_box_drawn)
 
         self.ui.loadBtn.clicked.connect(self.choose_dir)
         self.ui.prevBtn.clicked.connect(lambda: self.show_image(self.image_index - 1))
@@ -59,15 +142,78 @@ class LabelIt( QWidget ):
         self.ui.nextBtn.clicked.connect(lambda: self.image_viewer.clear_draw_box())
 
         self.kvwidget = KeyValueWidget()
+        self.kvwidget.set_confidence({}, self.conf_thresholds)
         kv_layout = QVBoxLayout(self.ui.kvFrame)
         kv_layout.addWidget(self.kvwidget)
         # kv_layout.setContentsMargins(0, 0, 0, 0)
         self.ui.kvFrame.setLayout(kv_layout)
 
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFormat('%v/%m labeled')
+        self.progress_bar.setValue(0)
+        self.todo_combo = QComboBox()
+        self.todo_combo.setToolTip('what "Next todo" (N) jumps to')
+        self.todo_btn = QPushButton('Next todo')
+        self.todo_btn.clicked.connect(self.jump_next_todo)
+        self.apply_btn = QPushButton('Apply schema')
+        self.apply_btn.setToolTip('write the blank schema keys into every unlabeled image')
+        self.apply_btn.clicked.connect(self.apply_schema)
+        progress_layout = QHBoxLayout()
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.todo_combo)
+        progress_layout.addWidget(self.todo_btn)
+        progress_layout.addWidget(self.apply_btn)
+        kv_layout.addLayout(progress_layout)
+
         self.kvwidget.item_modified.connect(self.slot_kv_item_modified)
 
+        self.status_label = QLabel('ocr idle')
+        self.ui.horizontalLayout_2.insertWidget(0, self.status_label)
+
+        # live p50/p95 of the instrumented stages, only with --trace
+        self.timing_label = QLabel()
+        self.timing_label.setToolTip('p50/p95 ms of the last spans per stage')
+        self.ui.horizontalLayout_2.insertWidget(1, self.timing_label)
+        self.timing_label.setVisible(instrument.enabled())
+        if instrument.enabled():
+            self.timing_timer = QTimer(self)
+            self.timing_timer.timeout.connect(self.slot_timing)
+            self.timing_timer.start(1000)
+
+        self.page_ocr_chk = QCheckBox('pageOCR')
+        self.page_ocr_chk.setToolTip('OCR the whole page once, boxes then resolve from its lines')
+        self.page_ocr_chk.setChecked(page_ocr)
+        self.page_ocr_chk.toggled.connect(lambda on: on and self.images_list and self.request_page_index())
+        self.ui.horizontalLayout.insertWidget(1, self.page_ocr_chk)
+
+        # draw a box per key first, then grab (G) them all in one OCR pass
+        self.multi_box_chk = QCheckBox('multiBox')
+        self.multi_box_chk.setToolTip('every box is bound to the selected key, grab recognises them together')
+        self.multi_box_chk.toggled.connect(self.slot_multi_box)
+        self.ui.horizontalLayout.insertWidget(2, self.multi_box_chk)
+
+        self.grid_btn = QPushButton('grid')
+        self.grid_btn.setToolTip('all images as thumbnails, click one to open it (T)')
+        self.grid_btn.clicked.connect(self.show_grid)
+        self.ui.horizontalLayout.addWidget(self.grid_btn)
+
+        self.dupes_btn = QPushButton('dupes')
+        self.dupes_btn.setToolTip('find near duplicate images and copy annotations to their unlabeled copies')
+        self.dupes_btn.clicked.connect(self.find_duplicates)
+        self.ui.horizontalLayout.addWidget(self.dupes_btn)
+
+        self.search_btn = QPushButton('search')
+        self.search_btn.setToolTip('find values in every image, jump to them or replace them all (F)')
+        self.search_btn.clicked.connect(self.show_search)
+        self.ui.horizontalLayout.addWidget(self.search_btn)
+        self.ui.grabBtn.setToolTip('OCR all boxes in one batch (G)')
+        self.ui.grabBtn.clicked.connect(self.ocr_boxes)
+
         ###########
 
+        # load the OCR engine once the window is up
+        QTimer.singleShot(0, self.ocr_service.warmup)
+
         _timer = QTimer()
         _timer.setInterval(10)
         # _timer.singleShot(100, lambda: self.choose_dir(self.DEFAULT_DIR))
@@ -79,122 +225,809 @@ class LabelIt( QWidget ):
         else:
             self.image_path = path
 
-        self.json_dir = self.image_path + '/jsons'
-        if not os.path.exists(self.json_dir):
-            print('create json dir', self.json_dir)
-            os.mkdir(self.json_dir)
-
         if self.image_path:
-            self.images_list = glob.glob(self.image_path + '/*')
-            self.images_list.sort()
+            self.store = open_store(self.image_path, self.store_backend)
+            print('annotations in', type(self.store).__name__)
+            self.saver.set_store(self.store)
+            self.prefetcher.clear()
+            self.progress.load(self.store)
+            self.open_search_index()
+            self.schema = load_schema(self.image_path) or Schema(inferred=True)
+            self.kvwidget.set_schema(self.schema)
+            print('schema', 'inferred' if self.schema.inferred else 'loaded', self.schema.keys())
+            self.images_list = []
+            self.images_keys = []
             self.image_index = 0
+
+            if self.scanner is not None:
+                self.scanner.stop()
+            self.scanner = DatasetScanner(self.image_path, self.recursive, self)
+            self.scanner.batchFound.connect(self.slot_scan_batch)
+            self.scanner.done.connect(self.slot_scan_done)
+            self.scanner.start()
+
+    def show_grid(self):
+        if self.grid is None:
+            self.grid = ThumbnailNavigator(parent=self)
+            self.grid.imageChosen.connect(self.slot_grid_chosen)
+        self.grid.show()
+        self.grid.raise_()
+        self.update_grid()
+
+    def update_grid(self):
+        # a hidden grid catches up when it is shown again. the list may grow
+        # in place while scanning, the model gets its own copy
+        if self.grid is None or not self.grid.isVisible():
+            return
+        self.grid.set_images(list(self.images_list), self.progress.state, self.image_name)
+        if self.images_list:
+            self.grid.set_current(self.image_index)
+
+    def slot_grid_chosen(self, index):
+        if index != self.image_index:
+            self.image_viewer.clear_draw_box()
+            self.show_image(index)
+
+    def open_search_index(self):
+        for task in (self.search_task, self.replace_task):
+            if task is not None:
+                task.stop()
+        if self.search_index is not None:
+            self.search_index.close()
+        self.search_index = SearchIndex(self.image_path)
+        # updated by the saver's writer thread, after each store write
+        self.saver.set_index(self.search_index)
+        if self.search_panel is not None:
+            self.search_panel.set_index(self.search_index)
+        self.sync_search_index()
+
+    def sync_search_index(self):
+        # catches up with edits made outside the tool, or by the bulk tasks
+        if self.search_task is not None and self.search_task.isRunning():
+            self.search_task.stop()
+        self.search_task = SearchBuildTask(self.search_index, self.store, self)
+        self.search_task.done.connect(self.slot_search_synced)
+        self.search_task.start()
+
+    def slot_search_synced(self, updated, removed):
+        if self.search_panel is not None and self.search_panel.isVisible():
+            self.search_panel.set_keys(self.search_keys())
+            self.search_panel.refresh()
+
+    def search_keys(self):
+        keys = self.schema.keys()
+        return keys + [k for k in self.search_index.keys() if k not in keys]
+
+    def show_search(self):
+        if self.search_index is None:
+            return
+        if self.search_panel is None:
+            self.search_panel = SearchPanel(self.search_index, self)
+            self.search_panel.imageChosen.connect(self.slot_search_chosen)
+            self.search_panel.replaceRequested.connect(self.slot_replace_requested)
+        self.search_panel.set_keys(self.search_keys())
+        self.search_panel.show()
+        self.search_panel.raise_()
+        self.search_panel.activateWindow()
+        self.search_panel.text_edit.setFocus()
+        self.search_panel.refresh()
+
+    def slot_search_chosen(self, name, key):
+        try:
+            index = self.find_image(os.path.join(self.image_path, name))
+        except ValueError:
+            print('not in the image list', name)
+            return
+        if index != self.image_index:
+            self.image_viewer.clear_draw_box()
+            self.show_image(index)
+        self.kvwidget.select_row(self.kvwidget.model.row_of(key))
+
+    def slot_replace_requested(self, find, repl, key, whole):
+        if self.replace_task is not None and self.replace_task.isRunning():
+            return
+        # what the replace itself will change, same matching and case rule
+        hits = replace_hits(self.search_index, find, repl, key or None, whole)
+        if not hits:
+            QMessageBox.information(self, 'replace', 'No value to change matches "{}".'.format(find))
+            return
+        text = 'Replace "{}" with "{}" in {} values of {} images?'.format(
+            find, repl, len(hits), len({name for name, _, _ in hits}))
+        if QMessageBox.question(self, 'replace', text) != QMessageBox.Yes:
+            return
+        # pending edits first, the replace reads the store
+        self.saver.flush(wait=True)
+        self.replace_task = ReplaceTask(self.store, self.search_index, find, repl, key or None, whole, self)
+        self.replace_task.done.connect(self.slot_values_replaced)
+        self.search_panel.replace_btn.setEnabled(False)
+        self.replace_task.start()
+
+    def slot_values_replaced(self, written):
+        self.search_panel.replace_btn.setEnabled(True)
+        print('values replaced in {} images'.format(len(written)))
+        if written:
+            # preloaded jsons and the progress index are older than the replace
+            self.prefetcher.drop_json({os.path.join(self.image_path, name) for name in written})
+            self.progress.update_many(written)
+            self.load_json()
+        self.search_panel.refresh()
+
+    def image_name(self, img_file):
+        # store key, the plain file name unless the dataset has sub dirs
+        return os.path.relpath(img_file, self.image_path)
+
+    def slot_scan_batch(self, files):
+        # the first image shows while the rest of the dir is still being listed
+        first = not self.images_list
+        self.images_list.extend(files)
+        self.prefetcher.extend(files)
+        self.update_grid()
+        if first and files:
             self.show_image(0)
 
+    def slot_scan_done(self, files, dirs):
+        current = self.images_list[self.image_index] if self.images_list else None
+        self.images_list = files
+        self.images_keys = [natural_key(f) for f in files]
+        self.watcher.watch(files, dirs, self.recursive)
+        self.progress.set_images([self.image_name(f) for f in files])
+        self.update_grid()
+        print('{} images in {}'.format(len(files), self.image_path))
+        if current is None:
+            if files:
+                self.show_image(0)
+        else:
+            # the sorted list may have moved the image already on screen
+            self.image_index = self.find_image(current)
+
+    def slot_images_added(self, files):
+        current = self.images_list[self.image_index] if self.images_list else None
+        # new list objects, the prefetcher rebuilds its order when the list changes
+        self.images_list = list(self.images_list)
+        self.images_keys = list(self.images_keys)
+        for f in files:
+            insort_natural(self.images_list, self.images_keys, f)
+        self.progress.add_images([self.image_name(f) for f in files])
+        self.update_grid()
+        print('added', len(files), 'images')
+        if current is None:
+            self.show_image(0)
+        else:
+            self.image_index = self.find_image(current)
+
+    def slot_images_removed(self, files):
+        if not self.images_list:
+            return
+        current = self.images_list[self.image_index]
+        gone = set(files)
+        keep = [i for i, f in enumerate(self.images_list) if f not in gone]
+        self.images_list = [self.images_list[i] for i in keep]
+        self.images_keys = [self.images_keys[i] for i in keep]
+        self.progress.remove_images([self.image_name(f) for f in files])
+        self.update_grid()
+        print('removed', len(files), 'images')
+        for f in files:
+            self.prefetcher.invalidate(f)
+        if current not in gone:
+            self.image_index = self.find_image(current)
+        elif self.images_list:
+            self.show_image(min(self.image_index, len(self.images_list) - 1))
+        else:
+            self.image_index = 0
+            self.image_viewer.clear_draw_box()
+
     def show_image(self, index):
-        self.setWindowTitle(os.path.basename(self.images_list[index]))
+        if not 0 <= index < len(self.images_list):
+            return
+        with instrument.span('show_image'):
+            self._show_image(index)
+        if self.grid is not None and self.grid.isVisible():
+            self.grid.set_current(index)
+
+    def _show_image(self, index):
+        self.setWindowTitle(self.image_name(self.images_list[index]))
+        self.saver.flush()
+
+        # a page OCR still queued for the previous image is not wanted anymore,
+        # a running one finishes into page_indexes for when the user comes back
+        if self.image_index < len(self.images_list):
+            self.ocr_service.drop_queued(('page', self.images_list[self.image_index]))
 
-        img_file = os.path.join(self.image_path, self.images_list[index])
+        img_file = self.images_list[index]
         self.image_index = index
-        self.image_viewer.set_photo(QPixmap(img_file))
+        self.image_viewer.clear_boxes()
+        self.ui.grabBtn.setEnabled(False)
+        if self.ocr_cache is not None:
+            self.ocr_cache.prehash(img_file)
+        qimg, data = self.prefetcher.take(img_file, self.load_annotation)
+        if qimg is None:
+            self.image_viewer.set_tiled_photo(img_file)
+        else:
+            self.image_viewer.set_photo(qimg)
 
         self.kvwidget.key_input.setText('')
         self.kvwidget.value_input.setPlainText('')
 
-        self.load_json()
+        self.load_json(data)
+
+        self.prefetcher.update(index, self.images_list, self.load_annotation)
+        self.update_status_tip()
+
+        if self.page_ocr_chk.isChecked():
+            self.request_page_index()
+
+    def update_status_tip(self):
+        self.status_label.setToolTip('prefetch hits:{hits} misses:{misses} ({hit_rate:.0%}), {cached} cached, {mb:.0f}MB\n'
+                                     'saves requested:{requests} written:{writes}'.format(
+            **self.prefetcher.stats(), **self.saver.stats())
+                                     + self.ocr_cache_tip() + self.ocr_stage_tip())
+
+    def ocr_stage_tip(self):
+        stats = self.ocr_service.stats()
+        if not stats['stage_ms']:
+            return ''
+        stages = ' '.join('{}:{:.1f}'.format(k, v) for k, v in stats['stage_ms'].items())
+        return '\nocr ms per crop {}\n{} of {} crops single line (recognizer only)'.format(
+            stages, stats['single_line'], stats['prepared'])
+
+    def ocr_cache_tip(self):
+        if self.ocr_cache is None:
+            return ''
+        return ('\nocr cache hits:{hits} misses:{misses} ({hit_rate:.0%}), saved {ms_saved:.0f}ms '
+                'and {mb_saved:.1f}MB of crops, {disk_mb:.1f}MB on disk').format(**self.ocr_cache.stats())
+
+    def cached_ocr(self, img_file, rect):
+        if self.ocr_cache is None:
+            return None
+        return self.ocr_cache.get(img_file, (rect.x(), rect.y(), rect.width(), rect.height()),
+                                  self.image_viewer.rotation())
+
+    def cache_ocr(self, img_file, rect, rotation, result, nbytes, ms):
+        if self.ocr_cache is not None and result is not None:
+            self.ocr_cache.put(img_file, rect, rotation, result, nbytes, ms)
+
+    def find_image(self, img_file):
+        # position in the naturally sorted list, bisect instead of a scan
+        i = bisect.bisect_left(self.images_keys, natural_key(img_file))
+        if i < len(self.images_list) and self.images_list[i] == img_file:
+            return i
+        return self.images_list.index(img_file)
+
+    def slot_progress_changed(self):
+        if self.grid is not None and self.grid.isVisible():
+            self.grid.refresh_states()
+        counts = self.progress.counts()
+        total = sum(counts.values())
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(counts['labeled'])
+
+        tip = ['{labeled} labeled, {partial} partial, {unlabeled} unlabeled'.format(**counts)]
+        conf = self.progress.mean_confidence()
+        if conf is not None:
+            tip.append('ocr confidence {:.2f}'.format(conf))
+        for k, rate in self.progress.fill_rates().items():
+            tip.append('{}: {:.0%}'.format(k, rate))
+        self.progress_bar.setToolTip('\n'.join(tip))
+
+        # jump targets, keeping the current choice when the keys change
+        current = self.todo_combo.currentData()
+        targets = [('unlabeled', (UNLABELED,)), ('unlabeled+partial', (UNLABELED, PARTIAL))]
+        targets += [('lowest confidence', (REVIEW,))]
+        targets += [('missing ' + k, k) for k in self.progress.keys()]
+        if [t[1] for t in targets] != [self.todo_combo.itemData(i) for i in range(self.todo_combo.count())]:
+            self.todo_combo.blockSignals(True)
+            self.todo_combo.clear()
+            for text, data in targets:
+                self.todo_combo.addItem(text, data)
+            i = self.todo_combo.findData(current)
+            self.todo_combo.setCurrentIndex(max(i, 0))
+            self.todo_combo.blockSignals(False)
 
-    def load_json(self):
-        # json_file = self.images_list[self.image_index] + '.json'
-        json_file = os.path.join(self.json_dir, os.path.basename(self.images_list[self.image_index]) + '.json')
-        if os.path.exists(json_file):
-            with open(json_file) as f:
-                data = json.load(f)
-                self.kvwidget.set_pairs(data)
-                print('load json', data)
+        # without a schema.json the keys come from the annotations, read along with the index
+        if self.schema.inferred and self.progress.key_order:
+            n = len(self.schema)
+            self.schema.extend(self.progress.key_order)
+            if len(self.schema) > n and self.images_list and not self.kvwidget.count():
+                self.load_json()
+
+    def apply_schema(self):
+        if self.apply_task is not None and self.apply_task.isRunning():
+            return
+        if not len(self.schema) or not self.progress.ready:
+            print('no schema or progress index not ready yet')
+            return
+        self.saver.flush(wait=True)
+        self.apply_task = ApplySchemaTask(self.store, self.progress.names(UNLABELED), self.schema.copy(), self)
+        self.apply_task.progress.connect(
+            lambda i, n: self.apply_btn.setText('Applying {:.0%}'.format(i / n)))
+        self.apply_task.done.connect(self.slot_schema_applied)
+        self.apply_btn.setEnabled(False)
+        self.apply_task.start()
+
+    def slot_schema_applied(self, written):
+        self.apply_btn.setText('Apply schema')
+        self.apply_btn.setEnabled(True)
+        # blank keys are now stored for those images, only they are updated
+        if written:
+            self.prefetcher.drop_json({os.path.join(self.image_path, name) for name in written})
+            self.progress.update_many(written)
+            self.sync_search_index()
+
+    def find_duplicates(self):
+        if self.dupe_task is not None and self.dupe_task.isRunning() or not self.images_list:
+            return
+        self.dupe_task = DuplicateTask(self.image_path, list(self.images_list), self.store, parent=self)
+        self.dupe_task.progress.connect(
+            lambda i, n: self.dupes_btn.setText('hashing {:.0%}'.format(i / n)))
+        self.dupe_task.done.connect(self.slot_duplicates_found)
+        self.dupes_btn.setEnabled(False)
+        self.dupe_task.start()
+
+    def slot_duplicates_found(self, clusters, plan):
+        self.dupes_btn.setText('dupes')
+        self.dupes_btn.setEnabled(True)
+        for group in clusters:
+            print('duplicates:', '  '.join(group))
+        text = '{} groups of near duplicates, {} images.'.format(len(clusters), sum(len(g) for g in clusters))
+        if not plan:
+            QMessageBox.information(self, 'duplicates', text + '\nNo unlabeled image has a labeled duplicate.')
+            return
+        text += '\n{} unlabeled images have a labeled duplicate, copy its annotation to them?'.format(len(plan))
+        if QMessageBox.question(self, 'duplicates', text) != QMessageBox.Yes:
+            return
+        self.saver.flush(wait=True)
+        self.copy_task = CopyAnnotationsTask(self.store, plan, self)
+        self.copy_task.done.connect(self.slot_annotations_copied)
+        self.dupes_btn.setEnabled(False)
+        self.copy_task.start()
+
+    def slot_annotations_copied(self, written):
+        self.dupes_btn.setEnabled(True)
+        print('annotations copied to {} images'.format(len(written)))
+        if written:
+            # preloaded jsons and the indexes are older than the copies
+            self.prefetcher.drop_json({os.path.join(self.image_path, name) for name in written})
+            self.progress.update_many(written)
+            self.sync_search_index()
+            self.load_json()
+
+    def jump_next_todo(self):
+        if not self.images_keys:
+            return
+        target = self.todo_combo.currentData() or (UNLABELED,)
+        current = self.image_name(self.images_list[self.image_index])
+        if target == (REVIEW,):
+            self.jump_next_review()
+            return
+        if isinstance(target, str):
+            name = self.progress.next(current, missing_key=target)
         else:
-            for i in range(self.kvwidget.value_list.count()):
-                self.kvwidget.value_list.item(i).setText(' ')
+            name = self.progress.next(current, target)
+        if name is None or name == current:
+            print('nothing left to do for', self.todo_combo.currentText())
+            return
+        self.image_viewer.clear_draw_box()
+        self.show_image(self.find_image(os.path.join(self.image_path, name)))
 
-            self.kvwidget.key_list.setCurrentRow(0)
-            self.kvwidget.value_list.setCurrentRow(0)
+    def jump_next_review(self):
+        # OCR values under the high threshold, the least confident first
+        entry = self.progress.next_review(self.review_at, below=self.conf_thresholds[1])
+        if entry is None:
+            print('no ocr values left to review')
+            return
+        self.review_at = entry
+        conf, name, key = entry
+        print('review {} {} ({:.2f})'.format(name, key, conf))
+        index = self.find_image(os.path.join(self.image_path, name))
+        if index != self.image_index:
+            self.image_viewer.clear_draw_box()
+            self.show_image(index)
+        self.kvwidget.select_row(self.kvwidget.model.row_of(key))
+
+    def page_index(self, img_file):
+        index = self.page_indexes.get(img_file)
+        if index is None:
+            index = ocrindex.load_sidecar(img_file)
+            if index is None:
+                return None
+            self._cache_page_index(img_file, index)
+        else:
+            self.page_indexes.move_to_end(img_file)
+        return index
+
+    def _cache_page_index(self, img_file, index):
+        self.page_indexes[img_file] = index
+        self.page_indexes.move_to_end(img_file)
+        while len(self.page_indexes) > self.PAGE_INDEX_CACHE:
+            self.page_indexes.popitem(last=False)
+
+    def request_page_index(self):
+        img_file = self.images_list[self.image_index]
+        if self.page_index(img_file) is not None or not self.image_viewer.has_photo():
+            return
+        if self.ocr_service.has_pending(('page', img_file)):
+            return
+        # OCR sees the page upright, the index is kept in unrotated pixels. the
+        # worker decodes the file itself, nothing of the page is copied here
+        size = self.image_viewer.image_size()
+        rotation = self.image_viewer.rotation()
+        ctx = {'kind': 'page', 'image': img_file, 'rotation': rotation, 'size': (size.width(), size.height())}
+        self.ocr_service.submit_page(img_file, rotation, tag=('page', img_file), ctx=ctx)
+
+    def load_annotation(self, img_file):
+        # runs on prefetch workers too, the store is safe for that
+        with instrument.span('json.load'):
+            return self.store.get(self.image_name(img_file))
+
+    def load_json(self, data=None):
+        # data is the json already preloaded by the prefetcher, if any
+        img_file = self.images_list[self.image_index]
+        unsaved = self.saver.latest(self.image_name(img_file))
+        if unsaved is not None:
+            data = unsaved
+        if data is None:
+            data = self.load_annotation(img_file)
+
+        pairs, self.meta = split_meta(data)
+        if self.meta.get('rotation'):
+            self.image_viewer.set_rotation(self.meta['rotation'])
+        confidence = self.meta.get('confidence') or {}
+        self.ocr_values = {k: pairs.get(k) for k in confidence}
+        self.kvwidget.set_confidence(confidence)
+
+        # every image shows the schema keys in schema order, labeled or not
+        pairs = self.schema.apply(pairs)
+
+        if pairs:
+            with instrument.span('set_pairs', n=len(pairs)):
+                self.kvwidget.set_pairs(pairs)
+        else:
+            self.kvwidget.clear_values()
 
 
     def slot_kv_item_modified(self, item):
+        # a value typed over is checked by a human, its OCR confidence no longer applies
+        confidence = self.meta.get('confidence') or {}
+        kept = {k: c for k, c in confidence.items() if item.get(k) == self.ocr_values.get(k)}
+        if len(kept) != len(confidence):
+            self.set_confidence(kept)
+
+        if self.schema.inferred:
+            self.schema.extend(item)
         if not self.ui.autoSaveChk.isChecked():
             return
 
-        print('auto saved')
-        # json_file = self.images_list[self.image_index] + '.json'
-        json_file = os.path.join(self.json_dir, os.path.basename(self.images_list[self.image_index]) + '.json')
-        json.dump(item, open(json_file, 'w'), indent=4, ensure_ascii=False)
+        self.save_annotation(item)
+
+    def save_annotation(self, pairs):
+        img_file = self.images_list[self.image_index]
+        data = join_meta(pairs, self.meta)
+        self.saver.schedule(self.image_name(img_file), data)
+        self.progress.update(self.image_name(img_file), data)
+        self.prefetcher.set_json(img_file, data)
+
+    def set_confidence(self, confidence):
+        self.meta = dict(self.meta, confidence=confidence)
+        if not confidence:
+            del self.meta['confidence']
+        self.ocr_values = {k: v for k, v in self.ocr_values.items() if k in confidence}
+        self.kvwidget.set_confidence(confidence)
+
+    def set_ocr_value(self, row, text, conf):
+        # a value from OCR, saved along with its confidence
+        if not 0 <= row < self.kvwidget.count():
+            row = self.kvwidget.current_row()
+        key = self.kvwidget.model.key(row)
+        if key is None:
+            return
+        self.ocr_values[key] = text
+        self.set_confidence(dict(self.meta.get('confidence') or {}, **{key: round(conf, 3)}))
+        if self.kvwidget.model.text(row) == text:
+            # no edit, so nothing else would save the new confidence
+            self.slot_kv_item_modified(self.kvwidget.gen_all_pairs())
+        else:
+            self.kvwidget.set_value(row, text)
+
+    def accept_value(self):
+        # the selected value is checked and right as it is (V)
+        key = self.kvwidget.model.key(self.kvwidget.current_row())
+        confidence = self.meta.get('confidence') or {}
+        if key not in confidence:
+            return
+        self.set_confidence({k: c for k, c in confidence.items() if k != key})
+        self.slot_kv_item_modified(self.kvwidget.gen_all_pairs())
+
+    def box_style(self, conf):
+        # -> (colour, pen width) of a box by the confidence of its text
+        level = conf_level(conf, *self.conf_thresholds)
+        if level == HIGH:
+            return Qt.GlobalColor.darkGreen, 10
+        if level == LOW:
+            return Qt.GlobalColor.magenta, 5
+        return Qt.GlobalColor.darkYellow, 5
+
+    def rotate_image(self, degrees=90):
+        # only recorded as orientation meta and applied as a view transform,
+        # the file itself is left alone (see rotate.py to bake it in)
+        self.image_viewer.clear_draw_box()
+        self.image_viewer.clear_boxes()
+        self.ui.grabBtn.setEnabled(False)
+        self.meta = dict(self.meta, rotation=(self.meta.get('rotation', 0) + degrees) % 360)
+        self.image_viewer.set_rotation(self.meta['rotation'])
+
+        # keep whatever pairs are stored, the blanks of an unlabeled image are not worth saving
+        img_file = self.images_list[self.image_index]
+        data = self.saver.latest(self.image_name(img_file)) or self.load_annotation(img_file)
+        self.save_annotation(split_meta(data)[0])
 
     def keyPressEvent(self, e):
         super().keyPressEvent(e)
 
         if e.key() == Qt.Key.Key_Escape:
             self.image_viewer.clear_draw_box()
-        elif e.key() == Qt.Key.Key_R:
-            # rotate img, save it to file then reload it
-            self.image_viewer.clear_draw_box()
-            
-            img_file = os.path.join(self.image_path, self.images_list[self.image_index])
-            img = cv2.imread(img_file)
-            img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
-            cv2.imwrite(img_file, img)
-            self.show_image(self.image_index)
-            pass
+        elif e.key() == Qt.Key.Key_R and self.images_list:
+            self.rotate_image(90)
+        elif e.key() == Qt.Key.Key_N:
+            self.jump_next_todo()
+        elif e.key() == Qt.Key.Key_G and self.multi_box_chk.isChecked():
+            self.ocr_boxes()
+        elif e.key() == Qt.Key.Key_V:
+            self.accept_value()
+        elif e.key() == Qt.Key.Key_T:
+            self.show_grid()
+        elif e.key() == Qt.Key.Key_F:
+            self.show_search()
+
+
+    def slot_image_cropped(self, img, rect):
+        img_file = self.images_list[self.image_index]
+        row = self.kvwidget.current_row()
+
+        # with a page index the box resolves without running the model at all
+        if self.page_ocr_chk.isChecked():
+            index = self.page_index(img_file)
+            if index is not None:
+                ids = index.query(rect.x(), rect.y(), rect.width(), rect.height())
+                if ids:
+                    self.apply_ocr_result(row, index.lines(ids))
+                    return
+
+        cached = self.cached_ocr(img_file, rect)
+        if cached is not None:
+            self.apply_ocr_result(row, cached)
+            return
+
+        # OCR runs in the worker pool, a newer crop on the same image supersedes the old one
+        ctx = {'kind': 'crop', 'image': img_file, 'row': row, 'nbytes': img.nbytes,
+               'rect': (rect.x(), rect.y(), rect.width(), rect.height()), 'rotation': self.image_viewer.rotation()}
+        self.ocr_service.submit(img, tag=img_file, ctx=ctx, prepare=True)
+        self.image_viewer.set_drawbox_color(Qt.GlobalColor.blue, 2, Qt.PenStyle.DashLine)
 
+    def slot_multi_box(self, on):
+        self.image_viewer.set_multi_box(on)
+        self.ui.grabBtn.setEnabled(False)
 
-    def slot_image_cropped(self, img):
+    def slot_box_drawn(self, rect):
+        row = self.kvwidget.current_row()
+        key = self.kvwidget.model.key(row)
+        if key is None:
+            print('select a key for the box first')
+            return
+        self.image_viewer.keep_box(key)
+        self.ui.grabBtn.setEnabled(True)
+        # the next box goes to the next key
+        self.kvwidget.select_row((row + 1) % self.kvwidget.count())
+
+    def ocr_boxes(self):
+        boxes = self.image_viewer.crop_boxes()
+        if not boxes:
+            return
+        img_file = self.images_list[self.image_index]
 
-        # convert RGBA to RGB
-        img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
+        index = self.page_index(img_file) if self.page_ocr_chk.isChecked() else None
+        keys, crops, rects = [], [], []
+        for key, crop, rect in boxes:
+            ids = index.query(rect.x(), rect.y(), rect.width(), rect.height()) if index is not None else None
+            cached = None if ids else self.cached_ocr(img_file, rect)
+            if ids:
+                self.apply_box_result(key, index.lines(ids))
+            elif cached is not None:
+                self.apply_box_result(key, cached)
+            elif crop is not None and crop.size:
+                keys.append(key)
+                crops.append(crop)
+                rects.append((rect.x(), rect.y(), rect.width(), rect.height()))
+                self.image_viewer.set_box_result(key, Qt.GlobalColor.blue)
+        if not crops:
+            return
+
+        ctx = {'kind': 'boxes', 'image': img_file, 'keys': keys, 'rects': rects,
+               'nbytes': [c.nbytes for c in crops], 'rotation': self.image_viewer.rotation()}
+        self.ocr_service.submit_batch(crops, tag=('boxes', img_file), ctx=ctx, prepare=True)
+
+    def apply_box_result(self, key, result):
+        text = result.text() if result else ''
+        if not text:
+            self.image_viewer.set_box_result(key, Qt.GlobalColor.red)
+            return
+        color, _ = self.box_style(result.confidence())
+        self.image_viewer.set_box_result(key, color, 2, text)
+        row = self.kvwidget.model.row_of(key)
+        if row >= 0:
+            self.set_ocr_value(row, text, result.confidence())
 
-        # cv2.imshow('slot_image_cropped', img)
-        # print('slot_image_cropped', img)
-        result = self.ocr.ocr(img)[0]
-        print('result -->', result)
+    def slot_ocr_result(self, req_id, ctx, result):
+        img_file = ctx['image']
 
-        if len(result) == 0:
+        if ctx['kind'] == 'page':
+            if result is None:
+                return
+            index = ocrindex.PageIndex.from_result(result, ctx['rotation'], ctx['size'])
+            ocrindex.save_sidecar(img_file, index, rotation=ctx['rotation'])
+            self._cache_page_index(img_file, index)
+            print('page ocr', os.path.basename(img_file), len(index), 'lines')
             return
 
-        confidence_sum = 0
-        rev = []
+        # cached even when the user moved on to another image meanwhile
+        stats = self.ocr_service.stats()
+        if ctx['kind'] == 'boxes' and result is not None:
+            ms = stats['last_batch_ms'] / max(len(result), 1)
+            for rect, nbytes, res in zip(ctx['rects'], ctx['nbytes'], result):
+                self.cache_ocr(img_file, rect, ctx['rotation'], res, nbytes, ms)
+        elif ctx['kind'] == 'crop':
+            self.cache_ocr(img_file, ctx['rect'], ctx['rotation'], result, ctx['nbytes'], stats['last_ms'])
 
-        for line in result:
-            if line:
-                rev.append(line[1][0])
-                confidence_sum += line[1][1]
+        if stats['stage_ms']:
+            self.update_status_tip()
 
-        confidence_avg = confidence_sum / len(result)
-        print('-->', rev, confidence_avg)
-        if confidence_avg > 0.85:
-            _color = Qt.GlobalColor.darkGreen
-            _width = 10
-        elif confidence_sum > 0.6:
-            _color = Qt.GlobalColor.yellow
-            _width = 5
-        self.image_viewer.set_drawbox_color(Qt.GlobalColor.darkGreen, width=10)
+        if not self.images_list or img_file != self.images_list[self.image_index]:
+            return
+
+        if ctx['kind'] == 'boxes':
+            print('batch of {} boxes in {:.0f}ms, {:.0f}ms per box (single crops avg {:.0f}ms)'.format(
+                stats['last_batch_n'], stats['last_batch_ms'], stats['last_batch_ms'] / max(stats['last_batch_n'], 1),
+                stats['avg_ms']))
+            for i, key in enumerate(ctx['keys']):
+                self.apply_box_result(key, result[i] if result else None)
+            return
+
+        self.apply_ocr_result(ctx['row'], result)
+
+    def apply_ocr_result(self, row, result):
+        if not result:
+            self.image_viewer.set_drawbox_color(Qt.GlobalColor.red, 2)
+            return
+
+        rev = [line.text for line in result]
+        confidence_avg = result.confidence()
+        color, width = self.box_style(confidence_avg)
+        self.image_viewer.set_drawbox_color(color, width=width)
         self.image_viewer.add_text_in_draw_box('\n'.join(rev))
 
         # copy to clipboard
         # QApplication.clipboard().setText('\n'.join(rev))
 
-        # copy value to curr kv focused item
-        self.kvwidget.value_list.currentItem().setText('\n'.join(rev))
-        # self.kvwidget.value_list.setCurrentRow(self.kvwidget.value_list.currentRow() + 1)
-        # self.kvwidget.key_list.setCurrentRow(self.kvwidget.key_list.currentRow() + 1)
+        # copy value to the kv row that was focused when the box was drawn
+        self.set_ocr_value(row, '\n'.join(rev), confidence_avg)
 
-        # print(result)
-        # self.slot_kv_item_modified(self.kvwidget.get_pairs())
-        # self.ui.grabBtn.setText('Grab')
-        # self.image_viewer.leave_draw_box()
-        # self.show_image(self.image_index + 1)
+    def slot_ocr_stats(self, stats):
+        if stats['state'] != OcrService.READY:
+            self.status_label.setText('ocr {}... q:{}'.format(stats['state'], stats['queue']))
+            return
+        self.status_label.setText('ocr q:{} last:{:.0f}ms avg:{:.0f}ms wait:{:.0f}ms'.format(
+            stats['queue'], stats['last_ms'], stats['avg_ms'], stats['avg_wait_ms']))
+        if stats['last_batch_n']:
+            self.status_label.setText(self.status_label.text() + ' batch:{}x{:.0f}ms ({:.0f}ms/box)'.format(
+                stats['last_batch_n'], stats['last_batch_ms'], stats['batch_ms_per_box']))
+
+    def slot_timing(self):
+        stats = instrument.stats()
+        self.timing_label.setText('  '.join('{} {:.0f}/{:.0f}'.format(name, p50, p95)
+                                            for name, (_, p50, p95) in sorted(stats.items())))
+        self.timing_label.setToolTip('p50/p95 ms of the last spans per stage\n' + '\n'.join(
+            '{}: {} spans'.format(name, n) for name, (n, _, _) in sorted(stats.items())))
+
+    def export_trace(self):
+        path = instrument.export(self.trace_file)
+        if path:
+            print('trace written to', path)
+
+    def slot_ocr_state(self, state, ms):
+        self.slot_ocr_stats(self.ocr_service.stats())
+        if state == OcrService.LOADING:
+            return
+
+        print('ocr {} in {:.0f}ms'.format(state, ms))
+        if self.startup_timing:
+            print('startup: ocr {} {:.0f}ms after start'.format(state, (time.perf_counter() - _T_START) * 1000))
+            QApplication.quit()
+
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        if not self._first_paint:
+            self._first_paint = True
+            if self.startup_timing:
+                print('startup: first paint {:.0f}ms after start'.format((time.perf_counter() - _T_START) * 1000))
+
+    def closeEvent(self, e):
+        if self.scanner is not None:
+            self.scanner.stop()
+        self.progress.stop()
+        if self.apply_task is not None:
+            self.apply_task.stop()
+        for task in (self.dupe_task, self.copy_task, self.search_task, self.replace_task):
+            if task is not None:
+                task.stop()
+        self.saver.flush(wait=True)
+        print('saves', self.saver.stats())
+        print('prefetch', self.prefetcher.stats())
+        self.prefetcher.shutdown()
+        self.ocr_service.shutdown()
+        if self.grid is not None:
+            self.grid.shutdown()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.ocr_cache is not None:
+            print('ocr cache', self.ocr_cache.stats())
+            self.ocr_cache.close()
+        super().closeEvent(e)
 
 
 
 #######################
 if __name__ == '__main__':
-    app = QApplication( sys.argv )
-    ui = LabelIt()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--startup-timing', action='store_true',
+                        help='print time to first paint and to OCR ready, then exit')
+    parser.add_argument('--page-ocr', action='store_true',
+                        help='OCR whole pages once and resolve boxes from the page lines')
+    parser.add_argument('--prefetch', type=int, default=3,
+                        help='images decoded ahead in the walking direction')
+    parser.add_argument('--cache-mb', type=int, default=512,
+                        help='memory budget of the decoded image cache')
+    parser.add_argument('--store', choices=('json', 'sqlite'), default=None,
+                        help='annotation backend, jsons/ dir or one annotations.db '
+                             '(default: sqlite if the dir has a database)')
+    parser.add_argument('--ocr-engine', choices=sorted(ENGINES), default='paddle',
+                        help='OCR backend, onnx needs rapidocr_onnxruntime, tesseract pytesseract')
+    parser.add_argument('--ocr-threads', type=int, default=None,
+                        help='cpu threads of the OCR engine')
+    parser.add_argument('--ocr-cache-mb', type=int, default=256,
+                        help='disk budget of the OCR result cache, 0 turns it off')
+    parser.add_argument('--no-preprocess', action='store_true',
+                        help='send crops to OCR as drawn, without resizing / padding them')
+    parser.add_argument('--ocr-deskew', action='store_true',
+                        help='straighten slightly rotated text in crops before OCR')
+    parser.add_argument('--ocr-binarize', action='store_true',
+                        help='black and white crops (Otsu) before OCR, helps on stained scans')
+    parser.add_argument('--rec-height', type=int, default=None,
+                        help='height one line crops are scaled to (default: the engine\'s recognizer input)')
+    parser.add_argument('--conf-low', type=float, default=LOW_CONF,
+                        help='ocr confidence below which a value is marked as likely wrong')
+    parser.add_argument('--conf-high', type=float, default=HIGH_CONF,
+                        help='ocr confidence from which a value is trusted, lower ones are in the review queue')
+    parser.add_argument('--trace', action='store_true',
+                        help='time decode, display, OCR and json load / save, p50/p95 in the status bar '
+                             'and a Chrome trace of the session in ~/.cache/label_it/traces')
+    parser.add_argument('--trace-file', default=None,
+                        help='where to write the trace instead (implies --trace)')
+    parser.add_argument('--recursive', action='store_true',
+                        help='also label the images in sub dirs of the chosen dir')
+    args, qt_args = parser.parse_known_args()
+
+    if args.trace or args.trace_file:
+        instrument.enable()
+
+    app = QApplication( sys.argv[:1] + qt_args )
+    ui = LabelIt(startup_timing=args.startup_timing, page_ocr=args.page_ocr,
+                 prefetch=args.prefetch, cache_mb=args.cache_mb, store=args.store,
+                 recursive=args.recursive, ocr_cache_mb=args.ocr_cache_mb,
+                 ocr_engine=args.ocr_engine, ocr_threads=args.ocr_threads,
+                 preprocess=not args.no_preprocess, deskew=args.ocr_deskew, binarize=args.ocr_binarize,
+                 rec_height=args.rec_height, conf_low=args.conf_low, conf_high=args.conf_high,
+                 trace_file=args.trace_file)
     ui.show()
+    # closeEvent does not run on every way out, pending edits must still land
+    app.aboutToQuit.connect(lambda: ui.saver.flush(wait=True))
+    app.aboutToQuit.connect(ui.export_trace)
     sys.exit( app.exec_() )
\ No newline at end of file
@@ -0,0 +1,201 @@
+# OCR results of crops, so redrawing (nearly) the same box, coming back to an
+# image or reopening a dataset does not run the model again. keyed by
+#   image content hash + orientation + crop rect (within `tolerance` pixels)
+#   + engine config
+# a small in-memory LRU sits in front of a sqlite file that is trimmed to
+# `max_mb`, least recently used first
+
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_ocr import file_hash
+from cachedir import CACHE_DIR
+from ocrengine import OcrResult
+
+
+DB_NAME = 'ocr_cache.db'
+
+
+class OcrCache:
+
+    def __init__(self, config, db_path=None, max_mb=256, mem_entries=512, tolerance=6, hash_entries=256):
+        self.config = config
+        self.max_bytes = max_mb * 1024 * 1024
+        self.mem_entries = mem_entries
+        self.tolerance = tolerance
+        self.hash_entries = hash_entries
+
+        # only ever used from the GUI thread, hashing runs on its own thread
+        if db_path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            db_path = os.path.join(CACHE_DIR, DB_NAME)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ocr ('
+                          'image TEXT, config TEXT, rotation INTEGER, x INTEGER, y INTEGER, w INTEGER, h INTEGER, '
+                          'result TEXT, nbytes INTEGER, ms REAL, used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ocr_image ON ocr (image, config, rotation)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS ocr_used ON ocr (used)')
+        self.disk_bytes = self.conn.execute('SELECT COALESCE(SUM(LENGTH(result)), 0) FROM ocr').fetchone()[0]
+
+        self._mem = OrderedDict()   # (image, rotation, rect) -> (result, nbytes, ms)
+        self._rects = {}            # (image, rotation) -> rects of it in _mem
+        self._hasher = ThreadPoolExecutor(1)
+        self._hashes = OrderedDict()    # (path, mtime, size) -> future of the content hash, LRU
+        self._deferred = []         # put() args of images still being hashed
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.ms_saved = 0.0
+
+    def prehash(self, path):
+        # start hashing before the first box is drawn, nothing waits on it
+        try:
+            self._hash_future(path)
+        except OSError:
+            pass
+
+    def _hash_future(self, path):
+        st = os.stat(path)
+        k = (path, st.st_mtime, st.st_size)
+        fut = self._hashes.get(k)
+        if fut is None:
+            fut = self._hashes[k] = self._hasher.submit(file_hash, path)
+            while len(self._hashes) > self.hash_entries:
+                self._hashes.popitem(last=False)
+        else:
+            self._hashes.move_to_end(k)
+        return fut
+
+    def image_key(self, path):
+        # the content hash, None while it is still being computed: the GUI
+        # thread never waits on reading a file
+        fut = self._hash_future(path)
+        return fut.result() if fut.done() else None
+
+    def _put_deferred(self):
+        # results that came back before the hash of their image
+        waiting = []
+        for fut, args in self._deferred:
+            if not fut.done():
+                waiting.append((fut, args))
+            elif fut.exception() is None:
+                self._put(fut.result(), *args)
+        self._deferred = waiting
+
+    def _near(self, a, b):
+        return all(abs(p - q) <= self.tolerance for p, q in zip(a, b))
+
+    @staticmethod
+    def _rect(rect):
+        return tuple(int(round(v)) for v in rect)
+
+    def get(self, path, rect, rotation=0):
+        # rect is (x, y, w, h) in unrotated image pixels. an OcrResult, None on
+        # a miss, or while the image is still being hashed
+        self._put_deferred()
+        try:
+            image = self.image_key(path)
+        except OSError:
+            return None
+        if image is None:
+            self.misses += 1
+            return None
+        rect = self._rect(rect)
+
+        entry = None
+        for r in self._rects.get((image, rotation), ()):
+            if self._near(r, rect):
+                k = (image, rotation, r)
+                entry = self._mem[k]
+                self._mem.move_to_end(k)
+                break
+
+        if entry is None:
+            t = self.tolerance
+            row = self.conn.execute(
+                'SELECT rowid, x, y, w, h, result, nbytes, ms FROM ocr WHERE image = ? AND config = ? AND rotation = ? '
+                'AND x BETWEEN ? AND ? AND y BETWEEN ? AND ? AND w BETWEEN ? AND ? AND h BETWEEN ? AND ? LIMIT 1',
+                (image, self.config, rotation) + sum(((v - t, v + t) for v in rect), ())).fetchone()
+            if row is not None:
+                entry = (OcrResult.from_list(json.loads(row[5])), row[6], row[7])
+                self.conn.execute('UPDATE ocr SET used = ? WHERE rowid = ?', (time.time(), row[0]))
+                self.conn.commit()
+                self._remember(image, rotation, tuple(row[1:5]), entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += entry[1]
+        self.ms_saved += entry[2]
+        return entry[0]
+
+    def put(self, path, rect, rotation, result, nbytes=0, ms=0.0):
+        self._put_deferred()
+        try:
+            fut = self._hash_future(path)
+        except OSError:
+            return
+        if not fut.done():
+            self._deferred.append((fut, (rect, rotation, result, nbytes, ms)))
+            return
+        if fut.exception() is None:
+            self._put(fut.result(), rect, rotation, result, nbytes, ms)
+
+    def _put(self, image, rect, rotation, result, nbytes, ms):
+        rect = self._rect(rect)
+        self._remember(image, rotation, rect, (result, nbytes, ms))
+
+        blob = json.dumps(result.to_list(), ensure_ascii=False)
+        self.conn.execute('INSERT INTO ocr VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (image, self.config, rotation) + rect + (blob, nbytes, ms, time.time()))
+        self.disk_bytes += len(blob)
+        if self.disk_bytes > self.max_bytes:
+            self._evict()
+        self.conn.commit()
+
+    def _remember(self, image, rotation, rect, entry):
+        k = (image, rotation, rect)
+        if k not in self._mem:
+            self._rects.setdefault((image, rotation), []).append(rect)
+        self._mem[k] = entry
+        self._mem.move_to_end(k)
+        while len(self._mem) > self.mem_entries:
+            (image, rotation, rect), _ = self._mem.popitem(last=False)
+            rects = self._rects[(image, rotation)]
+            rects.remove(rect)
+            if not rects:
+                del self._rects[(image, rotation)]
+
+    def _evict(self):
+        # oldest used first, down to 90% so this does not run on every put
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute('SELECT rowid, LENGTH(result) FROM ocr ORDER BY used')
+        drop = []
+        for rowid, n in rows:
+            if self.disk_bytes <= target:
+                break
+            drop.append((rowid,))
+            self.disk_bytes -= n
+        self.conn.executemany('DELETE FROM ocr WHERE rowid = ?', drop)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'mb_saved': self.bytes_saved / (1024 * 1024),
+            'ms_saved': self.ms_saved,
+            'disk_mb': self.disk_bytes / (1024 * 1024),
+        }
+
+    def close(self):
+        self._hasher.shutdown(wait=False)
+        self.conn.close()
@@ -0,0 +1,325 @@
+# OCR backends behind one interface. every engine takes an RGB uint8 array
+# and returns an OcrResult, so nothing outside this file knows what a paddle
+# or rapidocr result looks like. engines are picked by name from ENGINES:
+#
+#   paddle      PaddleOCR, the original engine
+#   onnx        RapidOCR on ONNX Runtime (same PP-OCR models), CPU only, no paddle stack
+#   tesseract   pytesseract, small and everywhere, less accurate
+#   stub        no model at all, for tests and benchmarks
+#
+# the heavy imports happen in the constructors, which only ever run on an
+# OCR worker thread or process
+
+import time
+import importlib.util
+from collections import namedtuple
+
+import numpy as np
+
+
+# poly is [[x, y], ...] in pixels of the image given to the engine
+OcrLine = namedtuple('OcrLine', 'poly text conf')
+
+
+class OcrResult:
+    # the text lines of one image or crop, in reading order
+
+    def __init__(self, lines=()):
+        self.lines = [OcrLine(*l) for l in lines]
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __repr__(self):
+        return 'OcrResult({!r})'.format([(l.text, round(l.conf, 3)) for l in self.lines])
+
+    def text(self, sep='\n'):
+        return sep.join(l.text for l in self.lines)
+
+    def confidence(self):
+        # mean over the lines, None without lines
+        return sum(l.conf for l in self.lines) / len(self.lines) if self.lines else None
+
+    def to_list(self):
+        # json friendly
+        return [[[[float(x), float(y)] for x, y in l.poly], l.text, float(l.conf)] for l in self.lines]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(data or [])
+
+    @classmethod
+    def from_paddle(cls, result):
+        # [[poly, (text, conf)], ...], None for nothing found
+        return cls((line[0], line[1][0], line[1][1]) for line in result or [] if line)
+
+
+def _order_key(quad):
+    # top to bottom, then left to right within about the same line
+    return round(quad[0][1] / 10), quad[0][0]
+
+
+def reading_order(quads):
+    return sorted(quads, key=_order_key)
+
+
+def line_crop(img, quad):
+    # upright crop of one detected text line, like paddle does it
+    import cv2
+    quad = np.asarray(quad, dtype=np.float32)
+    w = int(max(np.linalg.norm(quad[0] - quad[1]), np.linalg.norm(quad[2] - quad[3])))
+    h = int(max(np.linalg.norm(quad[0] - quad[3]), np.linalg.norm(quad[1] - quad[2])))
+    dst = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    crop = cv2.warpPerspective(img, cv2.getPerspectiveTransform(quad, dst), (max(w, 1), max(h, 1)),
+                               borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC)
+    if crop.shape[0] >= crop.shape[1] * 1.5:
+        crop = np.rot90(crop)
+    return crop
+
+
+def whole(img):
+    # the quad of a crop that is one text line as it is
+    h, w = img.shape[:2]
+    return [[0, 0], [w, 0], [w, h], [0, h]]
+
+
+def det_rec_batch(detect, recognize, imgs, single=None):
+    # several crops in one go: text lines are detected per crop, then all
+    # lines of all crops go through the recognizer in a single batched call.
+    # crops flagged in single are one line already and skip detection.
+    # detect(img) -> quads, recognize([line crops]) -> [(text, conf)]
+    single = single or [False] * len(imgs)
+    lines, owner, polys = [], [], []
+    for i, img in enumerate(imgs):
+        if single[i]:
+            lines.append(img)
+            owner.append(i)
+            polys.append(whole(img))
+            continue
+        for quad in reading_order(detect(img)):
+            lines.append(line_crop(img, quad))
+            owner.append(i)
+            polys.append(quad)
+
+    results = [OcrResult() for _ in imgs]
+    if lines:
+        for i, poly, (text, conf) in zip(owner, polys, recognize(lines)):
+            results[i].lines.append(OcrLine(poly, text, float(conf)))
+    return results
+
+
+def _line_result(img, rec):
+    # [(text, conf)] of the recognizer for a whole crop -> OcrResult
+    text, conf = rec[0] if rec else ('', 0.0)
+    return OcrResult([(whole(img), text, float(conf))] if text else [])
+
+
+class OcrEngine:
+    # one instance per worker thread, instances are not thread safe
+
+    name = None
+    # python module the engine needs, for available()
+    module = None
+    # what changes the results, part of the OCR cache key
+    config = ''
+    # input height of the recognizer, crops of one line are scaled to it
+    rec_height = 48
+
+    def __init__(self, **options):
+        self.options = options
+
+    @classmethod
+    def config_key(cls):
+        return '{} {}'.format(cls.name, cls.config)
+
+    def recognize(self, img):
+        raise NotImplementedError
+
+    def recognize_line(self, img):
+        # a crop known to hold one line of text, engines with a separate
+        # recognizer skip detection for it
+        return self.recognize(img)
+
+    def recognize_batch(self, imgs, single=None):
+        single = single or [False] * len(imgs)
+        return [self.recognize_line(img) if s else self.recognize(img) for img, s in zip(imgs, single)]
+
+    def warmup(self):
+        # one dummy pass so the predictors allocate their buffers now and
+        # not on the first real crop
+        dummy = np.full((48, 320, 3), 255, dtype=np.uint8)
+        dummy[16:32, 20:300] = 0
+        self.recognize(dummy)
+
+
+ENGINES = {}
+
+
+def register(cls):
+    ENGINES[cls.name] = cls
+    return cls
+
+
+def available():
+    return [name for name, cls in ENGINES.items()
+            if cls.module is None or importlib.util.find_spec(cls.module) is not None]
+
+
+def engine_class(name):
+    cls = ENGINES.get(name)
+    if cls is None:
+        raise ValueError('unknown ocr engine {!r}, one of {}'.format(name, ', '.join(ENGINES)))
+    return cls
+
+
+def create_engine(name, **options):
+    return engine_class(name)(**options)
+
+
+def _bgr(img):
+    # paddle and rapidocr models are trained on cv2 loaded (BGR) images
+    return np.ascontiguousarray(img[:, :, ::-1]) if img.ndim == 3 else img
+
+
+@register
+class PaddleEngine(OcrEngine):
+
+    name = 'paddle'
+    module = 'paddleocr'
+    config = 'v2 use_angle_cls=True'
+
+    def __init__(self, threads=None, use_gpu=False, rec_batch=6, **options):
+        super().__init__(**options)
+        from paddleocr import PaddleOCR
+        kw = {'use_gpu': use_gpu, 'rec_batch_num': rec_batch}
+        if threads:
+            kw['cpu_threads'] = threads
+        self.ocr = PaddleOCR(use_angle_cls=True, show_log=False, **kw)
+
+    def recognize(self, img):
+        return OcrResult.from_paddle(self.ocr.ocr(_bgr(img))[0])
+
+    def recognize_line(self, img):
+        rec = getattr(self.ocr, 'text_recognizer', None)
+        if rec is None:
+            return self.recognize(img)
+        return _line_result(img, rec([_bgr(img)])[0])
+
+    def recognize_batch(self, imgs, single=None):
+        det = getattr(self.ocr, 'text_detector', None)
+        rec = getattr(self.ocr, 'text_recognizer', None)
+        if det is None or rec is None:
+            return super().recognize_batch(imgs, single)
+
+        def detect(img):
+            boxes, _ = det(img)
+            return [] if boxes is None else [b.tolist() for b in boxes]
+
+        return det_rec_batch(detect, lambda lines: rec(lines)[0], [_bgr(img) for img in imgs], single)
+
+
+@register
+class OnnxEngine(OcrEngine):
+    # PP-OCR models on ONNX Runtime, a fraction of paddle's import time and memory
+
+    name = 'onnx'
+    module = 'rapidocr_onnxruntime'
+    config = 'rapidocr'
+
+    def __init__(self, threads=None, **options):
+        super().__init__(**options)
+        from rapidocr_onnxruntime import RapidOCR
+        kw = {}
+        if threads:
+            kw['intra_op_num_threads'] = threads
+            kw['inter_op_num_threads'] = 1
+        self.ocr = RapidOCR(**kw)
+
+    def recognize(self, img):
+        result, _ = self.ocr(_bgr(img))
+        return OcrResult((box, text, float(conf)) for box, text, conf in result or [])
+
+    def recognize_line(self, img):
+        rec = getattr(self.ocr, 'text_rec', None)
+        if rec is None:
+            return self.recognize(img)
+        return _line_result(img, rec([_bgr(img)])[0])
+
+    def recognize_batch(self, imgs, single=None):
+        det = getattr(self.ocr, 'text_det', None)
+        rec = getattr(self.ocr, 'text_rec', None)
+        if det is None or rec is None:
+            return super().recognize_batch(imgs, single)
+
+        def detect(img):
+            boxes, _ = det(img)
+            return [] if boxes is None else [b.tolist() for b in boxes]
+
+        return det_rec_batch(detect, lambda lines: rec(lines)[0], [_bgr(img) for img in imgs], single)
+
+
+@register
+class TesseractEngine(OcrEngine):
+    # fallback without any deep learning stack, needs the tesseract binary
+
+    name = 'tesseract'
+    module = 'pytesseract'
+    config = 'default'
+
+    def __init__(self, lang='eng', threads=None, **options):
+        super().__init__(**options)
+        import pytesseract
+        self.tess = pytesseract
+        self.lang = lang
+
+    def recognize(self, img, config=''):
+        data = self.tess.image_to_data(img, lang=self.lang, config=config, output_type=self.tess.Output.DICT)
+        # words -> lines
+        groups = {}
+        for i, word in enumerate(data['text']):
+            conf = float(data['conf'][i])
+            if not word.strip() or conf < 0:
+                continue
+            key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+            groups.setdefault(key, []).append((data['left'][i], data['top'][i], data['width'][i],
+                                               data['height'][i], word, conf / 100))
+        lines = []
+        for words in groups.values():
+            x0 = min(w[0] for w in words)
+            y0 = min(w[1] for w in words)
+            x1 = max(w[0] + w[2] for w in words)
+            y1 = max(w[1] + w[3] for w in words)
+            lines.append(([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], ' '.join(w[4] for w in words),
+                          sum(w[5] for w in words) / len(words)))
+        return OcrResult(sorted(lines, key=lambda l: _order_key(l[0])))
+
+    def recognize_line(self, img):
+        # page segmentation mode 7: the image is a single text line
+        return self.recognize(img, '--psm 7')
+
+
+@register
+class StubEngine(OcrEngine):
+    # one line over the whole crop with a fixed (or size) text, optionally slow
+
+    name = 'stub'
+    config = 'stub'
+
+    def __init__(self, text=None, delay_ms=0, conf=1.0, threads=None, **options):
+        super().__init__(**options)
+        self.text = text
+        self.delay_ms = delay_ms
+        self.conf = conf
+
+    def recognize(self, img):
+        if self.delay_ms:
+            time.sleep(self.delay_ms / 1000)
+        h, w = img.shape[:2]
+        text = self.text if self.text is not None else 'stub {}x{}'.format(w, h)
+        return OcrResult([([[0, 0], [w, 0], [w, h], [0, h]], text, self.conf)])
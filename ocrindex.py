@@ -0,0 +1,172 @@
+import os
+import json
+
+from ocrengine import OcrResult
+
+
+def sidecar_path(image_file, ocr_dir=None):
+    if ocr_dir is None:
+        ocr_dir = os.path.join(os.path.dirname(image_file), 'ocr')
+    return os.path.join(ocr_dir, os.path.basename(image_file) + '.ocr.json')
+
+
+def to_display(x, y, rotation, w, h):
+    # image pixel -> pixel of the image turned clockwise by rotation, w/h unrotated
+    if rotation == 90:
+        return h - y, x
+    if rotation == 180:
+        return w - x, h - y
+    if rotation == 270:
+        return y, w - x
+    return x, y
+
+
+def from_display(x, y, rotation, w, h):
+    if rotation == 90:
+        return y, h - x
+    if rotation == 180:
+        return w - x, h - y
+    if rotation == 270:
+        return w - y, x
+    return x, y
+
+
+class PageIndex:
+    # full page OCR lines of one image, bucketed in a uniform grid so a drawn
+    # box only has to look at the handful of lines around it
+
+    CELL = 64
+
+    def __init__(self, lines=None):
+        self.polys = []
+        self.texts = []
+        self.confs = []
+        self.bboxes = []
+        self._grid = {}
+
+        for poly, text, conf in lines or []:
+            self.add(poly, text, conf)
+
+    @classmethod
+    def from_result(cls, result, rotation=0, size=None):
+        # result is an OcrResult, or None for an empty page. when OCR ran on
+        # the rotated page, polygons are mapped back to image pixels (size is
+        # the unrotated w, h) so the index never depends on orientation
+        lines = []
+        for poly, text, conf in result or []:
+            if rotation:
+                poly = [from_display(x, y, rotation, *size) for x, y in poly]
+            lines.append((poly, text, conf))
+        return cls(lines)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, poly, text, conf):
+        xs = [p[0] for p in poly]
+        ys = [p[1] for p in poly]
+        bbox = (min(xs), min(ys), max(xs), max(ys))
+
+        idx = len(self.texts)
+        self.polys.append([[float(x), float(y)] for x, y in poly])
+        self.texts.append(text)
+        self.confs.append(float(conf))
+        self.bboxes.append(bbox)
+
+        for cell in self._cells(*bbox):
+            self._grid.setdefault(cell, []).append(idx)
+
+    def _cells(self, x0, y0, x1, y1):
+        c = self.CELL
+        for cy in range(int(y0 // c), int(y1 // c) + 1):
+            for cx in range(int(x0 // c), int(x1 // c) + 1):
+                yield cx, cy
+
+    def query(self, x, y, w, h, min_overlap=0.5):
+        # lines whose box lies at least min_overlap inside the rect, in reading order
+        rx0, ry0, rx1, ry1 = x, y, x + w, y + h
+
+        hits = []
+        seen = set()
+        for cell in self._cells(rx0, ry0, rx1, ry1):
+            for idx in self._grid.get(cell, ()):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+
+                x0, y0, x1, y1 = self.bboxes[idx]
+                iw = min(x1, rx1) - max(x0, rx0)
+                ih = min(y1, ry1) - max(y0, ry0)
+                if iw <= 0 or ih <= 0:
+                    continue
+                area = max((x1 - x0) * (y1 - y0), 1e-6)
+                if iw * ih / area >= min_overlap:
+                    hits.append(idx)
+
+        return self._reading_order(hits)
+
+    def _reading_order(self, ids):
+        # group into rows by vertical overlap, then left to right inside a row
+        ids = sorted(ids, key=lambda i: self.bboxes[i][1])
+        rows = []
+        for idx in ids:
+            x0, y0, x1, y1 = self.bboxes[idx]
+            cy = (y0 + y1) / 2
+            if rows and rows[-1][0] <= cy <= rows[-1][1]:
+                rows[-1][2].append(idx)
+                rows[-1][1] = max(rows[-1][1], y1)
+            else:
+                rows.append([y0, y1, [idx]])
+
+        rev = []
+        for _, _, row in rows:
+            rev.extend(sorted(row, key=lambda i: self.bboxes[i][0]))
+        return rev
+
+    def lines(self, ids):
+        # an OcrResult, so callers treat it like one from the engine
+        return OcrResult((self.polys[i], self.texts[i], self.confs[i]) for i in ids)
+
+    def to_dict(self):
+        return {'lines': [{'poly': p, 'text': t, 'conf': c}
+                          for p, t, c in zip(self.polys, self.texts, self.confs)]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([(l['poly'], l['text'], l['conf']) for l in data.get('lines', [])])
+
+
+def save_sidecar(image_file, index, ocr_dir=None, sha1=None, rotation=0):
+    path = sidecar_path(image_file, ocr_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    data = index.to_dict()
+    data['image'] = os.path.basename(image_file)
+    data['mtime'] = os.path.getmtime(image_file)
+    if sha1:
+        data['sha1'] = sha1
+    if rotation:
+        # the orientation the page was read at, boxes are in image pixels anyway
+        data['rotation'] = rotation
+
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    return path
+
+
+def read_sidecar(image_file, ocr_dir=None):
+    try:
+        with open(sidecar_path(image_file, ocr_dir)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_sidecar(image_file, ocr_dir=None):
+    # None when missing or older than the image
+    data = read_sidecar(image_file, ocr_dir)
+    if data is None or data.get('mtime') != os.path.getmtime(image_file):
+        return None
+    return PageIndex.from_dict(data)
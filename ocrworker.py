@@ -0,0 +1,312 @@
+import time
+import threading
+from collections import deque
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+import instrument
+
+# cv2 and the OCR engine are imported lazily on the worker threads, so they
+# don't cost anything before the window is up
+
+
+def _to_rgb3(img):
+    if img.ndim == 3 and img.shape[2] == 4:
+        import cv2
+        img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
+    return img
+
+
+def load_page(path, rotation=0):
+    # the whole page upright as RGB, decoded on the worker the way the viewer
+    # decodes it, so the GUI never holds a full resolution copy for OCR
+    from prefetch import read_image
+    from imageviewer import qimage_view, to_rgb, rotate_array
+    qimg = read_image(path)
+    if qimg.isNull():
+        raise ValueError('can not decode ' + path)
+    arr, order, qimg = qimage_view(qimg)
+    return rotate_array(to_rgb(arr, order), rotation)
+
+
+class _OcrTask(QRunnable):
+
+    def __init__(self, service, req_id, img, tag, ctx, prepare=False):
+        super().__init__()
+        self.setAutoDelete(False)
+
+        self.service = service
+        self.req_id = req_id
+        self.img = img          # a list of crops for a batch, (path, rotation) of a page
+        self.batch = isinstance(img, list)
+        self.page = isinstance(img, tuple)
+        self.tag = tag
+        self.ctx = ctx
+        self.prepare = prepare and service.pipeline is not None
+        self.stage_ms = {}
+        self.n_single = 0
+        self.t_submit = time.perf_counter()
+
+    def run(self):
+        if self.service.is_stale(self.req_id, self.tag):
+            self.service._task_done(self, None, cancelled=True)
+            return
+
+        t_start = time.perf_counter()
+        # named after the job (ctx kind: crop, boxes, page), else by its shape
+        kind = self.ctx.get('kind') if isinstance(self.ctx, dict) else None
+        name = 'ocr.' + (kind or ('batch' if self.batch else 'page' if self.page else 'crop'))
+        try:
+            with instrument.span(name, n=len(self.img) if self.batch else 1):
+                result = self._run()
+        except Exception as e:
+            print('ocr failed', e)
+            result = None
+        self.wait_ms = (t_start - self.t_submit) * 1000
+        self.run_ms = (time.perf_counter() - t_start) * 1000
+
+        self.service._task_done(self, result)
+
+    def _run(self):
+        if self.prepare:
+            return self._run_prepared()
+        if self.batch:
+            return self.service.engine().recognize_batch([_to_rgb3(img) for img in self.img])
+        if self.page:
+            with instrument.span('decode.page'):
+                img = load_page(*self.img)
+            return self.service.engine().recognize(img)
+        return self.service.engine().recognize(_to_rgb3(self.img))
+
+    def _run_prepared(self):
+        # crops through the preprocessing pipeline, one line crops then skip
+        # detection. results are mapped back to the pixels of the crop
+        from preprocess import to_crop
+        imgs = self.img if self.batch else [self.img]
+        prepared, single, infos = [], [], []
+        for img in imgs:
+            p, s, info = self.service.pipeline.run(img)
+            prepared.append(p)
+            single.append(s)
+            infos.append(info)
+            for stage, ms in info['ms'].items():
+                self.stage_ms[stage] = self.stage_ms.get(stage, 0.0) + ms
+                instrument.record('preprocess.' + stage, ms)
+        self.n_single = sum(single)
+
+        t0 = time.perf_counter()
+        engine = self.service.engine()
+        if self.batch:
+            results = engine.recognize_batch(prepared, single)
+        elif single[0]:
+            results = [engine.recognize_line(prepared[0])]
+        else:
+            results = [engine.recognize(prepared[0])]
+        self.stage_ms['ocr'] = (time.perf_counter() - t0) * 1000
+
+        results = [to_crop(r, info) for r, info in zip(results, infos)]
+        return results if self.batch else results[0]
+
+
+class _WarmupTask(QRunnable):
+
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            self.service.engine().warmup()
+        except Exception as e:
+            print('ocr warmup failed', e)
+            self.service._set_state(OcrService.FAILED, (time.perf_counter() - t0) * 1000)
+            return
+        self.service._set_state(OcrService.READY, (time.perf_counter() - t0) * 1000)
+
+
+class OcrService(QObject):
+    # req_id, ctx, ocrengine.OcrResult (None on failure). for a batch a list
+    # of results, one per crop, or None when it failed
+    resultReady = pyqtSignal(int, object, object)
+    statsChanged = pyqtSignal(dict)
+    # state, ms spent loading
+    stateChanged = pyqtSignal(str, float)
+
+    IDLE = 'idle'
+    LOADING = 'loading'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, engine_factory, workers=1, pipeline=None, parent=None):
+        super().__init__(parent)
+
+        # engines are not thread safe, every worker gets its own from the factory
+        self._engine_factory = engine_factory
+        # preprocess.CropPipeline for submits with prepare=True, stateless so shared
+        self.pipeline = pipeline
+        self._local = threading.local()
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(workers)
+        # idle threads are otherwise ended after 30s, and their engine with them
+        self._pool.setExpiryTimeout(-1)
+
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._latest = {}       # tag -> newest req_id, while the tag has requests pending
+        self._pending = {}      # req_id -> task
+
+        self._wait_ms = deque(maxlen=50)
+        self._run_ms = deque(maxlen=50)
+        self._batch_ms = deque(maxlen=50)   # (crops, ms)
+        self._stage_ms = deque(maxlen=50)   # (crops, {stage: ms}) of prepared tasks
+        self.n_prepared = 0
+        self.n_single = 0
+        self.n_done = 0
+        self.n_cancelled = 0
+        self.state = self.IDLE
+
+    def warmup(self):
+        # runs ahead of any crop in the (fifo) pool, crops made meanwhile just queue up
+        if self.state != self.IDLE:
+            return
+        self._set_state(self.LOADING, 0.0)
+        self._pool.start(_WarmupTask(self))
+
+    def _set_state(self, state, ms):
+        self.state = state
+        self.stateChanged.emit(state, ms)
+
+    def engine(self):
+        engine = getattr(self._local, 'engine', None)
+        if engine is None:
+            engine = self._engine_factory()
+            self._local.engine = engine
+        return engine
+
+    def submit(self, img, tag=None, ctx=None, prepare=False):
+        # prepare: a crop, sent through the pipeline before the engine. not for whole pages
+        with self._lock:
+            self._next_id += 1
+            req_id = self._next_id
+
+            # a newer crop on the same tag supersedes anything still queued
+            old_id = self._latest.get(tag)
+            old_task = self._pending.get(old_id)
+            if old_task is not None and self._pool.tryTake(old_task):
+                del self._pending[old_id]
+                self.n_cancelled += 1
+            self._latest[tag] = req_id
+
+            task = _OcrTask(self, req_id, img, tag, ctx, prepare)
+            self._pending[req_id] = task
+
+        self._pool.start(task)
+        self.statsChanged.emit(self.stats())
+        return req_id
+
+    def submit_batch(self, imgs, tag=None, ctx=None, prepare=False):
+        # all crops recognised in one pass, the result is a list in the same order
+        return self.submit(list(imgs), tag, ctx, prepare)
+
+    def submit_page(self, path, rotation=0, tag=None, ctx=None):
+        # a whole page, read from the file and turned upright on the worker
+        return self.submit((path, rotation), tag, ctx)
+
+    def has_pending(self, tag):
+        # queued or running
+        with self._lock:
+            return any(task.tag == tag for task in self._pending.values())
+
+    def drop_queued(self, tag):
+        # like cancel() for the queued requests only, a running one still delivers
+        with self._lock:
+            for req_id, task in list(self._pending.items()):
+                if task.tag == tag and self._pool.tryTake(task):
+                    del self._pending[req_id]
+                    self.n_cancelled += 1
+            if not any(task.tag == tag for task in self._pending.values()):
+                self._latest.pop(tag, None)
+        self.statsChanged.emit(self.stats())
+
+    def cancel(self, tag=None):
+        with self._lock:
+            for req_id, task in list(self._pending.items()):
+                if task.tag == tag and self._pool.tryTake(task):
+                    del self._pending[req_id]
+                    self.n_cancelled += 1
+            # a running one can't be taken back, its result is dropped
+            if any(task.tag == tag for task in self._pending.values()):
+                self._latest[tag] = self._next_id + 1
+            else:
+                self._latest.pop(tag, None)
+        self.statsChanged.emit(self.stats())
+
+    def is_stale(self, req_id, tag):
+        return self._latest.get(tag, req_id) != req_id
+
+    def _task_done(self, task, result, cancelled=False):
+        with self._lock:
+            self._pending.pop(task.req_id, None)
+            stale = self.is_stale(task.req_id, task.tag)
+            # nothing left for the tag, forget it (one per image and box otherwise)
+            if not any(t.tag == task.tag for t in self._pending.values()):
+                self._latest.pop(task.tag, None)
+            if cancelled:
+                self.n_cancelled += 1
+            else:
+                self.n_done += 1
+                self._wait_ms.append(task.wait_ms)
+                if task.batch:
+                    self._batch_ms.append((len(task.img), task.run_ms))
+                else:
+                    self._run_ms.append(task.run_ms)
+                if task.stage_ms:
+                    n = len(task.img) if task.batch else 1
+                    self._stage_ms.append((n, task.stage_ms))
+                    self.n_prepared += n
+                    self.n_single += task.n_single
+
+        if not cancelled and not stale:
+            self.resultReady.emit(task.req_id, task.ctx, result)
+        self.statsChanged.emit(self.stats())
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        with self._lock:
+            wait = list(self._wait_ms)
+            run = list(self._run_ms)
+            batch = list(self._batch_ms)
+            staged = list(self._stage_ms)
+            depth = len(self._pending)
+        n_boxes = sum(n for n, _ in batch)
+        # mean ms per crop of every preprocessing stage and of the engine call
+        stages = {}
+        for _, ms in staged:
+            for stage, v in ms.items():
+                stages[stage] = stages.get(stage, 0.0) + v
+        n_staged = sum(n for n, _ in staged)
+        stages = {stage: v / n_staged for stage, v in stages.items()}
+        return {
+            'state': self.state,
+            'queue': depth,
+            'done': self.n_done,
+            'cancelled': self.n_cancelled,
+            'last_ms': run[-1] if run else 0.0,
+            'avg_ms': sum(run) / len(run) if run else 0.0,
+            'avg_wait_ms': sum(wait) / len(wait) if wait else 0.0,
+            # batches, to compare per box against avg_ms of single crops
+            'last_batch_n': batch[-1][0] if batch else 0,
+            'last_batch_ms': batch[-1][1] if batch else 0.0,
+            'batch_ms_per_box': sum(ms for _, ms in batch) / n_boxes if n_boxes else 0.0,
+            'stage_ms': stages,
+            'prepared': self.n_prepared,
+            'single_line': self.n_single,
+        }
+
+    def shutdown(self, msecs=3000):
+        self._pool.clear()
+        self._pool.waitForDone(msecs)
@@ -0,0 +1,108 @@
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QTimer, pyqtSignal
+
+import instrument
+
+
+class _WriteTask(QRunnable):
+
+    def __init__(self, saver, name, data):
+        super().__init__()
+        self.saver = saver
+        self.name = name
+        self.data = data
+
+    def run(self):
+        try:
+            with instrument.span('json.save'):
+                self.saver.store.put(self.name, self.data)
+            err = ''
+        except Exception as e:
+            err = str(e)
+        # the search index follows the store, on this thread too
+        index = self.saver.index
+        if index is not None and not err:
+            try:
+                with instrument.span('search.update'):
+                    index.update(self.name, self.data)
+            except Exception as e:
+                print('search index not updated', self.name, e)
+        self.saver._written(self.name, self.data, err)
+
+
+class JsonSaver(QObject):
+    # write-behind for annotations: edits within `delay` ms of each other
+    # collapse into one store write (and search index update), done on a
+    # single background thread so writes to the same image stay in order
+    saved = pyqtSignal(str)
+    failed = pyqtSignal(str, str)
+
+    def __init__(self, store=None, delay=500, parent=None):
+        super().__init__(parent)
+
+        self.store = store
+        self.index = None       # search.SearchIndex kept up to date with the writes
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self.flush)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        # one long lived writer thread, a SqliteStore keeps a connection per thread
+        self._pool.setExpiryTimeout(-1)
+
+        self._lock = threading.Lock()
+        self._pending = {}      # name -> data, not handed to the writer yet
+        self._inflight = {}     # name -> data, being written
+
+        self.n_requests = 0
+        self.n_writes = 0
+
+    def set_store(self, store):
+        self.flush(wait=True)
+        self.store = store
+
+    def set_index(self, index):
+        self.flush(wait=True)
+        self.index = index
+
+    def schedule(self, name, data):
+        with self._lock:
+            self._pending[name] = dict(data)
+        self.n_requests += 1
+        self._timer.start()
+
+    def latest(self, name):
+        # data not in the store yet, if any. loads must prefer it
+        with self._lock:
+            if name in self._pending:
+                return self._pending[name]
+            return self._inflight.get(name)
+
+    def flush(self, wait=False):
+        self._timer.stop()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._inflight.update(pending)
+        for name, data in pending.items():
+            self._pool.start(_WriteTask(self, name, data))
+        if wait:
+            self._pool.waitForDone()
+
+    def _written(self, name, data, err):
+        with self._lock:
+            if self._inflight.get(name) is data:
+                del self._inflight[name]
+            if not err:
+                self.n_writes += 1
+        if err:
+            print('save failed', name, err)
+            self.failed.emit(name, err)
+        else:
+            self.saved.emit(name)
+
+    def stats(self):
+        return {'requests': self.n_requests, 'writes': self.n_writes}
@@ -0,0 +1,212 @@
+import threading
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImageReader
+
+import instrument
+from tiledimage import can_tile
+
+
+def read_image(path, max_pixels=None):
+    # QImage (unlike QPixmap) may be created off the GUI thread. images over
+    # max_pixels are not decoded at all (None), the viewer tiles those itself.
+    # formats it can not tile are always decoded whole
+    reader = QImageReader(path)
+    if max_pixels and can_tile(reader):
+        size = reader.size()
+        if size.width() * size.height() > max_pixels:
+            return None
+    with instrument.span('decode'):
+        img = reader.read()
+    if img.isNull():
+        print('decode failed', path, reader.errorString())
+    return img
+
+
+class _DecodeTask(QRunnable):
+
+    def __init__(self, prefetcher, img_file, load_fn):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.prefetcher = prefetcher
+        self.img_file = img_file
+        self.load_fn = load_fn
+        self.result = None
+        self.finished = threading.Event()
+
+    def run(self):
+        img = read_image(self.img_file, self.prefetcher.max_pixels)
+        data = self.load_fn(self.img_file) if self.load_fn else None
+        # take() may be waiting for it on the GUI thread
+        self.result = (img, data)
+        self.finished.set()
+        self.prefetcher._decoded.emit(self)
+
+
+class ImagePrefetcher(QObject):
+    # decoded images plus their annotations (load_fn runs on the worker too).
+    # the cache itself is only touched on the GUI thread, workers hand their
+    # results over through a queued signal
+    _decoded = pyqtSignal(object)   # _DecodeTask
+
+    def __init__(self, ahead=3, behind=1, budget_mb=512, workers=2, max_pixels=None, parent=None):
+        super().__init__(parent)
+
+        self.max_pixels = max_pixels
+        self.ahead = ahead
+        self.behind = behind
+        self.budget = budget_mb * 1024 * 1024
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(workers)
+        # workers read annotations too, a SqliteStore keeps a connection per thread
+        self._pool.setExpiryTimeout(-1)
+        self._decoded.connect(self._slot_decoded)
+
+        self._cache = OrderedDict()     # img_file -> [QImage, json data, bytes]
+        self._inflight = {}             # img_file -> _DecodeTask
+        self._stale = set()             # in flight, their json was read before a write
+        self._bytes = 0
+        self._images_list = None
+        self._order = {}                # img_file -> position in the current list
+        self._index = 0
+        self._direction = 1
+
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, img_file, load_fn=None):
+        # (QImage, json data) for img_file, decoded now if it was not prefetched.
+        # the image is None when it is over max_pixels
+        entry = self._cache.get(img_file)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(img_file)
+            return entry[0], entry[1]
+
+        self.misses += 1
+        task = self._inflight.pop(img_file, None)
+        if task is not None and not self._pool.tryTake(task):
+            # already decoding, wait for it rather than decoding it twice
+            task.finished.wait()
+            img, data = task.result
+            if img_file in self._stale:
+                self._stale.discard(img_file)
+                data = None
+        else:
+            self._stale.discard(img_file)
+            img = read_image(img_file, self.max_pixels)
+            data = load_fn(img_file) if load_fn else None
+        self._insert(img_file, img, data)
+        return img, data
+
+    def update(self, index, images_list, load_fn=None):
+        # called on every navigation, queues the neighbours in the walking direction first
+        if index != self._index:
+            self._direction = 1 if index > self._index else -1
+        self._index = index
+        if images_list is not self._images_list or len(images_list) != len(self._order):
+            self._images_list = images_list
+            self._order = {f: i for i, f in enumerate(images_list)}
+
+        d = self._direction
+        ahead = [index + d * i for i in range(1, self.ahead + 1)]
+        behind = [index - d * i for i in range(1, self.behind + 1)]
+        for i in ahead + behind:
+            if not 0 <= i < len(images_list):
+                continue
+            img_file = images_list[i]
+            if img_file in self._cache or img_file in self._inflight:
+                continue
+            task = self._inflight[img_file] = _DecodeTask(self, img_file, load_fn)
+            self._pool.start(task)
+
+    def extend(self, img_files):
+        # the list grew in place (scan batches), positions of the new ones
+        if self._images_list is not None:
+            n = len(self._order)
+            self._order.update((f, n + i) for i, f in enumerate(img_files))
+
+    def set_json(self, img_file, data):
+        # keep preloaded annotations in step with what was just saved
+        entry = self._cache.get(img_file)
+        if entry is not None:
+            entry[1] = data
+        if img_file in self._inflight:
+            self._stale.add(img_file)
+
+    def drop_json(self, img_files=None):
+        # the store wrote these (None: any), preloaded annotations may be older.
+        # decoded images stay, take() then gives no json and it is read again
+        for img_file, entry in self._cache.items():
+            if img_files is None or img_file in img_files:
+                entry[1] = None
+        self._stale.update(self._inflight if img_files is None else self._inflight.keys() & set(img_files))
+
+    def invalidate(self, img_file):
+        entry = self._cache.pop(img_file, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def clear(self):
+        self._pool.clear()
+        self._cache.clear()
+        self._inflight.clear()
+        self._stale.clear()
+        self._images_list = None
+        self._order = {}
+        self._bytes = 0
+
+    def _slot_decoded(self, task):
+        img_file = task.img_file
+        if self._inflight.get(img_file) is not task:
+            # cleared or taken meanwhile
+            return
+        del self._inflight[img_file]
+        img, data = task.result
+        if img_file in self._stale:
+            self._stale.discard(img_file)
+            data = None
+        if img is None or not img.isNull():
+            self._insert(img_file, img, data)
+
+    def _insert(self, img_file, img, data):
+        self.invalidate(img_file)
+        nbytes = img.byteCount() if img is not None else 0
+        self._cache[img_file] = [img, data, nbytes]
+        self._bytes += nbytes
+        self._evict(keep=img_file)
+
+    def _evict(self, keep):
+        if self._bytes <= self.budget:
+            return
+
+        # drop what is furthest away first, images behind the walking direction
+        # count double since we are less likely to go back to them
+        def cost(img_file):
+            pos = self._order.get(img_file)
+            if pos is None:
+                return float('inf')
+            delta = (pos - self._index) * self._direction
+            return delta if delta >= 0 else -2 * delta
+
+        for img_file in sorted(self._cache, key=cost, reverse=True):
+            if self._bytes <= self.budget:
+                break
+            if img_file != keep:
+                self.invalidate(img_file)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'cached': len(self._cache),
+            'mb': self._bytes / (1024 * 1024),
+        }
+
+    def shutdown(self, msecs=3000):
+        self._pool.clear()
+        self._pool.waitForDone(msecs)
@@ -0,0 +1,145 @@
+# crops are prepared for OCR on the worker thread, between the viewer and the
+# engine:
+#
+#   rgb       alpha dropped
+#   deskew    (optional) small rotations of the text undone
+#   layout    text rows counted from the ink profile, empty margins trimmed
+#   resize    one line: to the recognizer's input height. several lines: so
+#             a line is about DET_LINE_HEIGHT px, long side capped
+#   binarize  (optional) Otsu
+#   pad       a white border, recognizers clip glyphs touching the edge
+#
+# a single line then only goes through the recognizer, several lines through
+# detection + recognition. every stage is timed.
+
+import time
+
+import numpy as np
+
+
+DET_LINE_HEIGHT = 32
+
+
+class CropPipeline:
+
+    def __init__(self, rec_height=48, max_side=1600, deskew=False, binarize=False, pad=8):
+        self.rec_height = rec_height
+        self.max_side = max_side
+        self.deskew = deskew
+        self.binarize = binarize
+        self.pad = pad
+
+    def config_key(self):
+        # what changes the OCR result, part of the OCR cache key
+        return 'h{} max{}{}{} pad{}'.format(self.rec_height, self.max_side, ' deskew' if self.deskew else '',
+                                            ' binarize' if self.binarize else '', self.pad)
+
+    def run(self, img):
+        # -> (prepared image, single line, info). info has the per stage ms
+        # under 'ms' and what to_crop() needs to map results back
+        import cv2
+        ms = {}
+        t = time.perf_counter()
+
+        def lap(stage):
+            nonlocal t
+            now = time.perf_counter()
+            ms[stage] = (now - t) * 1000
+            t = now
+
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        elif img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
+        lap('rgb')
+
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        if self.deskew:
+            img, gray = self._deskew(img, gray)
+            lap('deskew')
+
+        rows = text_rows(gray)
+        single = len(rows) <= 1 and img.shape[1] >= img.shape[0]
+        y0 = 0
+        if rows:
+            # vertical margins trimmed to a fifth of a line
+            line_h = int(np.median([b - a for a, b in rows]))
+            y0 = max(0, rows[0][0] - line_h // 5)
+            y1 = min(img.shape[0], rows[-1][1] + line_h // 5)
+            img, gray = img[y0:y1], gray[y0:y1]
+        else:
+            line_h = img.shape[0]
+        lap('layout')
+
+        h, w = img.shape[:2]
+        if single:
+            scale = self.rec_height / max(h, 1)
+        else:
+            scale = DET_LINE_HEIGHT / max(line_h, 1)
+        scale = min(scale, self.max_side / max(h, w, 1))
+        if abs(scale - 1) > 0.05:
+            size = (max(1, round(w * scale)), max(1, round(h * scale)))
+            interp = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+            img = cv2.resize(img, size, interpolation=interp)
+            gray = cv2.resize(gray, size, interpolation=interp) if self.binarize else gray
+        else:
+            scale = 1.0
+        lap('resize')
+
+        if self.binarize:
+            _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            img = cv2.cvtColor(bw, cv2.COLOR_GRAY2RGB)
+            lap('binarize')
+
+        if self.pad:
+            img = cv2.copyMakeBorder(img, self.pad, self.pad, self.pad, self.pad,
+                                     cv2.BORDER_CONSTANT, value=(255, 255, 255))
+        lap('pad')
+
+        return img, single, {'ms': ms, 'scale': scale, 'pad': self.pad, 'y0': y0}
+
+    def _deskew(self, img, gray):
+        import cv2
+        ink = np.column_stack(np.nonzero(gray < ink_threshold(gray)))
+        if len(ink) < 20:
+            return img, gray
+        angle = cv2.minAreaRect(ink[:, ::-1].astype(np.float32))[2]
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        if not 0.3 < abs(angle) < 15:
+            return img, gray
+        h, w = gray.shape
+        m = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+        img = cv2.warpAffine(img, m, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        gray = cv2.warpAffine(gray, m, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return img, gray
+
+
+def ink_threshold(gray):
+    # between paper and ink, cheap stand-in for Otsu
+    return (int(gray.min()) + int(np.median(gray))) // 2
+
+
+def text_rows(gray, min_height=3):
+    # [(y0, y1)] of the rows of text, from the share of ink per pixel row
+    if gray.size == 0:
+        return []
+    step = max(1, max(gray.shape) // 800)
+    small = gray[::step, ::step]
+    ink = (small < ink_threshold(small)).mean(axis=1) > 0.01
+    edges = np.diff(np.concatenate(([0], ink.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    keep = (ends - starts) * step >= min_height
+    return [(int(a) * step, int(b) * step) for a, b in zip(starts[keep], ends[keep])]
+
+
+def to_crop(result, info):
+    # polygons of a result on the prepared image -> pixels of the original crop
+    # (a deskew rotation is not undone, it is at most a few degrees)
+    from ocrengine import OcrResult
+    s, pad, y0 = info['scale'], info['pad'], info['y0']
+    return OcrResult(([[(x - pad) / s, (y - pad) / s + y0] for x, y in poly], text, conf)
+                     for poly, text, conf in result)
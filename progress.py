@@ -0,0 +1,291 @@
+import bisect
+from collections import Counter
+
+from PyQt5.QtCore import QObject, QThread, pyqtSignal
+
+from annostore import split_meta
+from imagelist import natural_key
+
+
+UNLABELED = 'unlabeled'
+PARTIAL = 'partial'
+LABELED = 'labeled'
+STATES = (UNLABELED, PARTIAL, LABELED)
+
+# the "Next todo" target going through the OCR values by confidence
+REVIEW = 'review'
+
+# OCR confidence of a value: below LOW_CONF it is likely wrong, below
+# HIGH_CONF worth a second look. the defaults of --conf-low / --conf-high
+LOW_CONF = 0.6
+HIGH_CONF = 0.85
+LOW, MID, HIGH = 'low', 'mid', 'high'
+
+
+def conf_level(conf, low=LOW_CONF, high=HIGH_CONF):
+    if conf is None:
+        return None
+    return HIGH if conf >= high else MID if conf >= low else LOW
+
+
+def summarize(data):
+    # -> (filled keys, blank keys, lowest ocr confidence or None, ((key, confidence), ...))
+    # meta['confidence'] holds the OCR confidence of the values that were
+    # grabbed and not edited or checked since; blank values do not count
+    pairs, meta = split_meta(data)
+    filled = tuple(k for k, v in pairs.items() if str(v).strip())
+    blank = tuple(k for k, v in pairs.items() if not str(v).strip())
+    confs = tuple((k, float(c)) for k, c in (meta.get('confidence') or {}).items()
+                  if str(pairs.get(k, '')).strip())
+    return filled, blank, min(c for _, c in confs) if confs else None, confs
+
+
+def state_of(summary):
+    if summary is None or not summary[0]:
+        return UNLABELED
+    return PARTIAL if summary[1] else LABELED
+
+
+def _key(name):
+    # the name itself breaks ties between names natural_key() folds together
+    return natural_key(name), name
+
+
+class SortedNames:
+    # image names in natural order, lookups and updates by bisection
+
+    def __init__(self, names=()):
+        self.keys = sorted(_key(n) for n in names)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, name):
+        k = _key(name)
+        i = bisect.bisect_left(self.keys, k)
+        if i == len(self.keys) or self.keys[i] != k:
+            self.keys.insert(i, k)
+
+    def discard(self, name):
+        k = _key(name)
+        i = bisect.bisect_left(self.keys, k)
+        if i < len(self.keys) and self.keys[i] == k:
+            del self.keys[i]
+
+    def after(self, name):
+        # first (key, name) sorted after `name`, None at the end
+        i = bisect.bisect_right(self.keys, _key(name))
+        return self.keys[i] if i < len(self.keys) else None
+
+    def first(self):
+        return self.keys[0] if self.keys else None
+
+
+class _Builder(QThread):
+    # reads every annotation once, off the GUI thread
+    built = pyqtSignal(dict, list)
+
+    def __init__(self, store, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        summaries = {}
+        key_order = {}
+        try:
+            for name, data in self.store.items():
+                if self._stop:
+                    return
+                summaries[name] = summarize(data)
+                for k in split_meta(data)[0]:
+                    key_order.setdefault(k)
+        finally:
+            # the store connection of this thread
+            self.store.close()
+        self.built.emit(summaries, list(key_order))
+
+
+class ProgressIndex(QObject):
+    # labeling progress of the whole dataset, built once from the store and
+    # updated on every save. per image only a small summary is kept; the
+    # sorted name lists make "next unlabeled" / "next missing <key>" a bisect.
+    #
+    # an image misses a key when it is unlabeled or has the key left blank,
+    # the kv widget carries the keys over from image to image so annotated
+    # images hardly ever lack one entirely
+    changed = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._builder = None
+        self._summaries = {}    # name -> summarize(), only annotated images
+        self._images = set()
+        self.key_order = []     # every key used, in the order they first show up
+        self.ready = False
+        self._reset()
+
+    def _reset(self):
+        self._sorted = {s: SortedNames() for s in STATES}
+        self._missing = {}      # key -> SortedNames of images with it blank
+        self._fill = Counter()  # key -> images with it filled
+        self._conf = {}         # name -> lowest confidence
+        self._review = []       # (confidence, name, key) of every OCR value, sorted
+
+    def load(self, store):
+        if self._builder is not None:
+            self._builder.stop()
+        self._summaries = {}
+        self.key_order = []
+        self.ready = False
+        self._reset()
+        self._builder = _Builder(store, self)
+        self._builder.built.connect(self._slot_built)
+        self._builder.start()
+
+    def stop(self):
+        if self._builder is not None:
+            self._builder.stop()
+
+    def _slot_built(self, summaries, key_order):
+        # saves made while building are newer than what the builder read
+        summaries.update(self._summaries)
+        self._summaries = summaries
+        self.key_order = key_order
+        self.ready = True
+        self._rebuild()
+
+    def set_images(self, names):
+        self._images = set(names)
+        self._rebuild()
+
+    def _rebuild(self):
+        self._reset()
+        by_state = {s: [] for s in STATES}
+        missing = {}
+        for name in self._images:
+            summary = self._summaries.get(name)
+            by_state[state_of(summary)].append(name)
+            if summary is not None:
+                self._fill.update(summary[0])
+                for k in summary[1]:
+                    missing.setdefault(k, []).append(name)
+                if summary[2] is not None:
+                    self._conf[name] = summary[2]
+                self._review.extend((c, name, k) for k, c in summary[3])
+        self._review.sort()
+        self._sorted = {s: SortedNames(names) for s, names in by_state.items()}
+        self._missing = {k: SortedNames(names) for k, names in missing.items()}
+        self.changed.emit()
+
+    def _count(self, name, sign):
+        summary = self._summaries.get(name)
+        state = self._sorted[state_of(summary)]
+        state.add(name) if sign > 0 else state.discard(name)
+        if summary is None:
+            return
+        for k in summary[0]:
+            self._fill[k] += sign
+        for k in summary[1]:
+            missing = self._missing.setdefault(k, SortedNames())
+            missing.add(name) if sign > 0 else missing.discard(name)
+        if summary[2] is not None:
+            if sign > 0:
+                self._conf[name] = summary[2]
+            else:
+                self._conf.pop(name, None)
+        for k, c in summary[3]:
+            entry = (c, name, k)
+            i = bisect.bisect_left(self._review, entry)
+            if sign > 0:
+                self._review.insert(i, entry)
+            elif i < len(self._review) and self._review[i] == entry:
+                del self._review[i]
+
+    def update(self, name, data):
+        known = name in self._images
+        if known:
+            self._count(name, -1)
+        self._summaries[name] = summarize(data)
+        if known:
+            self._count(name, +1)
+            self.changed.emit()
+
+    def update_many(self, items):
+        # {name: data} a bulk write (schema apply, copy, replace) touched,
+        # instead of reading the whole store again
+        for name, data in items.items():
+            known = name in self._images
+            if known:
+                self._count(name, -1)
+            self._summaries[name] = summarize(data)
+            if known:
+                self._count(name, +1)
+        if items:
+            self.changed.emit()
+
+    def add_images(self, names):
+        for name in names:
+            if name not in self._images:
+                self._images.add(name)
+                self._count(name, +1)
+        self.changed.emit()
+
+    def remove_images(self, names):
+        for name in names:
+            if name in self._images:
+                self._count(name, -1)
+                self._images.discard(name)
+        self.changed.emit()
+
+    def state(self, name):
+        return state_of(self._summaries.get(name))
+
+    def names(self, state):
+        return [k[1] for k in self._sorted[state].keys]
+
+    def counts(self):
+        return {s: len(self._sorted[s]) for s in STATES}
+
+    def keys(self):
+        return sorted(set(self._fill) | {k for k, names in self._missing.items() if len(names)})
+
+    def fill_rates(self):
+        total = len(self._images)
+        return {k: self._fill[k] / total if total else 0.0 for k in self.keys()}
+
+    def mean_confidence(self):
+        return sum(self._conf.values()) / len(self._conf) if self._conf else None
+
+    def review_queue(self, below=HIGH_CONF):
+        # every OCR value under `below` in the dataset, lowest confidence
+        # first: [(confidence, name, key)]
+        return self._review[:bisect.bisect_left(self._review, (below,))]
+
+    def next_review(self, after=None, below=HIGH_CONF):
+        # the entry of review_queue() after `after` (the last one looked at),
+        # wrapping around to the lowest. None if nothing is under `below`.
+        # a bisect into the sorted entries kept up to date by every save
+        i = bisect.bisect_right(self._review, after) if after is not None else 0
+        if i < len(self._review) and self._review[i][0] < below:
+            return self._review[i]
+        if self._review and self._review[0][0] < below:
+            return self._review[0]
+        return None
+
+    def next(self, name, states=(UNLABELED,), missing_key=None):
+        # the next image after `name` in one of `states` (or missing
+        # `missing_key`), wrapping around at the end. None if there is none
+        lists = [self._sorted[s] for s in states]
+        if missing_key is not None:
+            lists = [self._sorted[UNLABELED], self._missing.get(missing_key, SortedNames())]
+        found = [k for k in (l.after(name) for l in lists) if k is not None]
+        if not found:
+            found = [k for k in (l.first() for l in lists) if k is not None]
+        if not found:
+            return None
+        return min(found)[1]
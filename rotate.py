@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+# bake the orientation recorded with R in the GUI into the image files.
+# jpegs are turned losslessly with jpegtran when it is installed, other
+# formats are re-encoded (lossless for png/bmp/tif anyway). the stored
+# orientation is reset and ocr sidecars are turned along, so nothing has to
+# be recomputed.
+#
+#   python3 rotate.py /path/to/images -j 4
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import ocrindex
+from annostore import open_store, split_meta, join_meta
+
+
+JPEG_EXTS = ('.jpg', '.jpeg')
+
+
+def rotate_jpeg_lossless(path, rotation):
+    # False when jpegtran is missing or the size is not a multiple of the MCU
+    if shutil.which('jpegtran') is None:
+        return False
+    tmp = path + '.rot.tmp'
+    ret = subprocess.run(['jpegtran', '-rotate', str(rotation), '-perfect', '-copy', 'all', '-outfile', tmp, path],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if ret.returncode != 0:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+def rotate_reencode(path, rotation):
+    import cv2
+    codes = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError('unreadable')
+    ext = os.path.splitext(path)[1]
+    params = [cv2.IMWRITE_JPEG_QUALITY, 97] if ext.lower() in JPEG_EXTS else []
+    tmp = path + '.rot.tmp' + ext
+    if not cv2.imwrite(tmp, cv2.rotate(img, codes[rotation]), params):
+        raise IOError('write failed')
+    os.replace(tmp, path)
+
+
+def rotate_sidecar(img_file, rotation, size):
+    data = ocrindex.read_sidecar(img_file)
+    if data is None:
+        return
+    index = ocrindex.PageIndex.from_dict(data)
+    w, h = size
+    turned = ocrindex.PageIndex([([ocrindex.to_display(x, y, rotation, w, h) for x, y in poly], text, conf)
+                                 for poly, text, conf in zip(index.polys, index.texts, index.confs)])
+    ocrindex.save_sidecar(img_file, turned)
+
+
+def bake(img_file, rotation, allow_reencode):
+    from PyQt5.QtGui import QImageReader
+    size = QImageReader(img_file).size()
+    was_current = ocrindex.load_sidecar(img_file) is not None
+
+    if img_file.lower().endswith(JPEG_EXTS):
+        if not rotate_jpeg_lossless(img_file, rotation):
+            if not allow_reencode:
+                return 'skipped, no lossless transform (use --allow-reencode)'
+            rotate_reencode(img_file, rotation)
+    else:
+        rotate_reencode(img_file, rotation)
+
+    if was_current:
+        rotate_sidecar(img_file, rotation, (size.width(), size.height()))
+    return None
+
+
+def run(path, workers=4, allow_reencode=False):
+    store = open_store(path)
+
+    todo = []
+    for name in store.names():
+        data = store.get(name)
+        pairs, meta = split_meta(data)
+        if meta.get('rotation') and os.path.exists(os.path.join(path, name)):
+            todo.append((name, meta['rotation']))
+    print('{} images to rotate'.format(len(todo)))
+
+    def one(job):
+        name, rotation = job
+        try:
+            return name, bake(os.path.join(path, name), rotation, allow_reencode)
+        except Exception as e:
+            return name, str(e)
+
+    t0 = time.perf_counter()
+    n_done = 0
+    with ThreadPoolExecutor(workers) as pool:
+        for name, err in pool.map(one, todo):
+            if err:
+                print(name, err)
+                continue
+            # reread, the GUI may have saved meanwhile
+            pairs, meta = split_meta(store.get(name))
+            meta.pop('rotation', None)
+            store.put(name, join_meta(pairs, meta))
+            n_done += 1
+
+    print('rotated {} of {} images in {:.1f}s'.format(n_done, len(todo), time.perf_counter() - t0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='apply recorded orientations to the image files')
+    parser.add_argument('path', help='image dir')
+    parser.add_argument('-j', '--workers', type=int, default=4)
+    parser.add_argument('--allow-reencode', action='store_true',
+                        help='re-encode jpegs that cannot be turned losslessly')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+    run(args.path, args.workers, args.allow_reencode)
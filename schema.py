@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+# the keys every image of a dataset is labeled with, in order, optionally
+# typed and checked by a regex. kept in <dataset>/schema.json:
+#
+#   {"keys": [{"name": "invoice_no", "pattern": "^[A-Z]{2}\\d+$"},
+#             {"name": "date", "type": "date"},
+#             {"name": "total", "type": "float"}]}
+#
+#   python3 schema.py init /path/to/images     keys found in the annotations -> schema.json
+#   python3 schema.py apply /path/to/images    blank template for every unlabeled image
+
+import os
+import re
+import sys
+import json
+import time
+import datetime
+import argparse
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from annostore import open_store, split_meta, join_meta, atomic_write_json
+from imagelist import list_images
+
+
+SCHEMA_NAME = 'schema.json'
+
+
+def _is_int(v):
+    int(v)
+
+
+def _is_float(v):
+    float(v.replace(',', ''))
+
+
+def _is_date(v):
+    datetime.date.fromisoformat(v)
+
+
+TYPES = {'str': None, 'int': _is_int, 'float': _is_float, 'date': _is_date}
+
+
+class Field:
+
+    def __init__(self, name, type='str', pattern=None):
+        if type not in TYPES:
+            raise ValueError('unknown type {!r} of key {!r}'.format(type, name))
+        self.name = name
+        self.type = type
+        self.pattern = pattern
+        self._regex = re.compile(pattern) if pattern else None
+
+    def validate(self, value):
+        # None when fine (blank is fine, it is just not filled yet), else why not
+        value = str(value).strip()
+        if not value:
+            return None
+        check = TYPES[self.type]
+        if check is not None:
+            try:
+                check(value)
+            except ValueError:
+                return 'not a {}'.format(self.type)
+        if self._regex is not None and not self._regex.search(value):
+            return 'does not match {}'.format(self.pattern)
+        return None
+
+    def to_dict(self):
+        d = {'name': self.name}
+        if self.type != 'str':
+            d['type'] = self.type
+        if self.pattern:
+            d['pattern'] = self.pattern
+        return d
+
+
+class Schema:
+    # `inferred` when there is no schema.json and the keys come from the
+    # annotations, such a schema grows with every key added in the GUI
+
+    def __init__(self, fields=(), inferred=False):
+        self.fields = []
+        self._by_name = {}
+        self.inferred = inferred
+        for f in fields:
+            self.add(f)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, key):
+        return key in self._by_name
+
+    def add(self, field):
+        if field.name not in self._by_name:
+            self._by_name[field.name] = field
+            self.fields.append(field)
+
+    def extend(self, keys):
+        for k in keys:
+            if k not in self._by_name:
+                self.add(Field(k))
+
+    def keys(self):
+        return [f.name for f in self.fields]
+
+    def field(self, key):
+        return self._by_name.get(key)
+
+    def validate(self, key, value):
+        f = self._by_name.get(key)
+        return f.validate(value) if f is not None else None
+
+    def template(self):
+        return {f.name: '' for f in self.fields}
+
+    def apply(self, pairs):
+        # schema keys first and in order, keys only this image has after them
+        rev = {f.name: pairs.get(f.name, '') for f in self.fields}
+        for k, v in pairs.items():
+            if k not in rev:
+                rev[k] = v
+        return rev
+
+    def copy(self):
+        return Schema(self.fields, self.inferred)
+
+    def to_dict(self):
+        return {'keys': [f.to_dict() for f in self.fields]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(Field(k['name'], k.get('type', 'str'), k.get('pattern')) for k in d.get('keys', []))
+
+
+def schema_path(image_path):
+    return os.path.join(image_path, SCHEMA_NAME)
+
+
+def load_schema(image_path):
+    # None when the dataset has no schema.json
+    try:
+        with open(schema_path(image_path)) as f:
+            return Schema.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+        # broken json, a key without a name, a bad pattern...
+        print('bad schema', schema_path(image_path), repr(e))
+        return None
+
+
+def save_schema(image_path, schema):
+    atomic_write_json(schema_path(image_path), schema.to_dict())
+
+
+def infer_schema(store):
+    # keys in the order they first show up
+    schema = Schema(inferred=True)
+    for _, data in store.items():
+        schema.extend(split_meta(data)[0])
+    return schema
+
+
+def apply_to_unlabeled(store, names, schema, batch=500, stop=None, progress=None):
+    # write the blank template for every image without a filled value, in
+    # batches of one transaction each. -> {name: data} written
+    written = {}
+    chunk = []
+
+    def write():
+        nonlocal chunk
+        store.put_many(chunk)
+        written.update(chunk)
+        chunk = []
+
+    for i, name in enumerate(names):
+        if stop is not None and stop():
+            break
+        pairs, meta = split_meta(store.get(name))
+        if any(str(v).strip() for v in pairs.values()):
+            continue
+        template = schema.apply(pairs)
+        if template != pairs:
+            chunk.append((name, join_meta(template, meta)))
+        if len(chunk) >= batch:
+            write()
+            if progress is not None:
+                progress(i + 1, len(names))
+    if chunk:
+        write()
+    return written
+
+
+class ApplySchemaTask(QThread):
+    # apply_to_unlabeled() off the GUI thread
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(dict)     # name -> data written
+
+    def __init__(self, store, names, schema, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.names = names
+        self.schema = schema
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            written = apply_to_unlabeled(self.store, self.names, self.schema,
+                                         stop=lambda: self._stop, progress=self.progress.emit)
+        finally:
+            self.store.close()
+        print('schema applied to {} images in {:.1f}s'.format(len(written), time.perf_counter() - t0))
+        self.done.emit(written)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dataset key schema')
+    parser.add_argument('action', choices=('init', 'apply'))
+    parser.add_argument('path', help='image dir')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+
+    store = open_store(args.path)
+    t0 = time.perf_counter()
+    if args.action == 'init':
+        if os.path.exists(schema_path(args.path)):
+            print(schema_path(args.path), 'already exists')
+            sys.exit(1)
+        schema = infer_schema(store)
+        save_schema(args.path, schema)
+        print('{} keys written to {}'.format(len(schema), schema_path(args.path)))
+    else:
+        schema = load_schema(args.path) or infer_schema(store)
+        names = [os.path.basename(f) for f in list_images(args.path)]
+        written = apply_to_unlabeled(store, names, schema)
+        print('template written for {} images in {:.1f}s'.format(len(written), time.perf_counter() - t0))
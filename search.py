@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+
+# full text search over the key/value pairs of a whole dataset, to check that
+# a value is spelled the same everywhere and to fix it where it is not.
+#
+#   index     ~/.cache/label_it/search/<dir hash>.db, one row per filled pair
+#             plus an FTS5 trigram index of the values (plain LIKE scans when
+#             the sqlite has no FTS5). kept current on every save, and synced
+#             with the store at startup by the store's change stamp of every
+#             image (sqlite write time, json mtime + size), so only images
+#             written since the last sync are read again
+#   search    by key, value substring (trigram index) or fuzzy (candidates
+#             sharing trigrams, ranked by difflib)
+#   replace   every match in one store transaction, the index in one too
+#
+#   python3 search.py /path/to/images "general hosp"
+#   python3 search.py /path/to/images "Gen. Hospital" --key hospital --fuzzy
+#   python3 search.py /path/to/images --key hospital --values
+#   python3 search.py /path/to/images "Gen. Hospital" --key hospital --replace "General Hospital" --whole
+
+import os
+import sys
+import json
+import time
+import re
+import difflib
+import hashlib
+import sqlite3
+import argparse
+import threading
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+from annostore import open_store, split_meta, join_meta
+from cachedir import CACHE_DIR
+
+
+SEARCH_DIR = os.path.join(CACHE_DIR, 'search')
+
+SUBSTRING = 'substring'
+FUZZY = 'fuzzy'
+EXACT = 'exact'
+MODES = (SUBSTRING, FUZZY, EXACT)
+
+FUZZY_CUTOFF = 0.6
+
+
+def index_file(image_path):
+    h = hashlib.sha1(os.path.abspath(image_path).encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(SEARCH_DIR, h + '.db')
+
+
+def digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def filled_pairs(data):
+    # the pairs worth finding, meta and blanks left out
+    pairs, _ = split_meta(data)
+    return [(k, str(v)) for k, v in pairs.items() if str(v).strip()]
+
+
+def trigrams(text):
+    text = text.lower()
+    return sorted({text[i:i + 3] for i in range(len(text) - 2)})
+
+
+class SearchIndex:
+    # one connection per thread like SqliteStore, the GUI updates it on save
+    # while a SearchBuildTask syncs it in the background
+
+    def __init__(self, image_path, db_path=None):
+        if db_path is None:
+            os.makedirs(SEARCH_DIR, exist_ok=True)
+            db_path = index_file(image_path)
+        self.db_path = db_path
+        self._local = threading.local()
+        # names indexed from a save, a running sync must not overwrite them
+        # with what it read from the store earlier
+        self._lock = threading.Lock()
+        self._touched = set()
+
+        with self._conn() as conn:
+            # stamp: the store's change marker the data was read at, NULL
+            # when indexed from a save (read once more by the next sync)
+            conn.execute('CREATE TABLE IF NOT EXISTS docs (name TEXT PRIMARY KEY, digest TEXT NOT NULL, stamp TEXT)')
+            if 'stamp' not in [r[1] for r in conn.execute('PRAGMA table_info(docs)')]:
+                conn.execute('ALTER TABLE docs ADD COLUMN stamp TEXT')
+            conn.execute('CREATE TABLE IF NOT EXISTS pairs ('
+                         'id INTEGER PRIMARY KEY, name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pairs_name ON pairs (name)')
+            conn.execute('CREATE INDEX IF NOT EXISTS pairs_key_value ON pairs (key, value)')
+        try:
+            with self._conn() as conn:
+                # external content: the values are stored once, in pairs
+                conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pairs_fts USING fts5("
+                             "value, content='pairs', content_rowid='id', tokenize='trigram')")
+                conn.execute('CREATE TRIGGER IF NOT EXISTS pairs_ai AFTER INSERT ON pairs BEGIN '
+                             'INSERT INTO pairs_fts (rowid, value) VALUES (new.id, new.value); END')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS pairs_ad AFTER DELETE ON pairs BEGIN '
+                             "INSERT INTO pairs_fts (pairs_fts, rowid, value) VALUES ('delete', old.id, old.value); END")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print('no fts5 trigram index, searching by scan:', e)
+            self.fts = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # only a cache of the store, a lost commit is redone by the next sync
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def _write(self, conn, items, stamps=None):
+        stamps = stamps or {}
+        for name, data in items:
+            conn.execute('DELETE FROM pairs WHERE name = ?', (name,))
+            if data is None:
+                conn.execute('DELETE FROM docs WHERE name = ?', (name,))
+                continue
+            conn.executemany('INSERT INTO pairs (name, key, value) VALUES (?, ?, ?)',
+                             ((name, k, v) for k, v in filled_pairs(data)))
+            conn.execute('INSERT OR REPLACE INTO docs (name, digest, stamp) VALUES (?, ?, ?)',
+                         (name, digest(data), stamps.get(name)))
+
+    def update(self, name, data):
+        self.update_many([(name, data)])
+
+    def update_many(self, items):
+        # data None drops the image
+        items = list(items)
+        with self._lock:
+            self._touched.update(name for name, _ in items)
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._write(conn, items)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def sync(self, store, batch=500, stop=None, progress=None):
+        # reindex what the store wrote since the last run, by its change
+        # stamps: an unchanged dataset costs one listing, no annotation is
+        # read. -> (updated, removed)
+        with self._lock:
+            self._touched.clear()
+        conn = self._conn()
+        known = {name: (d, s) for name, d, s in conn.execute('SELECT name, digest, stamp FROM docs')}
+        stamps = store.stamps()
+        todo = [name for name, stamp in stamps.items() if name not in known or known[name][1] != stamp]
+        chunk = []          # (name, data), data None drops it
+        restamp = []        # (stamp, name) of images written with the same content
+        n = 0
+
+        def write():
+            nonlocal n, chunk, restamp
+            # the write lock first, then the check: a save either landed
+            # before (and is skipped here) or waits for this batch
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                with self._lock:
+                    touched = set(self._touched)
+                chunk = [(name, data) for name, data in chunk if name not in touched]
+                self._write(conn, chunk, stamps)
+                conn.executemany('UPDATE docs SET stamp = ? WHERE name = ?',
+                                 [(s, name) for s, name in restamp if name not in touched])
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            n += len(chunk)
+            chunk = []
+            restamp = []
+
+        for i, name in enumerate(todo):
+            if stop is not None and stop():
+                break
+            # the stamp was taken before this read, a write in between is
+            # only found again next time
+            data = store.get(name)
+            if data is None:
+                continue
+            if name in known and known[name][0] == digest(data):
+                restamp.append((stamps[name], name))
+            else:
+                chunk.append((name, data))
+            if len(chunk) + len(restamp) >= batch:
+                write()
+                if progress is not None:
+                    progress(i + 1, len(todo))
+        else:
+            chunk.extend((name, None) for name in known if name not in stamps)
+        removed = sum(1 for _, data in chunk if data is None)
+        if chunk or restamp:
+            write()
+        return n - removed, removed
+
+    def keys(self):
+        return [r[0] for r in self._conn().execute('SELECT DISTINCT key FROM pairs ORDER BY key')]
+
+    def counts(self):
+        # -> (images, pairs) indexed
+        conn = self._conn()
+        return (conn.execute('SELECT count(*) FROM docs').fetchone()[0],
+                conn.execute('SELECT count(*) FROM pairs').fetchone()[0])
+
+    def search(self, text, key=None, mode=SUBSTRING, limit=1000):
+        # -> [(name, key, value)], fuzzy ones closest first. no text finds
+        # every value of the key. limit None for all of them
+        limit = -1 if limit is None else limit
+        where, args = [], []
+        if key:
+            where.append('p.key = ?')
+            args.append(key)
+
+        if not text:
+            if not key:
+                return []
+            sql = 'SELECT p.name, p.key, p.value FROM pairs p WHERE {} ORDER BY p.name LIMIT ?'
+        elif mode == EXACT:
+            where.append('p.value = ?')
+            args.append(text)
+            sql = 'SELECT p.name, p.key, p.value FROM pairs p WHERE {} ORDER BY p.name LIMIT ?'
+        elif mode == FUZZY:
+            return self._fuzzy(text, key, limit)
+        elif self.fts and len(text) >= 3 and '%' not in text and '_' not in text:
+            # the trigram index serves LIKE, but neither an ESCAPE clause nor
+            # patterns under three characters
+            where.append('pairs_fts.value LIKE ?')
+            args.append('%' + text + '%')
+            sql = ('SELECT p.name, p.key, p.value FROM pairs_fts JOIN pairs p ON p.id = pairs_fts.rowid '
+                   'WHERE {} ORDER BY p.name LIMIT ?')
+        else:
+            where.append("p.value LIKE ? ESCAPE '\\'")
+            args.append('%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            sql = 'SELECT p.name, p.key, p.value FROM pairs p WHERE {} ORDER BY p.name LIMIT ?'
+        return self._conn().execute(sql.format(' AND '.join(where)), args + [limit]).fetchall()
+
+    def _fuzzy(self, text, key, limit, cutoff=FUZZY_CUTOFF, candidates=2000):
+        conn = self._conn()
+        grams = trigrams(text)
+        if self.fts and grams:
+            # values sharing the most trigrams with the text, best first by bm25
+            match = ' OR '.join('"{}"'.format(g.replace('"', '""')) for g in grams)
+            sql = ('SELECT DISTINCT p.value FROM pairs_fts JOIN pairs p ON p.id = pairs_fts.rowid '
+                   'WHERE pairs_fts MATCH ?{} ORDER BY rank LIMIT ?').format(' AND p.key = ?' if key else '')
+            values = [r[0] for r in conn.execute(sql, [match] + ([key] if key else []) + [candidates])]
+        else:
+            sql = 'SELECT DISTINCT value FROM pairs' + (' WHERE key = ?' if key else '')
+            values = [r[0] for r in conn.execute(sql, [key] if key else [])]
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(text.lower())
+        scored = []
+        for v in values:
+            matcher.set_seq1(v.lower())
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                score = matcher.ratio()
+                if score >= cutoff:
+                    scored.append((score, v))
+        scored.sort(key=lambda s: -s[0])
+
+        rows = []
+        for _, v in scored:
+            rows.extend(self.search(v, key, EXACT, limit - len(rows) if limit >= 0 else None))
+            if 0 <= limit <= len(rows):
+                break
+        return rows
+
+    def values(self, key=None, limit=1000):
+        # -> [(value, key, images)], the spellings in use, most used first
+        sql = 'SELECT value, key, count(*) FROM pairs {} GROUP BY key, value ORDER BY count(*) DESC, value LIMIT ?'
+        args = [key, limit] if key else [limit]
+        return self._conn().execute(sql.format('WHERE key = ?' if key else ''), args).fetchall()
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def replacer(find, repl, whole=False):
+    # -> fn(value) -> the replaced value. the case rule of the search it
+    # replaces in: a whole value is compared exactly, substrings (LIKE and the
+    # trigram index) ignore case. values go by their text, as indexed
+    if whole:
+        return lambda v: repl if str(v) == find else v
+    pattern = re.compile(re.escape(find), re.IGNORECASE)
+    return lambda v: pattern.sub(lambda m: repl, str(v))
+
+
+def replace_hits(index, find, repl, key=None, whole=False):
+    # -> [(name, key, value)] replace_values() would change
+    rule = replacer(find, repl, whole)
+    return [(name, k, v) for name, k, v in index.search(find, key, EXACT if whole else SUBSTRING, limit=None)
+            if rule(v) != v]
+
+
+def replace_values(store, index, find, repl, key=None, whole=False, stop=None):
+    # find -> repl in the values of `key` (every key if None), the whole value
+    # or every occurrence in it. all images are written in one put_many, all
+    # or nothing, then reindexed. a replaced value is checked by a human, its
+    # OCR confidence goes like on an edit. -> {name: data} of the images changed
+    rule = replacer(find, repl, whole)
+    names = sorted({name for name, _, _ in replace_hits(index, find, repl, key, whole)})
+    changed = []
+    for name in names:
+        if stop is not None and stop():
+            return {}
+        pairs, meta = split_meta(store.get(name))
+        confidence = dict(meta.get('confidence') or {})
+        hit = False
+        for k, v in pairs.items():
+            if key and k != key or not str(v).strip():
+                continue
+            new = rule(v)
+            if new != v and new != str(v):
+                pairs[k] = new
+                confidence.pop(k, None)
+                hit = True
+        if not hit:
+            continue
+        meta = dict(meta, confidence=confidence)
+        if not confidence:
+            del meta['confidence']
+        changed.append((name, join_meta(pairs, meta)))
+    if changed:
+        store.put_many(changed)
+        index.update_many(changed)
+    return dict(changed)
+
+
+class SearchBuildTask(QThread):
+    # SearchIndex.sync() off the GUI thread
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(int, int)     # updated, removed
+
+    def __init__(self, index, store, parent=None):
+        super().__init__(parent)
+        self.index = index
+        self.store = store
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            updated, removed = self.index.sync(self.store, stop=lambda: self._stop, progress=self.progress.emit)
+        finally:
+            # the connections of this thread
+            self.index.close()
+            self.store.close()
+        print('search index: {} images reindexed, {} dropped in {:.1f}s'.format(
+            updated, removed, time.perf_counter() - t0))
+        self.done.emit(updated, removed)
+
+
+class ReplaceTask(QThread):
+    # replace_values() off the GUI thread
+    done = pyqtSignal(dict)     # name -> data written
+
+    def __init__(self, store, index, find, repl, key=None, whole=False, parent=None):
+        super().__init__(parent)
+        self.store = store
+        self.index = index
+        self.args = (find, repl, key, whole)
+        self._stop = False
+
+    def stop(self):
+        self._stop = True
+        self.wait()
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            written = replace_values(self.store, self.index, *self.args, stop=lambda: self._stop)
+        except Exception as e:
+            print('replace failed, nothing written:', e)
+            written = {}
+        self.index.close()
+        self.store.close()
+        print('replaced in {} images in {:.1f}s'.format(len(written), time.perf_counter() - t0))
+        self.done.emit(written)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='search the annotation values of a dataset dir')
+    parser.add_argument('path', help='image dir')
+    parser.add_argument('text', nargs='?', default='')
+    parser.add_argument('--key', default=None, help='only values of this key')
+    parser.add_argument('--fuzzy', action='store_true', help='similar values, not only substrings')
+    parser.add_argument('--exact', action='store_true', help='only values equal to the text')
+    parser.add_argument('--values', action='store_true', help='the distinct values and how many images have them')
+    parser.add_argument('--replace', default=None, metavar='NEW', help='replace the text by NEW in every match')
+    parser.add_argument('--whole', action='store_true', help='with --replace, only values that are the text as a whole')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--store', choices=('json', 'sqlite'), default=None)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.path):
+        print('not a directory', args.path)
+        sys.exit(1)
+
+    store = open_store(args.path, args.store)
+    index = SearchIndex(args.path)
+    t0 = time.perf_counter()
+    updated, removed = index.sync(store)
+    images, pairs = index.counts()
+    print('{} images, {} values indexed ({} reindexed, {} dropped) in {:.1f}s'.format(
+        images, pairs, updated, removed, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    if args.replace is not None:
+        if not args.text:
+            print('nothing to replace')
+            sys.exit(1)
+        names = replace_values(store, index, args.text, args.replace, args.key, args.whole)
+        print('replaced in {} images in {:.1f}ms'.format(len(names), (time.perf_counter() - t0) * 1000))
+        for name in names:
+            print('  ' + name)
+    elif args.values:
+        rows = index.values(args.key, args.limit)
+        print('{} values in {:.1f}ms'.format(len(rows), (time.perf_counter() - t0) * 1000))
+        for value, key, n in rows:
+            print('{:6d}  {}: {}'.format(n, key, value))
+    else:
+        mode = FUZZY if args.fuzzy else EXACT if args.exact else SUBSTRING
+        rows = index.search(args.text, args.key, mode, args.limit)
+        print('{} matches in {:.1f}ms'.format(len(rows), (time.perf_counter() - t0) * 1000))
+        for name, key, value in rows:
+            print('{}  {}: {}'.format(name, key, value))
@@ -0,0 +1,153 @@
+from PyQt5.QtWidgets import QWidget, QLineEdit, QComboBox, QCheckBox, QPushButton, QLabel, QTableWidget, \
+    QTableWidgetItem, QHeaderView, QAbstractItemView, QVBoxLayout, QHBoxLayout
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+
+from search import MODES, EXACT
+
+
+class SearchPanel(QWidget):
+    # a window to search the values of every image, click a hit to open it.
+    # with a key and no text it lists the spellings of that key and how many
+    # images use each, click one to see those images
+    imageChosen = pyqtSignal(str, str)                  # name, key
+    replaceRequested = pyqtSignal(str, str, str, bool)  # find, replace, key ('' for all), whole value
+
+    ALL_KEYS = '(all keys)'
+
+    def __init__(self, index, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle('search')
+        self.resize(640, 560)
+        self.index = index
+        self._values = False    # the table lists distinct values, not images
+
+        self.key_combo = QComboBox()
+        self.key_combo.setMinimumContentsLength(12)
+        self.text_edit = QLineEdit()
+        self.text_edit.setPlaceholderText('value')
+        self.text_edit.setClearButtonEnabled(True)
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItems(MODES)
+
+        self.repl_edit = QLineEdit()
+        self.repl_edit.setPlaceholderText('replace with')
+        self.whole_chk = QCheckBox('whole value')
+        self.whole_chk.setToolTip('only values that are the text as a whole, else every occurrence in them')
+        self.replace_btn = QPushButton('Replace all')
+        self.replace_btn.setToolTip('in every image at once, one transaction')
+        self.replace_btn.clicked.connect(self.slot_replace)
+
+        self.table = QTableWidget(0, 3)
+        self.table.setHorizontalHeaderLabels(['image', 'key', 'value'])
+        self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.cellClicked.connect(self.slot_row_chosen)
+        self.table.cellActivated.connect(self.slot_row_chosen)
+
+        self.info = QLabel()
+
+        # searched while typing, once it pauses
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(150)
+        self._timer.timeout.connect(self.refresh)
+        self.text_edit.textChanged.connect(self._timer.start)
+        self.text_edit.returnPressed.connect(self.refresh)
+        self.key_combo.currentIndexChanged.connect(self.refresh)
+        self.mode_combo.currentIndexChanged.connect(self.refresh)
+
+        find_layout = QHBoxLayout()
+        find_layout.addWidget(self.key_combo)
+        find_layout.addWidget(self.text_edit, 1)
+        find_layout.addWidget(self.mode_combo)
+        replace_layout = QHBoxLayout()
+        replace_layout.addWidget(self.repl_edit, 1)
+        replace_layout.addWidget(self.whole_chk)
+        replace_layout.addWidget(self.replace_btn)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addLayout(find_layout)
+        layout.addWidget(self.table)
+        layout.addLayout(replace_layout)
+        layout.addWidget(self.info)
+
+    def key(self):
+        key = self.key_combo.currentText()
+        return '' if key == self.ALL_KEYS else key
+
+    def set_keys(self, keys):
+        current = self.key()
+        keys = [self.ALL_KEYS] + list(keys)
+        if keys == [self.key_combo.itemText(i) for i in range(self.key_combo.count())]:
+            return
+        self.key_combo.blockSignals(True)
+        self.key_combo.clear()
+        self.key_combo.addItems(keys)
+        self.key_combo.setCurrentIndex(max(self.key_combo.findText(current), 0))
+        self.key_combo.blockSignals(False)
+
+    def set_index(self, index):
+        self.index = index
+        self.refresh()
+
+    def refresh(self):
+        self._timer.stop()
+        text, key = self.text_edit.text(), self.key()
+        limit = 1000
+        self.table.setRowCount(0)
+        if self.index is None:
+            return
+
+        self._values = bool(key and not text)
+        rows = self.index.values(key, limit + 1) if self._values else \
+            self.index.search(text, key, self.mode_combo.currentText(), limit + 1)
+        more = len(rows) > limit
+        rows = rows[:limit]
+
+        self.table.setUpdatesEnabled(False)
+        self.table.setHorizontalHeaderLabels(['images' if self._values else 'image', 'key', 'value'])
+        self.table.setRowCount(len(rows))
+        for r, row in enumerate(rows):
+            if self._values:
+                value, k, n = row
+                row = (str(n), k, value)
+            for c, cell in enumerate(row):
+                self.table.setItem(r, c, QTableWidgetItem(cell))
+        self.table.resizeColumnToContents(0)
+        self.table.setUpdatesEnabled(True)
+
+        if self._values:
+            self.info.setText('{}{} spellings of {}, click one to list its images'.format(
+                len(rows), '+' if more else '', key))
+        elif text or key:
+            self.info.setText('{}{} values in {} images'.format(
+                len(rows), '+' if more else '', len({row[0] for row in rows})))
+        else:
+            images, pairs = self.index.counts()
+            self.info.setText('{} values of {} images indexed'.format(pairs, images))
+
+    def slot_row_chosen(self, row, column):
+        if self._values:
+            # the images with exactly this spelling, ready to be replaced
+            self.mode_combo.setCurrentText(EXACT)
+            self.whole_chk.setChecked(True)
+            self.text_edit.setText(self.table.item(row, 2).text())
+            self.refresh()
+            return
+        self.imageChosen.emit(self.table.item(row, 0).text(), self.table.item(row, 1).text())
+
+    def slot_replace(self):
+        # always the literal text, a fuzzy search only shows what to type here
+        find = self.text_edit.text()
+        if not find:
+            self.info.setText('nothing to replace, type the value to find')
+            return
+        self.replaceRequested.emit(find, self.repl_edit.text(), self.key(), self.whole_chk.isChecked())
+
+    def closeEvent(self, e):
+        # only hidden, typed search and replace stay for the next time
+        self.hide()
+        e.ignore()
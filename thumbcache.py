@@ -0,0 +1,172 @@
+# thumbnails of the dataset images for the grid navigator. made in a process
+# pool, JPEGs decoded at 1/2, 1/4 or 1/8 resolution straight by libjpeg
+# (cv2.IMREAD_REDUCED_COLOR_*), and kept in ~/.cache/label_it/thumbs keyed by
+# path + mtime + size, so a changed file gets a new one and a dataset is only
+# ever thumbnailed once.
+#
+# requests are served newest first and only the last `max_pending` are kept:
+# while scrolling fast through a big dataset, the cells that scrolled out of
+# view long ago are dropped and the visible ones come first. even the check
+# for a thumbnail already on disk runs in the pool, a request costs the
+# caller no file system access
+
+import os
+import struct
+import hashlib
+import threading
+import multiprocessing as mp
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from cachedir import CACHE_DIR
+
+
+THUMB_SIZE = 128
+THUMB_DIR = os.path.join(CACHE_DIR, 'thumbs')
+
+
+def thumb_file(path, size=THUMB_SIZE, st=None):
+    st = st or os.stat(path)
+    key = '{}\0{}\0{}\0{}'.format(os.path.abspath(path), st.st_mtime_ns, st.st_size, size)
+    h = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(THUMB_DIR, h[:2], h + '.jpg')
+
+
+def jpeg_size(path):
+    # (w, h) from the SOF marker without decoding anything, None if not a JPEG
+    try:
+        with open(path, 'rb') as f:
+            if f.read(2) != b'\xff\xd8':
+                return None
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                m = marker[1]
+                if m in (0xd8, 0x01) or 0xd0 <= m <= 0xd7:
+                    continue
+                length = f.read(2)
+                if len(length) < 2:
+                    return None
+                n = struct.unpack('>H', length)[0]
+                if 0xc0 <= m <= 0xcf and m not in (0xc4, 0xc8, 0xcc):
+                    h, w = struct.unpack('>xHH', f.read(5))
+                    return w, h
+                f.seek(n - 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def reduction(w, h, size):
+    # the largest libjpeg scale (1/8, 1/4, 1/2) still at least `size` on the long side
+    for factor in (8, 4, 2):
+        if max(w, h) / factor >= size:
+            return factor
+    return 1
+
+
+def make_thumb(path, out, size=THUMB_SIZE):
+    # runs in the pool. -> out, None when the image can not be read
+    import cv2
+    flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+             4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    dims = jpeg_size(path)
+    img = cv2.imread(path, flags[reduction(*dims, size)] if dims else cv2.IMREAD_COLOR)
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    scale = size / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+    # written aside and renamed, a reader never sees half a file
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    tmp = '{}.{}.tmp.jpg'.format(out[:-4], os.getpid())
+    if not cv2.imwrite(tmp, img, [cv2.IMWRITE_JPEG_QUALITY, 80]):
+        return None
+    os.replace(tmp, out)
+    return out
+
+
+def thumb(path, size=THUMB_SIZE):
+    # runs in the pool. -> (thumb file or None, made now)
+    out = thumb_file(path, size)
+    if os.path.exists(out):
+        return out, False
+    return make_thumb(path, out, size), True
+
+
+class ThumbCache:
+
+    def __init__(self, size=THUMB_SIZE, workers=None, on_ready=None, max_pending=256):
+        # on_ready(path, thumb file or None) is called from a pool thread
+        self.size = size
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.on_ready = on_ready
+        self.max_pending = max_pending
+
+        self._pool = None       # spawned on the first miss
+        self._lock = threading.Lock()
+        self._wanted = OrderedDict()    # path -> None, newest last
+        self._running = {}              # path -> future
+        self._closed = False
+
+        self.disk_hits = 0
+        self.made = 0
+        self.failed = 0
+
+    def request(self, path):
+        # queue a thumbnail, on_ready is called once it exists. cheap enough to
+        # repeat on every repaint until it did
+        with self._lock:
+            if self._closed or path in self._running:
+                return
+            self._wanted[path] = None
+            self._wanted.move_to_end(path)
+            while len(self._wanted) > self.max_pending:
+                self._wanted.popitem(last=False)
+        self._pump()
+
+    def _pump(self):
+        with self._lock:
+            if self._pool is None and self._wanted and not self._closed:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=mp.get_context('spawn'))
+            # a couple in flight per worker, the rest stay reorderable
+            while self._wanted and len(self._running) < self.workers * 2 and not self._closed:
+                path, _ = self._wanted.popitem(last=True)
+                fut = self._pool.submit(thumb, path, self.size)
+                self._running[path] = fut
+                fut.add_done_callback(lambda f, path=path: self._done(path, f))
+
+    def _done(self, path, fut):
+        with self._lock:
+            self._running.pop(path, None)
+            if self._closed:
+                return
+        try:
+            out, made = fut.result()
+        except Exception as e:
+            print('thumbnail failed', path, e)
+            out, made = None, False
+        if out is None:
+            self.failed += 1
+        elif made:
+            self.made += 1
+        else:
+            self.disk_hits += 1
+        if self.on_ready is not None:
+            self.on_ready(path, out)
+        self._pump()
+
+    def stats(self):
+        with self._lock:
+            return {'made': self.made, 'disk_hits': self.disk_hits, 'failed': self.failed,
+                    'queued': len(self._wanted), 'running': len(self._running)}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wanted.clear()
+            pool = self._pool
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,164 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QWidget, QListView, QVBoxLayout, QLabel, QAbstractItemView
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QSize, pyqtSignal
+from PyQt5.QtGui import QPixmap, QColor, QBrush
+
+from thumbcache import ThumbCache, THUMB_SIZE
+from progress import LABELED, PARTIAL
+
+
+class ThumbnailModel(QAbstractListModel):
+    # one row per image. the view only asks for the rows on screen (uniform
+    # item sizes), so only those are ever loaded or requested from the cache
+    _ready = pyqtSignal(str, str)   # path, thumb file ('' when it failed)
+
+    STATE_BRUSH = {LABELED: QBrush(QColor(190, 235, 190)), PARTIAL: QBrush(QColor(250, 235, 170))}
+
+    def __init__(self, size=THUMB_SIZE, pixmaps=1000, parent=None):
+        super().__init__(parent)
+        self.size = size
+        self.max_pixmaps = pixmaps
+        self._files = []
+        self._rows = {}             # path -> row
+        self._pixmaps = OrderedDict()   # path -> QPixmap, LRU
+        self._failed = set()
+        self.state_of = None        # path -> progress state
+        self.name_of = os.path.basename
+
+        self._placeholder = QPixmap(size, size)
+        self._placeholder.fill(QColor(225, 225, 225))
+
+        # the pool calls back on its own thread, the signal brings it over
+        self._ready.connect(self._slot_ready)
+        self.cache = ThumbCache(size, on_ready=lambda path, out: self._ready.emit(path, out or ''))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._files)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self._files[index.row()]
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.DecorationRole:
+            return self._pixmap(path)
+        if role == Qt.ToolTipRole:
+            name = self.name_of(path)
+            return '{} ({})'.format(name, self.state_of(name)) if self.state_of else name
+        if role == Qt.BackgroundRole and self.state_of is not None:
+            return self.STATE_BRUSH.get(self.state_of(self.name_of(path)))
+        return None
+
+    def _pixmap(self, path):
+        pix = self._pixmaps.get(path)
+        if pix is not None:
+            self._pixmaps.move_to_end(path)
+            return pix
+        if path not in self._failed:
+            # on disk or not, the pool finds out and _slot_ready brings it in
+            self.cache.request(path)
+        return self._placeholder
+
+    def _remember(self, path, pix):
+        self._pixmaps[path] = pix
+        while len(self._pixmaps) > self.max_pixmaps:
+            self._pixmaps.popitem(last=False)
+        return pix
+
+    def _slot_ready(self, path, out):
+        if not out:
+            self._failed.add(path)
+            return
+        row = self._rows.get(path)
+        if row is None:
+            return
+        self._remember(path, QPixmap(out))
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def set_images(self, files):
+        # the scan only appends: new rows keep scroll position and selection
+        n = len(self._files)
+        if files[:n] == self._files:
+            if len(files) > n:
+                self.beginInsertRows(QModelIndex(), n, len(files) - 1)
+                self._files = files
+                self._rows.update((f, i) for i, f in enumerate(files[n:], n))
+                self.endInsertRows()
+            return
+        self.beginResetModel()
+        self._files = files
+        self._rows = {f: i for i, f in enumerate(files)}
+        self.endResetModel()
+
+    def row_of(self, path):
+        return self._rows.get(path, -1)
+
+    def refresh_states(self):
+        if self._files:
+            self.dataChanged.emit(self.index(0), self.index(len(self._files) - 1),
+                                  [Qt.BackgroundRole, Qt.ToolTipRole])
+
+    def close(self):
+        self.cache.close()
+
+
+class ThumbnailNavigator(QWidget):
+    # a window with every image of the dataset as a grid, click to jump
+    imageChosen = pyqtSignal(int)
+
+    def __init__(self, size=THUMB_SIZE, parent=None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle('images')
+        self.resize(5 * (size + 24), 720)
+
+        self.model = ThumbnailModel(size, parent=self)
+        self.view = QListView()
+        self.view.setModel(self.model)
+        self.view.setViewMode(QListView.IconMode)
+        self.view.setMovement(QListView.Static)
+        self.view.setResizeMode(QListView.Adjust)
+        self.view.setIconSize(QSize(size, size))
+        self.view.setGridSize(QSize(size + 20, size + 36))
+        # no per item measuring, layout of 100k cells is arithmetic
+        self.view.setUniformItemSizes(True)
+        self.view.setLayoutMode(QListView.Batched)
+        self.view.setBatchSize(500)
+        self.view.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.view.clicked.connect(lambda index: self.imageChosen.emit(index.row()))
+        self.view.activated.connect(lambda index: self.imageChosen.emit(index.row()))
+
+        self.info = QLabel()
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addWidget(self.view)
+        layout.addWidget(self.info)
+
+    def set_images(self, files, state_of=None, name_of=None):
+        self.model.state_of = state_of
+        if name_of is not None:
+            self.model.name_of = name_of
+        self.model.set_images(files)
+        self.info.setText('{} images'.format(len(files)))
+
+    def set_current(self, row):
+        index = self.model.index(row)
+        if index.isValid():
+            self.view.setCurrentIndex(index)
+            self.view.scrollTo(index)
+
+    def refresh_states(self):
+        self.model.refresh_states()
+
+    def closeEvent(self, e):
+        # only hidden, the cache and its pool stay for the next time
+        self.hide()
+        e.ignore()
+
+    def shutdown(self):
+        print('thumbnails', self.model.cache.stats())
+        self.model.close()
@@ -0,0 +1,181 @@
+import math
+from collections import OrderedDict
+
+from PyQt5.QtWidgets import QGraphicsObject, QGraphicsItem
+from PyQt5.QtGui import QImage, QImageReader, QImageIOHandler, QPainter, QPixmap
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, QRect, QRectF, QSize, pyqtSignal
+
+
+class _TileTask(QRunnable):
+
+    def __init__(self, source, key, signals):
+        super().__init__()
+        self.source = source
+        self.key = key
+        self.signals = signals
+
+    def run(self):
+        img = self.source.read_tile(*self.key)
+        self.signals.tileReady.emit(self.key, img)
+
+
+class _TileSignals(QObject):
+    tileReady = pyqtSignal(tuple, QImage)
+
+
+def can_tile(reader):
+    # only formats that decode scaled clip rects straight from the file (jpeg)
+    # are tiled. others (png, tiff...) would need the whole image decoded for
+    # every level anyway, they take the plain decoded image path
+    return reader.supportsOption(QImageIOHandler.ImageOption.ScaledClipRect)
+
+
+class TileSource:
+    # mip pyramid over an image file. level 0 is full resolution, every level
+    # halves the previous one. tiles of every level are decoded straight from
+    # the file, nothing but the tiles on screen is ever held (see can_tile)
+
+    TILE = 512
+
+    def __init__(self, path):
+        self.path = path
+        reader = QImageReader(path)
+        self.size = reader.size()
+
+        self.levels = 1
+        while max(self.size.width(), self.size.height()) >> (self.levels - 1) > self.TILE:
+            self.levels += 1
+
+    def level_size(self, level):
+        return QSize(max(1, math.ceil(self.size.width() / (1 << level))),
+                     max(1, math.ceil(self.size.height() / (1 << level))))
+
+    def tile_rect(self, level, tx, ty):
+        # in level pixels
+        ls = self.level_size(level)
+        t = self.TILE
+        return QRect(tx * t, ty * t, min(t, ls.width() - tx * t), min(t, ls.height() - ty * t))
+
+    def read_tile(self, level, tx, ty):
+        rect = self.tile_rect(level, tx, ty)
+        reader = QImageReader(self.path)
+        if level:
+            reader.setScaledSize(self.level_size(level))
+            reader.setScaledClipRect(rect)
+        else:
+            reader.setClipRect(rect)
+        return reader.read()
+
+    def read_region(self, rect):
+        # full resolution pixels of rect, for OCR crops
+        reader = QImageReader(self.path)
+        reader.setClipRect(rect)
+        return reader.read()
+
+    def read_full(self):
+        # never kept here, the caller holds it as long as it needs it
+        return QImageReader(self.path).read()
+
+
+class TiledImageItem(QGraphicsObject):
+    # draws only the exposed tiles at the level matching the view scale, a
+    # small preview of the whole page fills in while tiles are still decoding
+
+    def __init__(self, path, cache_mb=192, parent=None):
+        super().__init__(parent)
+
+        self.source = TileSource(path)
+        self._rect = QRectF(0, 0, self.source.size.width(), self.source.size.height())
+
+        self._tiles = OrderedDict()     # (level, tx, ty) -> QPixmap
+        self._max_tiles = max(16, cache_mb * 1024 * 1024 // (TileSource.TILE * TileSource.TILE * 4))
+        self._pending = set()
+        self._closed = False
+
+        self._pool = QThreadPool()
+        self._pool.setMaxThreadCount(2)
+        self._signals = _TileSignals()
+        self._signals.tileReady.connect(self._slot_tile_ready)
+
+        top = self.source.levels - 1
+        self._preview = QPixmap.fromImage(self.source.read_tile(top, 0, 0))
+
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        return self._rect
+
+    def image_size(self):
+        return self.source.size
+
+    def close(self):
+        self._closed = True
+        self._pool.clear()
+        self._signals.tileReady.disconnect(self._slot_tile_ready)
+        self._tiles.clear()
+
+    def _level_for(self, lod):
+        if lod >= 1:
+            return 0
+        return min(int(math.floor(math.log2(1 / lod))), self.source.levels - 1)
+
+    def _tile_target(self, level, tx, ty):
+        # tile rect in item (full resolution) coordinates
+        r = self.source.tile_rect(level, tx, ty)
+        ls = self.source.level_size(level)
+        sx = self._rect.width() / ls.width()
+        sy = self._rect.height() / ls.height()
+        return QRectF(r.x() * sx, r.y() * sy, r.width() * sx, r.height() * sy)
+
+    def paint(self, painter, option, widget=None):
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        exposed = option.exposedRect.intersected(self._rect)
+        if exposed.isEmpty():
+            return
+
+        # preview under everything
+        psx = self._preview.width() / self._rect.width()
+        psy = self._preview.height() / self._rect.height()
+        painter.drawPixmap(exposed, self._preview,
+                           QRectF(exposed.x() * psx, exposed.y() * psy, exposed.width() * psx, exposed.height() * psy))
+
+        level = self._level_for(option.levelOfDetailFromTransform(painter.worldTransform()))
+        if level == self.source.levels - 1:
+            return
+
+        ls = self.source.level_size(level)
+        t = TileSource.TILE
+        sx = self._rect.width() / ls.width()
+        sy = self._rect.height() / ls.height()
+        tx0, tx1 = int(exposed.left() / sx) // t, int(exposed.right() / sx) // t
+        ty0, ty1 = int(exposed.top() / sy) // t, int(exposed.bottom() / sy) // t
+        nx, ny = math.ceil(ls.width() / t), math.ceil(ls.height() / t)
+
+        for ty in range(ty0, min(ty1, ny - 1) + 1):
+            for tx in range(tx0, min(tx1, nx - 1) + 1):
+                key = (level, tx, ty)
+                pm = self._tiles.get(key)
+                if pm is None:
+                    self._request(key)
+                    continue
+                self._tiles.move_to_end(key)
+                painter.drawPixmap(self._tile_target(*key), pm, QRectF(pm.rect()))
+
+    def _request(self, key):
+        if key in self._pending or self._closed:
+            return
+        self._pending.add(key)
+        self._pool.start(_TileTask(self.source, key, self._signals))
+
+    def _slot_tile_ready(self, key, img):
+        self._pending.discard(key)
+        if self._closed or img.isNull():
+            return
+        self._tiles[key] = QPixmap.fromImage(img)
+        while len(self._tiles) > self._max_tiles:
+            self._tiles.popitem(last=False)
+        self.update(self._tile_target(*key))
+
+    def wait_for_tiles(self, msecs=-1):
+        # benchmarks only
+        self._pool.waitForDone(msecs)